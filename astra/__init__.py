@@ -1,6 +1,7 @@
 from .astra import *
 from .generator import AstraGenerator
 from .evaluate import evaluate_astra_with_generator
+from .batch import AstraBatch
 from .astra_distgen import run_astra_with_distgen, evaluate_astra_with_distgen
 
 from . import _version
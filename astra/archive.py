@@ -1,10 +1,13 @@
+import h5py
 import numpy as np
 
 from pmd_beamphysics import ParticleGroup, pmd_init
 from pmd_beamphysics.units import read_dataset_and_unit_h5, write_dataset_and_unit_h5
 
 from .control import ControlGroup
+from .fieldmaps import fieldmap_fingerprint
 from .parsers import OutputUnits
+from .particles import compact_particle_group
 from .tools import isotime, native_type
 
 
@@ -112,26 +115,73 @@ def read_input_h5(h5):
 
 #----------------------------        
 # fieldmaps
-def write_fieldmap_h5(h5, fieldmap_dict, name='fieldmap'):
+# Group in the root of an archive file holding the 3D fieldmap datasets, by fingerprint
+FIELDMAP_STORE = 'fieldmap_store'
+
+def write_fieldmap_h5(h5, fieldmap_dict, name='fieldmap', store=None):
     """
     Writes all fieldmaps as simple datasets
+
+    3D fieldmaps are written once per content, as chunked and compressed datasets
+    in a store group, and linked from the fieldmap group.
+    The default store is FIELDMAP_STORE in the root of the file, so archives of many runs
+    in one file share the data with hard links, and each archive stays self-contained.
+    A store group in another file gives external links instead, and archives that
+    need that file.
     """
     g = h5.create_group(name)
     for k, v in fieldmap_dict.items():
+        if v['attrs'].get('type') == 'astra_3d':
+            if store is None:
+                store = h5.file.require_group(FIELDMAP_STORE)
+            dset = _write_fieldmap3d_h5(store, v)
+            if dset.file == h5.file:
+                g[k] = dset
+            else:
+                g[k] = h5py.ExternalLink(dset.file.filename, dset.name)
+            continue
+        
         g[k] = v['data']
         for k2, a in v['attrs'].items():
             g[k].attrs[k2] = a
+
+def _write_fieldmap3d_h5(store, fmap):
+    key = fieldmap_fingerprint(fmap)
+    if key in store:
+        return store[key]
+    
+    data = fmap['data']
+    dset = store.create_dataset(key, data=data, chunks=(1,) + data.shape[1:],
+                                compression='gzip', compression_opts=1, shuffle=True)
+    for k2, a in fmap['attrs'].items():
+        dset.attrs[k2] = a
+    for k2 in ('x', 'y', 'z'):
+        dset.attrs[k2] = fmap[k2]
+    return dset
         
 def read_fieldmap_h5(h5):
+    """
+    Reads fieldmaps from an h5 group. See: write_fieldmap_h5
+
+    The data arrays are read-only, as for fieldmaps loaded from files (see: fieldmaps.load_fieldmap),
+    so that their fingerprints are remembered.
+    """
     d = {}
     for fmap in h5:
         d[fmap] = {}
         d[fmap]['data'] = h5[fmap][:]
+        d[fmap]['data'].setflags(write=False)
         
         # Handle legacy fieldmaps without attrs
         attrs = dict(h5[fmap].attrs)
         if not attrs:
             attrs = {'type': 'astra_1d'}
+            
+        # 3D grids
+        if attrs['type'] == 'astra_3d':
+            for k in ('x', 'y', 'z'):
+                d[fmap][k] = attrs.pop(k)
+            
         d[fmap]['attrs'] = attrs            
             
     return d
@@ -160,9 +210,11 @@ def write_output_h5(h5, astra_output, name='output'):
             
     write_particles_h5(g, astra_output['particles'], name='particles')
             
-def read_output_h5(h5):
+def read_output_h5(h5, compact=False, float32=False):
     """
     Reads a properly archived astra output and returns a dict that corresponds to Astra.output
+
+    See read_particles_h5 for compact and float32.
     """
     
     o = {}
@@ -177,7 +229,7 @@ def read_output_h5(h5):
             o[name2][key], _ = read_dataset_and_unit_h5(g[key], expected_unit=expected_unit) 
             
     if 'particles' in h5:
-        o['particles'] = read_particles_h5(h5['particles'])        
+        o['particles'] = read_particles_h5(h5['particles'], compact=compact, float32=float32)
         
     return o
 
@@ -240,9 +292,12 @@ def write_particles_h5(h5, particles, name='particles'):
         particle_group.write(g, name=name)  
         
         
-def read_particles_h5(h5):
+def read_particles_h5(h5, compact=False, float32=False):
     """
     Reads particles from h5
+
+    With compact, the ParticleGroups are stored compactly, with float32 as in
+    particles.compact_particle_group
     
     See: write_particles_h5
     """
@@ -251,4 +306,11 @@ def read_particles_h5(h5):
     ilist = sorted([int(x) for x in list(h5)])
     glist = [str(i) for i in ilist]
     
-    return [ParticleGroup(h5=h5[g]) for g in glist]          
+    particles = []
+    for g in glist:
+        P = ParticleGroup(h5=h5[g])
+        if compact:
+            # One screen at a time, so the full size copies are not all in memory
+            compact_particle_group(P, float32=float32)
+        particles.append(P)
+    return particles          
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import tempfile
 import shutil
 import os
@@ -8,6 +9,8 @@ import traceback
 from time import time
 from copy import deepcopy
 import functools
+import hashlib
+import weakref
 
 import h5py
 import numpy as np
@@ -18,13 +21,22 @@ from pmd_beamphysics import ParticleGroup
 
 from . import parsers, writers, tools, archive
 from .control import ControlGroup
-from .fieldmaps import load_fieldmaps, write_fieldmaps
+from .fieldmaps import load_fieldmaps, write_fieldmaps, fieldmap_fingerprint
 from .generator import AstraGenerator
 from .plot import plot_stats_with_layout, plot_fieldmaps
+from .monitor import RunMonitor, OutputFileTail, partial_output_stats
+from .segments import (SegmentCache, element_z_ranges, elements_at, segment_key, concatenate_stats,
+                       particle_fingerprint)
+from .evaluate_cache import as_evaluate_cache
+from .particles import PhaseFileSequence, load_phase_files, particle_stats_table, compact_particles
+from .streaming import stream_stats
+from .split import (space_charge_off, split_astra_particle_file, merge_particle_lists,
+                    sum_landf, reference_particle_charge, norm_emit_z, PARTICLE_STAT_KEYS)
+from .auto_phase import (cavity_phase_keys, cached_cavity_phases, store_cavity_phases,
+                         apply_cavity_phases, restore_input)
 from .interfaces.bmad import astra_from_tao
 
 from pmd_beamphysics import ParticleGroup, single_particle
-from pmd_beamphysics.interfaces.astra import parse_astra_phase_file
 
 
 import numpy as np
@@ -52,6 +64,8 @@ class Astra(CommandWrapper):
         $ASTRA_BIN
     environmental variable.
     
+    The work directory is created when it is first needed. 
+    If a workdir_pool (see astra.workdir.WorkdirPool) is given, it will be leased from the pool.
     
     """
     MPI_SUPPORTED = False
@@ -62,11 +76,20 @@ class Astra(CommandWrapper):
                  input_file=None,
                  *,                 
                  group=None,
+                 workdir_pool=None,
                  **kwargs
                  ):
         super().__init__(input_file=input_file, **kwargs)
         # Save init
         self.original_input_file = self._input_file
+        self.workdir_pool = workdir_pool
+        self._workdir_lease = None
+        self.monitor = None
+        self.segment_cache = None
+        self.auto_phase_cache = None  # See: astra.auto_phase.AutoPhaseCache
+        self._auto_phase_keys = None
+        self._particle_stats_cache = {}  # See: .particle_stats
+        self._written_files = {}  # Path: (digest, file stat) of written input. See: ._write_if_changed
 
         # These will be set
         self.log = []
@@ -129,7 +152,7 @@ class Astra(CommandWrapper):
     def stat(self, key):
         return self.output['stats'][key]
 
-    def particle_stat(self, key, alive_only=True):
+    def particle_stat(self, key, alive_only=True, chunk_size=None):
         """
         Compute a statistic from the particles.
 
@@ -137,28 +160,137 @@ class Astra(CommandWrapper):
 
         n_dead will override the alive_only flag,
         and return the number of particles with status < -6 (Astra convention)
+
+        With chunk_size, the phase space files are streamed chunk_size particles at a time,
+        without loading them. See: astra.streaming
+
+        See: .particle_stats
         """
+        return self.particle_stats([key], alive_only=alive_only, chunk_size=chunk_size)[key]
 
-        if key == 'n_dead':
-            return np.array([len(np.where(P.status < -6)[0]) for P in self.particles])
+    def particle_stats(self, keys, alive_only=True, chunk_size=None):
+        """
+        Compute many statistics from the particles, in one pass over the screens.
 
-        if key == 'n_alive':
-            return np.array([len(np.where(P.status > -6)[0]) for P in self.particles])
+        The results are cached until the particles are reloaded.
 
-        pstats = []
-        for P in self.particles:
-            if alive_only and P.n_dead > 0:
-                P = P.where(P.status == 1)
-            pstats.append(P[key])
-        return np.array(pstats)
+        Parameters
+        ----------
+        keys : list of str
+            Keys as in .particle_stat
+        alive_only : bool, optional
+            Compute statistics from the alive particles only. Default: True
+        chunk_size : int, optional
+            Stream the phase space files chunk_size particles at a time, instead of using .particles.
+            Default: None
+
+        Returns
+        -------
+        dict of key: array with one value per screen
+
+        """
+        if chunk_size:
+            source = tuple((f, os.stat(f).st_mtime_ns) for f in self._phase_files())
+        else:
+            source = (id(self.particles), len(self.particles))
+
+        cache = self._particle_stats_cache
+        if cache.get('source') != source:
+            # Keep a reference, so the id is not reused
+            cache = self._particle_stats_cache = {'source': source, 'particles': self.particles, 'stats': {}}
+        stats = cache['stats']
+
+        todo = [key for key in dict.fromkeys(keys) if (key, alive_only) not in stats]
+        if todo:
+            if chunk_size:
+                results = [stream_stats(f, todo, chunk_size=chunk_size, alive_only=alive_only).result()
+                           for f, _ in source]
+                new = {key: np.array([r[key] for r in results]) for key in todo}
+            else:
+                new = particle_stats_table(self.particles, todo, alive_only=alive_only)
+            for key, val in new.items():
+                stats[(key, alive_only)] = val
+
+        return {key: stats[(key, alive_only)] for key in keys}
 
-    
     def configure(self):
-        self.setup_workdir(self._workdir)
         self.command = lumetools.full_path(self.command)
-        self.vprint("Configured to run in:", self.path)
-        self.input_file = os.path.join(self.path, self.original_input_file)
+        # The workdir will be set up when needed. See: .path
+        self.release_workdir()
+        self._base_path = None
         self.configured = True    
+
+    @property
+    def path(self):
+        """
+        The work directory. Created (or leased) on first access after configure.
+        """
+        if self._base_path is None and self.configured:
+            self._setup_path()
+        return self._base_path
+
+    @path.setter
+    def path(self, path):
+        self._base_path = path
+
+    @property
+    def input_file(self):
+        if self._base_path is None and self.configured:
+            self._setup_path()
+        return self._input_file
+
+    @input_file.setter
+    def input_file(self, input_file):
+        self._input_file = input_file
+
+    def _setup_path(self):
+        if self.workdir_pool is not None:
+            path = self.workdir_pool.lease()
+            self._workdir_lease = weakref.finalize(self, self.workdir_pool.release, path)
+            self._base_path = path
+        else:
+            self.setup_workdir(self._workdir)
+        self.vprint("Configured to run in:", self._base_path)
+        self._input_file = os.path.join(self._base_path, self.original_input_file)
+
+    def release_workdir(self):
+        """
+        Returns a leased work directory to its pool. A new one will be leased when needed.
+
+        Has no effect if the workdir is not from a pool.
+        Lazily loaded particles are loaded first, because the pool cleans the workdir.
+        """
+        if self._workdir_lease is not None:
+            particles = self.output.get('particles')
+            if isinstance(particles, PhaseFileSequence):
+                self.output['particles'] = particles.materialize()
+            self._workdir_lease()
+            self._workdir_lease = None
+            self._base_path = None
+
+    def __deepcopy__(self, memo):
+        """
+        Deep copy. The copy shares the workdir pool, but not a leased workdir: it leases its own
+        when needed. Lazily loaded particles in a leased workdir are loaded first.
+        """
+        cls = self.__class__
+        new = cls.__new__(cls)
+        memo[id(self)] = new
+        for key, val in self.__dict__.items():
+            if key != '_workdir_lease':
+                new.__dict__[key] = deepcopy(val, memo)
+        new._workdir_lease = None
+
+        particles = new.output.get('particles')
+        if isinstance(particles, PhaseFileSequence):
+            if self._workdir_lease is not None:
+                new.output['particles'] = particles.materialize()
+            else:
+                # Keep the files of the original
+                particles._owner = self
+        if self._workdir_lease is not None:
+            new._base_path = None
+        return new
     
     
  #   def configure(self):
@@ -176,11 +308,13 @@ class Astra(CommandWrapper):
  #       #self.input_file = os.path.join(self.path, self.original_input_file)
  #       self.configured = True
 
-    def load_fieldmaps(self, search_paths=[]):
+    def load_fieldmaps(self, search_paths=[], include_3d=False):
         """
         Loads fieldmaps into Astra.fieldmap as a dict.
 
         Optionally, a list of paths can be included that will search for these. The default will search self.path.
+
+        3D fieldmaps are only loaded with include_3d. See: fieldmaps.load_fieldmap3d
         """
 
         # Do not consider files if fieldmaps have been loaded.
@@ -193,7 +327,7 @@ class Astra(CommandWrapper):
             search_paths = [self.path]
 
         self.fieldmap = load_fieldmaps(self.input, fieldmap_dict=self.fieldmap, search_paths=search_paths,
-                                       verbose=self.verbose, strip_path=strip_path)
+                                       verbose=self.verbose, strip_path=strip_path, include_3d=include_3d)
         
     def load_initial_particles(self, h5):
         """Loads a openPMD-beamphysics particle h5 handle or file"""
@@ -208,7 +342,7 @@ class Astra(CommandWrapper):
         if absolute_paths:
             parsers.fix_input_paths(self.input, root=self.original_path)
 
-    def load_output(self, include_particles=True):
+    def load_output(self, include_particles=True, lazy=True, max_bytes=None):
         """
         Loads Astra output files into .output
 
@@ -218,7 +352,19 @@ class Astra(CommandWrapper):
             .other
 
         and if include_particles,
-            .particles = list of ParticleGroup objects
+            .particles = sequence of ParticleGroup objects
+
+        By default, the particles are a PhaseFileSequence, which parses a screen on first access.
+        See: .load_particles
+
+        Parameters
+        ----------
+        include_particles : bool, optional
+            Load the phase space files. Default: True
+        lazy : bool, optional
+            Load screens on access, instead of all at once. Default: True
+        max_bytes : int, optional
+            Memory budget of a lazy sequence. Default: astra.particles.DEFAULT_MAX_BYTES
 
         """
         run_number = parsers.astra_run_extension(self.input['newrun']['run'])
@@ -244,15 +390,56 @@ class Astra(CommandWrapper):
         assert len(nlist) == 1, f'Stat keys do not all have the same length: {[len(stats[k]) for k in stats]}'
 
         if include_particles:
-            self.load_particles()
+            self.load_particles(lazy=lazy, max_bytes=max_bytes)
+
+    def load_particles(self, end_only=False, max_workers=1, executor='process', lazy=False, max_bytes=None,
+                       columns=None, alive_only=False, subsample=None, seed=0, compact=False, float32=False):
+        """
+        Loads the phase space files into .output['particles'], sorted by z.
+
+        With lazy, this is a PhaseFileSequence that only parses a file when its screen
+        is first accessed, and keeps parsed screens up to a memory budget.
+        The files must then stay in place until all screens are accessed: a rerun in the same
+        workdir invalidates the sequence. A leased workdir loads all screens before it is released.
+
+        Parameters
+        ----------
+        end_only : bool, optional
+            Only load the last file. Default: False
+        max_workers : int, optional
+            Number of files to parse in parallel, if not lazy. None means os.cpu_count(). Default: 1
+        executor : str or concurrent.futures.Executor, optional
+            'process' or 'thread' pool, or an existing executor. Default: 'process'
+        lazy : bool, optional
+            Load screens on access. Default: False
+        max_bytes : int, optional
+            Memory budget of a lazy sequence. Default: astra.particles.DEFAULT_MAX_BYTES
+        columns : list of str, optional
+            Only read these ParticleGroup keys, for example ['z', 'pz', 't'].
+            Other keys are nan. Default: None (all)
+        alive_only : bool, optional
+            Drop particles that are not alive (status == 1). Default: False
+        subsample : int or float, optional
+            Keep every k-th particle (int), or a random fraction (float in (0, 1)) chosen with seed.
+            Weights are scaled to keep the total charge. Default: None (all)
+        seed : int, optional
+            Seed of a random subsample. Default: 0
+        compact : bool, optional
+            Store status as int8, and constant weight and t as a single value. Default: False
+        float32 : bool or list of str, optional
+            With compact, store these coordinates (True for all) as float32.
+            See: astra.particles.compact_particle_group. Default: False
+
+        """
+        options = {'columns': columns, 'alive_only': alive_only, 'subsample': subsample, 'seed': seed}
+        if compact:
+            options.update(compact=True, float32=float32)
 
-    def load_particles(self, end_only=False):
         # Clear existing particles
         self.output['particles'] = []
 
         # Sort files by approximate z
-        run_number = parsers.astra_run_extension(self.input['newrun']['run'])
-        phase_files = parsers.find_phase_files(self.input_file, run_number)
+        phase_files = self._phase_files(with_z=True)
         files = [x[0] for x in phase_files]  # This is sorted by approximate z
         zapprox = [x[1] for x in phase_files]
 
@@ -261,41 +448,94 @@ class Astra(CommandWrapper):
         if self.verbose:
             print('loading ' + str(len(files)) + ' particle files')
             print(zapprox)
-        for f in files:
-            pdat = parse_astra_phase_file(f)
-            P = ParticleGroup(data=pdat)
-            self.output['particles'].append(P)
 
-    def run(self):
-        self.run_astra()
+        if lazy:
+            zapprox = zapprox[-len(files):] if files else []
+            self.output['particles'] = PhaseFileSequence(files, z=zapprox, max_bytes=max_bytes, owner=self,
+                                                         options=options)
+        else:
+            self.output['particles'] = load_phase_files(files, max_workers=max_workers, executor=executor,
+                                                        **options)
+
+    def _phase_files(self, with_z=False):
+        """
+        Phase space files of the current run, sorted by approximate z.
+        """
+        run_number = parsers.astra_run_extension(self.input['newrun']['run'])
+        phase_files = parsers.find_phase_files(self.input_file, run_number)
+        if with_z:
+            return phase_files
+        return [x[0] for x in phase_files]
+
+    def run(self, **kwargs):
+        self.run_astra(**kwargs)
 
-    def run_astra(self, verbose=False, parse_output=True, timeout=None):
+    def run_astra(self, verbose=False, parse_output=True, timeout=None,
+                  stall_timeout=None, progress_callback=None, poll_interval=1.0, abort=None):
         """
         Runs Astra
 
         Changes directory, so does not work with threads.
+
+        Parameters
+        ----------
+        parse_output : bool, optional
+            Load the output after the run. Default: True
+        timeout : float, optional
+            Time limit in seconds. Default: self.timeout
+        stall_timeout : float, optional
+            Kill the run if no new z position is written to the stats files within this many seconds.
+            Default: None (never)
+        progress_callback : callable, optional
+            Called with a progress dict during the run. See: astra.monitor.RunMonitor.status
+        poll_interval : float, optional
+            Seconds between progress checks. Default: 1
+        abort : list of str or callable, optional
+            Kill the run as soon as one of these conditions is true for the stats written so far,
+            like ['norm_emit_x > 5e-6', 'sigma_x > 3 mm', 'n_lost > 10%'].
+            See: astra.monitor.AbortCondition
+            why_error will be 'abort: <condition>'
+
+        If the run is killed by the monitor, .error is set, and the partial stats are loaded.
+        The monitor is kept as .monitor
         """
         if not self.configured:
             print('not configured to run')
             return
 
-        run_info = self.output['run_info'] = {}
+        monitored = stall_timeout is not None or progress_callback is not None or abort
+        if monitored:
+            # The monitor must not see the stats of a previous run in this workdir
+            self.clean_output()
 
-        t1 = time()
-        run_info['start_time'] = t1
+        runscript = self._setup_run()
+        run_info = self.output['run_info']
+        t1 = run_info['start_time']
 
-        # Write all input
-        self.write_input()
+        if monitored:
+            self.monitor = RunMonitor.from_astra(self, stall_timeout=stall_timeout, callback=progress_callback,
+                                                 abort=abort)
+            poll = self.monitor.poll
+        else:
+            self.monitor = None
+            poll = None
 
-        runscript = self.get_run_script()
-        tools.make_executable(os.path.join(self.path, 'run'))
-        run_info['run_script'] = ' '.join(runscript)
+        timeout = timeout or self.timeout
 
-        if self.timeout:
-            res = tools.execute2(runscript, timeout=timeout, cwd=self.path)
+        if timeout or poll:
+            res = tools.execute2(runscript, timeout=timeout, cwd=self.path, poll=poll, poll_interval=poll_interval)
             log = res['log']
             self.error = res['error']
             run_info['why_error'] = res['why_error']
+            self._record_usage(res['usage'])
+            if self.monitor and res['why_error'] and res['why_error'] != 'timeout':
+                # Killed by the monitor
+                self.log = log
+                if parse_output:
+                    self.load_partial_output()
+                run_info['run_time'] = time() - t1
+                self.vprint(run_info)
+                return
             # Log file must have this to have finished properly
             if log.find('finished simulation') == -1:
                 raise ValueError("Couldn't find finished simulation")
@@ -303,11 +543,14 @@ class Astra(CommandWrapper):
         else:
             # Interactive output, for Jupyter
             log = []
-            for path in tools.execute(runscript, cwd=self.path):
+            usage = {}
+            for path in tools.execute(runscript, cwd=self.path, usage=usage):
                 self.vprint(path, end="")
                 log.append(path)
+            self._record_usage(usage)
 
         self.log = log
+        self._store_auto_phases()
 
         if parse_output:
             self.load_output()
@@ -318,16 +561,161 @@ class Astra(CommandWrapper):
 
         self.vprint(run_info)
 
+    def load_partial_output(self):
+        """
+        Loads the stats written so far by an unfinished run into .output
+
+        Arrays are cut to a common length.
+        """
+        run_number = parsers.astra_run_extension(self.input['newrun']['run'])
+        outfiles = parsers.find_astra_output_files(self.input_file, run_number)
+        tails = [OutputFileTail(f) for f in outfiles]
+        for tail in tails:
+            tail.update()
+        stats, other = partial_output_stats(tails)
+        self.output['stats'] = stats
+        if other:
+            self.output['other'] = other
+
+    async def run_async(self, parse_output=True, timeout=None, executor=None):
+        """
+        Runs Astra as an asyncio coroutine.
+
+        The process output is read, and its exit awaited, by the event loop, without a thread per run.
+        Where available, the process is reaped with os.wait4, so run_info has the same CPU and
+        memory usage as a run. See: tools.execute_async
+        Writing input and parsing output are done in an executor.
+
+        Cancelling the task kills the Astra process.
+
+        Parameters
+        ----------
+        parse_output : bool, optional
+            Load the output after the run. Default: True
+        timeout : float, optional
+            Time limit in seconds. Default: self.timeout
+        executor : concurrent.futures.Executor, optional
+            Executor for writing input and parsing output. Default: the loop's default executor
+
+        """
+        if not self.configured:
+            print('not configured to run')
+            return
+
+        loop = asyncio.get_running_loop()
+
+        runscript = await loop.run_in_executor(executor, self._setup_run)
+        run_info = self.output['run_info']
+        t1 = run_info['start_time']
+
+        res = await tools.execute_async(runscript, timeout=timeout or self.timeout, cwd=self.path)
+        log = res['log']
+        self.error = res['error']
+        run_info['why_error'] = res['why_error']
+        self._record_usage(res['usage'])
+        self.log = log
+
+        # Log file must have this to have finished properly
+        if log.find('finished simulation') == -1:
+            raise ValueError("Couldn't find finished simulation")
+
+        self._store_auto_phases()
+
+        if parse_output:
+            await loop.run_in_executor(executor, self.load_output)
+
+        run_info['run_time'] = time() - t1
+
+        self.finished = True
+
+        self.vprint(run_info)
+
+    def _setup_run(self):
+        """
+        Writes all input and the run script, and starts a new run_info.
+
+        Returns the run script.
+        """
+        run_info = self.output['run_info'] = {}
+        run_info['start_time'] = time()
+
+        # Cached cavity phases are only written to the input file
+        saved = self._apply_auto_phase_cache()
+        try:
+            # Write all input
+            self.write_input()
+        finally:
+            if saved:
+                restore_input(self.input, saved)
+
+        runscript = self.get_run_script()
+        tools.make_executable(os.path.join(self.path, 'run'))
+        run_info['run_script'] = ' '.join(runscript)
+
+        # To find what the run writes
+        self._workdir_files = tools.dir_file_stats(self.path)
+
+        return runscript
+
+    def _apply_auto_phase_cache(self):
+        """
+        If .auto_phase_cache has the phases of all cavities, writes them into the input, 
+        and turns off auto_phase. 
+
+        Returns the original values to restore, or None.
+        """
+        self._auto_phase_keys = None
+        if self.auto_phase_cache is None or not self.input['newrun'].get('auto_phase'):
+            return None
+
+        keys = cavity_phase_keys(self)
+        phases = cached_cavity_phases(self.auto_phase_cache, keys)
+        self.output['run_info']['auto_phase_cached'] = phases is not None
+        if phases is None:
+            # Store the phases after the run
+            self._auto_phase_keys = keys
+            return None
+
+        return apply_cavity_phases(self.input, phases)
+
+    def _store_auto_phases(self):
+        """
+        Stores the cavity phases from the log in .auto_phase_cache, if the run phased the cavities.
+        """
+        if not self._auto_phase_keys or self.error:
+            return
+        phases = parsers.parse_auto_phase_table(self.log)
+        if phases:
+            store_cavity_phases(self.auto_phase_cache, self._auto_phase_keys, phases)
+        self._auto_phase_keys = None
+
+    def _record_usage(self, usage):
+        """
+        Adds the resource usage of the run to run_info:
+            cpu_user_time, cpu_system_time : CPU time of the process (s)
+            max_rss : peak resident set size of the process (bytes)
+            bytes_written : total size of the files written or changed in the workdir
+            n_output_files : number of files written or changed in the workdir
+
+        CPU and memory usage are only available for processes reaped with os.wait4 (see: tools.wait_process)
+        """
+        run_info = self.output['run_info']
+        run_info.update(usage)
+        changes = tools.dir_file_changes(self._workdir_files, tools.dir_file_stats(self.path))
+        run_info.update(changes)
+
     def units(self, key):
         if key in parsers.OutputUnits:
             return parsers.OutputUnits[key]
         else:
             return 'unknown unit'
 
-    def load_archive(self, h5=None, configure=False):
+    def load_archive(self, h5=None, configure=False, compact=False, float32=False):
         """
         Loads input and output from archived h5 file.
 
+        With compact, the particles are stored compactly. See: astra.particles.compact_particle_group
+
         See: Astra.archive
         """
         if isinstance(h5, str):
@@ -351,7 +739,7 @@ class Astra(CommandWrapper):
             g = h5
 
         self.input = archive.read_input_h5(g['input'])
-        self.output = archive.read_output_h5(g['output'])
+        self.output = archive.read_output_h5(g['output'], compact=compact, float32=float32)
         if 'initial_particles' in g:
             self.initial_particles = ParticleGroup(h5=g['initial_particles'])
 
@@ -372,12 +760,15 @@ class Astra(CommandWrapper):
         if configure:
             self.configure()
 
-    def archive(self, h5=None):
+    def archive(self, h5=None, fieldmap_store=None):
         """
         Archive all data to an h5 handle or filename.
 
         If no file is given, a file based on the fingerprint will be created.
 
+        3D fieldmaps are stored once per file, or once in fieldmap_store, an h5 group in a shared file.
+        See: archive.write_fieldmap_h5
+
         """
         if not h5:
             h5 = 'astra_' + self.fingerprint() + '.h5'
@@ -399,7 +790,7 @@ class Astra(CommandWrapper):
 
         # Fieldmaps
         if self.fieldmap:
-            archive.write_fieldmap_h5(g, self.fieldmap, name='fieldmap')
+            archive.write_fieldmap_h5(g, self.fieldmap, name='fieldmap', store=fieldmap_store)
 
         # All input
         archive.write_input_h5(g, self.input)
@@ -413,41 +804,80 @@ class Astra(CommandWrapper):
 
         return h5
 
-    def write_fieldmaps(self, path=None):
+    def write_fieldmaps(self, path=None, force=False):
         """
-        Writes any loaded fieldmaps to path
+        Writes any loaded fieldmaps to path.
+
+        Fieldmaps that this object already wrote there, and that have not changed, are skipped,
+        unless force.
         """
         if path is None:
             path = self.path         
 
-        if self.fieldmap:
-            write_fieldmaps(self.fieldmap, path)
-            self.vprint(f'{len(self.fieldmap)} fieldmaps written to {path}')
+        n = 0
+        for k, fmap in self.fieldmap.items():
+            n += self._write_if_changed(os.path.join(path, k), fieldmap_fingerprint(fmap),
+                                        lambda f, k=k, fmap=fmap: write_fieldmaps({k: fmap}, path), force=force)
+        if n:
+            self.vprint(f'{n} fieldmaps written to {path}')
 
-    def write_input(self, input_filename=None, path=None, make_symlinks=True):
+    def write_input(self, input_filename=None, path=None, make_symlinks=True, force=False):
         """
         Writes all input. If fieldmaps have been loaded, these will also be written.
+
+        The initial particles, fieldmaps, and input file are only written if they changed since
+        this object last wrote them to path, unless force.
         """
         
         if path is None:
             path = self.path        
 
         if self.initial_particles:
-            fname = self.write_initial_particles(path=path)
-            self.input['newrun']['distribution'] = fname
+            self.input['newrun']['distribution'] = self._write_initial_particles_if_changed(path, force=force)
 
-        self.write_fieldmaps(path=path)
+        self.write_fieldmaps(path=path, force=force)
 
-        self.write_input_file(path=path, make_symlinks=make_symlinks)
+        self.write_input_file(path=path, make_symlinks=make_symlinks, force=force)
 
-    def write_input_file(self, path=None, make_symlinks=True):
+    def write_input_file(self, path=None, make_symlinks=True, force=False):
         if path is None:
             path = self.path
             input_file = self.input_file
         else:
             input_file = os.path.join(path, 'astra.in')
             
-        writers.write_namelists(self.input, input_file, make_symlinks=make_symlinks, verbose=self.verbose)
+        text = writers.render_namelists(self.input, input_file, make_symlinks=make_symlinks, verbose=self.verbose)
+
+        def write(f):
+            with open(f, 'w') as fid:
+                fid.write(text)
+
+        digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        self._write_if_changed(input_file, digest, write, force=force)
+
+    def _write_initial_particles_if_changed(self, path, force=False):
+        """
+        Writes the initial particles to path/astra.particles, if they changed. Returns the file name.
+        """
+        fname = os.path.join(path, 'astra.particles')
+        self._write_if_changed(fname, particle_fingerprint(self.initial_particles),
+                               lambda f: self.write_initial_particles(fname=f), force=force)
+        return fname
+
+    def _write_if_changed(self, filePath, digest, write, force=False):
+        """
+        Calls write(filePath), unless this object already wrote content with the same digest there,
+        and the file has not changed since (size, mtime).
+
+        Returns True if the file was written.
+        """
+        f = os.path.abspath(filePath)
+        record = self._written_files.get(f)
+        if not force and record is not None and record == (digest, tools.file_stat(f)):
+            return False
+        write(f)
+        self._written_files[f] = (digest, tools.file_stat(f))
+        return True
 
     def write_initial_particles(self, fname=None, path=None):
         if path is None:
@@ -604,10 +1034,16 @@ class Astra(CommandWrapper):
     
     # Tracking
     #---------
-    def track(self, particles, z=None):
+    def track(self, particles, z=None, n_chunks=None, max_workers=None, compact=False, float32=False):
         """
         Track a ParticleGroup. An optional stopping z can be given.
 
+        If n_chunks is given, and space charge is off, the particles are tracked 
+        in parallel processes. See: .run_split
+
+        With compact, the output particles are stored compactly, with float32 coordinates if asked for.
+        See: astra.particles.compact_particle_group
+
         If successful, returns a ParticleGroup with the final particles.
         
         Otherwise, returns None
@@ -627,7 +1063,13 @@ class Astra(CommandWrapper):
         # Turn particle output on.
         nr['phases'] = True
     
-        self.run()
+        if n_chunks:
+            self.run_split(n_chunks, max_workers=max_workers)
+        else:
+            self.run()
+
+        if compact and self.output.get('particles'):
+            self.output['particles'] = compact_particles(self.output['particles'], float32=float32)
     
         if 'particles' in self.output:
             if len(self.output['particles']) == 0:
@@ -670,9 +1112,243 @@ class Astra(CommandWrapper):
         """
         p0 = single_particle(x=x0, px=px0, y=y0, py=py0, z=z0, pz=pz0, t=t0, weight=weight, status=status, species=species)
         return self.track(p0, z=z)
-    
-    
-    
+
+
+    def run_segmented(self, boundaries, cache=None):
+        """
+        Runs in segments split at boundary z positions, resuming from cached particles when possible.
+
+        The particles at each boundary are cached, keyed by all of the input that can change them:
+        settings, elements that start before the boundary (or whose extent is unknown),
+        and the initial particles or distribution file. See: astra.segments.segment_key
+
+        A run starts from the deepest boundary in the cache with unchanged upstream input,
+        so scans of downstream settings only track the downstream segments.
+
+        Boundaries must not be inside the known z range of a cavity, solenoid, or quadrupole
+        (see: astra.segments.element_z_ranges). A segment starting there would start inside
+        the field, and Astra would auto-phase a cavity from there, so the result would differ
+        from a full run. These boundaries raise a ValueError.
+
+        Parameters
+        ----------
+        boundaries : list of float
+            z positions in m to split the beamline at. Positions outside of (zstart, zstop) are ignored.
+        cache : SegmentCache, EvaluateCache, or str, optional
+            Cache for the segment results. A str is a path for an EvaluateCache on disk.
+            Default: .segment_cache, a SegmentCache that is created on first use.
+
+        .output['stats'] and .output['other'] are concatenated over all segments, including cached ones.
+        .output['particles'] has the particles at each boundary that was tracked or resumed from,
+        followed by the particles of the last segment.
+        .output['run_info'] has n_segments and n_cached_segments.
+        """
+        if cache is None:
+            if self.segment_cache is None:
+                self.segment_cache = SegmentCache()
+            cache = self.segment_cache
+        elif isinstance(cache, str):
+            cache = as_evaluate_cache(cache)
+
+        output_nl = self.input['output']
+        zstart = output_nl.get('zstart', 0)
+        zstop = output_nl['zstop']
+        boundaries = sorted(z for z in boundaries if zstart < z < zstop)
+
+        ranges = element_z_ranges(self.input, self.fieldmap)
+        for z in boundaries:
+            inside = elements_at(ranges, z)
+            if inside:
+                raise ValueError(f'Segment boundary z = {z} m is inside the field of {inside}')
+        keys = [segment_key(self, z, ranges=ranges) for z in boundaries]
+
+        # Deepest cached boundary
+        start = 0
+        entry = None
+        for i in reversed(range(len(boundaries))):
+            entry = cache.get(keys[i])
+            if entry is not None:
+                start = i + 1
+                break
+
+        if entry is not None:
+            P = entry['particles']
+            stats_list = [entry['stats']]
+            other_list = [entry['other']]
+            particles = [P]
+        else:
+            P = self.initial_particles
+            stats_list = []
+            other_list = []
+            particles = []
+
+        t1 = time()
+
+        # Segments change these. Restore them in place, because groups are linked to the input.
+        saved_newrun = dict(self.input['newrun'])
+        saved_output = dict(output_nl)
+        saved_particles = self.initial_particles
+        try:
+            for i in range(start, len(boundaries) + 1):
+                z = boundaries[i] if i < len(boundaries) else zstop
+                P_end = self._run_segment(P, z)
+
+                stats_list.append(self.output['stats'])
+                other_list.append(self.output.get('other', {}))
+                segment_particles = self.output['particles']
+
+                if self.error or P_end is None:
+                    break
+
+                if i < len(boundaries):
+                    cache.put(keys[i], {'particles': P_end,
+                                        'stats': concatenate_stats(stats_list),
+                                        'other': concatenate_stats(other_list, z_key='landf_z')})
+                    particles.append(P_end)
+                P = P_end
+        finally:
+            self.input['newrun'].clear()
+            self.input['newrun'].update(saved_newrun)
+            output_nl.clear()
+            output_nl.update(saved_output)
+            self.initial_particles = saved_particles
+
+        self.output['stats'] = concatenate_stats(stats_list)
+        self.output['other'] = concatenate_stats(other_list, z_key='landf_z')
+        self.output['particles'] = particles + list(segment_particles)
+
+        run_info = self.output['run_info']
+        run_info['start_time'] = t1
+        run_info['run_time'] = time() - t1
+        run_info['n_segments'] = len(boundaries) + 1
+        run_info['n_cached_segments'] = start
+
+    def run_split(self, n_chunks=None, max_workers=None, mp_context=None):
+        """
+        Runs with the particles split into chunks, tracked in parallel processes. 
+
+        This requires space charge to be off (charge:lspch and charge:lspch3d False),
+        so that the particles are independent. All chunks share the reference particle
+        of the full distribution.
+
+        The particles at each output are merged, and .output['stats'] is computed from them,
+        so it has one point per particle output. LandF tables are summed, counting the
+        shared reference particle once.
+
+        Parameters
+        ----------
+        n_chunks : int, optional
+            Number of chunks. Default: os.cpu_count()
+        max_workers : int, optional
+            Number of worker processes. Default: os.cpu_count()
+        mp_context : str, optional
+            multiprocessing start method. See: astra.batch.AstraBatch
+
+        """
+        from .batch import AstraBatch
+
+        if not space_charge_off(self.input):
+            raise ValueError('run_split requires charge:lspch and charge:lspch3d to be False')
+        if not self.configured:
+            print('not configured to run')
+            return
+
+        t1 = time()
+        n_chunks = n_chunks or os.cpu_count()
+
+        # Full distribution, with its reference particle
+        if self.initial_particles:
+            dist = self._write_initial_particles_if_changed(self.path)
+        else:
+            dist = self.input['newrun']['distribution']
+        files = split_astra_particle_file(dist, n_chunks, path=self.path)
+        ref_charge = reference_particle_charge(dist)
+
+        # Workers use the chunk files instead
+        saved_particles = self.initial_particles
+        self.initial_particles = None
+        try:
+            B = AstraBatch(template=self, settings=[{'newrun:distribution': f} for f in files],
+                           max_workers=max_workers, include_particles=True, mp_context=mp_context)
+        finally:
+            self.initial_particles = saved_particles
+
+        try:
+            results = B.run()
+        finally:
+            for f in files:
+                os.remove(f)
+
+        run_info = self.output['run_info'] = {'start_time': t1, 'n_chunks': len(files)}
+        self.log = results[0]['log']
+        self.error = any(r['error'] for r in results)
+        run_info['why_error'] = '\n'.join(r['why_error'] for r in results if r['error'])
+
+        # Totals over chunks
+        chunk_info = [r['output']['run_info'] for r in results]
+        for k in ('cpu_user_time', 'cpu_system_time', 'bytes_written', 'n_output_files'):
+            if all(k in ri for ri in chunk_info):
+                run_info[k] = sum(ri[k] for ri in chunk_info)
+        if all('max_rss' in ri for ri in chunk_info):
+            run_info['max_rss'] = max(ri['max_rss'] for ri in chunk_info)
+
+        if self.error:
+            self.output['stats'] = {}
+            self.output['particles'] = []
+        else:
+            particles = merge_particle_lists([r['output']['particles'] for r in results])
+            self.output['particles'] = particles
+            stats = particle_stats_table(particles, PARTICLE_STAT_KEYS, skip_missing=True)
+            stats['norm_emit_z'] = np.array([norm_emit_z(P) for P in particles])
+            self.output['stats'] = stats
+            self.output['other'] = sum_landf([r['output'].get('other') for r in results], ref_charge=ref_charge)
+            self.finished = True
+
+        run_info['run_time'] = time() - t1
+        self.vprint(run_info)
+
+    def _run_segment(self, particles, z):
+        """
+        Runs from particles (or the input distribution if None) to z.
+
+        Returns the particles at z, or None.
+        """
+        if particles is not None:
+            self.initial_particles = particles
+        self.input['output']['zstop'] = z
+
+        # Particle output is needed at z
+        nr = self.input['newrun']
+        nr['zphase'] = max(nr.get('zphase', 1), 1)
+        nr['phases'] = True
+
+        # Phase files of previous segments would be loaded again
+        self.clean_particles()
+
+        self.error = False
+        self.run()
+
+        if self.error or not self.output.get('particles'):
+            return None
+        return self.output['particles'][-1]
+
+    @staticmethod
+    def run_many(astra_objects, max_workers=None, include_particles=False, mp_context=None):
+        """
+        Runs a list of configured Astra objects in parallel, each in its own process and workdir.
+
+        Each object's .output, .log, .error, and .finished are updated with its result.
+        A failure in one run does not stop the others.
+
+        Returns a list of result dicts, in the same order. See: astra.batch.AstraBatch
+
+        """
+        from .batch import AstraBatch
+        B = AstraBatch(astra_objects, max_workers=max_workers,
+                       include_particles=include_particles, mp_context=mp_context)
+        return B.run()
+
+
     @classmethod
     @functools.wraps(astra_from_tao) 
     def from_tao(cls, tao):
@@ -5,6 +5,7 @@ from astra import Astra
 from . import tools
 from .astra import recommended_spacecharge_mesh
 from .evaluate import default_astra_merit
+from .evaluate_cache import evaluate_key, as_evaluate_cache
 
 from distgen import Generator   
 from distgen.writers import write_astra
@@ -161,16 +162,31 @@ def evaluate_astra_with_distgen(settings,
                                 verbose=False,
                                 auto_set_spacecharge_mesh=True,
                                 archive_path=None, 
-                                merit_f=None):
+                                merit_f=None,
+                                cache=None):
     """
     Similar to run_astra_with_distgen, but returns a flat dict of outputs as processed by merit_f. 
     
     If no merit_f is given, a default one will be used. See:
         astra.evaluate.default_astra_merit
     
+    If cache is given (an EvaluateCache or a path), identical evaluations will
+    return the stored outputs without running. See: astra.evaluate_cache
+    
     Will raise an exception if there is an error. 
     
     """
+    cache = as_evaluate_cache(cache)
+    if cache:
+        key = evaluate_key(settings, simulation='astra_with_distgen', merit_f=merit_f,
+                           astra_input_file=astra_input_file,
+                           distgen_input_file=distgen_input_file,
+                           astra_bin=astra_bin,
+                           auto_set_spacecharge_mesh=auto_set_spacecharge_mesh)
+        output = cache.get(key, require_archive=bool(archive_path))
+        if output is not None:
+            return output
+        
     A = run_astra_with_distgen(settings=settings, 
                          astra_input_file=astra_input_file, 
                          distgen_input_file=distgen_input_file, 
@@ -204,6 +220,9 @@ def evaluate_astra_with_distgen(settings,
         # Call the composite archive method
         archive_astra_with_distgen(A, G, archive_file=archive_file)   
         
+    if cache:
+        cache.put(key, output)
+        
     return output
 
 
@@ -0,0 +1,220 @@
+"""
+Caching of Astra auto-phasing results.
+
+With auto_phase on, Astra finds the phase of maximum energy gain of every cavity
+at the start of each run, and phi(i) is relative to it. These phases are parsed
+from the log, and cached per cavity by the settings that change them:
+the cavity itself (except its phi), all cavities upstream of it, the reference
+particle, and the integration settings.
+
+When all cavities of a run have a phase in the cache, the absolute phases are written into
+phi(i), and auto_phase and phase_scan are turned off for the run. A cavity that Astra did not
+phase is a cache miss, so that the run is phased again.
+
+Example:
+    A.auto_phase_cache = AutoPhaseCache('phases.json')
+    for x in values:
+        A['solenoid:maxb(1)'] = x
+        A.run() # Only the first run phases the cavities
+"""
+
+import json
+import os
+import re
+import tempfile
+
+from lume import tools as lumetools
+
+from .evaluate_cache import file_identity, binary_identity
+from .fieldmaps import find_fieldmap_ixlist
+from .segments import particle_fingerprint
+
+# newrun settings that do not change the phasing
+IGNORED_NEWRUN_KEYS = ('run', 'head', 'auto_phase', 'phase_scan', 'distribution',
+                       'zphase', 'phases', 'track_all', 'check_ref_part')
+
+
+class AutoPhaseCache:
+    """
+    Cache of cavity phases, by key. See: cavity_phase_keys
+
+    Parameters
+    ----------
+    path : str, optional
+        JSON file to keep the cache in. It is read if it exists, and written on every put.
+        Default: None (memory only)
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data = {}
+        if path is not None:
+            self.path = lumetools.full_path(path)
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    self._data = json.load(f)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path!r}, n={len(self)})'
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        """
+        Returns the cached phase dict for a key, or None.
+        """
+        return self._data.get(key)
+
+    def put(self, key, value):
+        """
+        Stores a phase dict for a key.
+        """
+        self._data[key] = value
+        if self.path is not None:
+            self.save()
+
+    def save(self):
+        """
+        Writes the cache to .path
+        """
+        dirname = os.path.dirname(self.path)
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._data, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self._data = {}
+        if self.path is not None:
+            self.save()
+
+
+def _normalize(d):
+    """
+    Makes 0 and 0.0 give the same key.
+    """
+    return {k: float(v) if isinstance(v, int) and not isinstance(v, bool) else v for k, v in d.items()}
+
+
+def _cavity_settings(cavity_nl, ix):
+    """
+    Settings of cavity ix, with files replaced by their identity.
+    """
+    pattern = re.compile(rf'^\w+\({ix}\)$')
+    d = {}
+    for key, val in cavity_nl.items():
+        if pattern.match(key):
+            if isinstance(val, str) and os.path.isfile(val):
+                val = file_identity(val)
+            d[key] = val
+    return _normalize(d)
+
+
+def cavity_phase_keys(astra_object):
+    """
+    Keys for the auto-phasing result of each cavity in an Astra object.
+
+    The key of a cavity includes:
+        its settings, except phi
+        all settings of the cavities upstream of it (by c_pos), including phi
+        the non-indexed cavity settings
+        the newrun settings, except for IGNORED_NEWRUN_KEYS
+        the initial particles or distribution file, for the reference particle
+        the Astra binary
+
+    Returns a dict of cavity index: key
+    """
+    astra_input = astra_object.input
+    if 'cavity' not in astra_input:
+        return {}
+    cav = astra_input['cavity']
+
+    ixlist = find_fieldmap_ixlist(astra_input, 'cavity')
+    ixlist = sorted(ixlist, key=lambda ix: cav.get(f'c_pos({ix})', 0))
+
+    common = {}
+    common['cavity'] = _normalize({k: v for k, v in cav.items() if not re.match(r'^\w+\(\d+\)$', k)})
+    common['newrun'] = _normalize({k: v for k, v in astra_input['newrun'].items() if k not in IGNORED_NEWRUN_KEYS})
+    if astra_object.initial_particles:
+        common['initial_particles'] = particle_fingerprint(astra_object.initial_particles)
+    else:
+        dist = astra_input['newrun'].get('distribution', '')
+        common['distribution'] = file_identity(dist) if dist else ''
+    common['command'] = binary_identity(astra_object.command)
+
+    keys = {}
+    upstream = []
+    for ix in ixlist:
+        settings = _cavity_settings(cav, ix)
+        this = {k: v for k, v in settings.items() if k != f'phi({ix})'}
+        keys[ix] = lumetools.fingerprint({'common': common, 'upstream': upstream, 'cavity': this})
+        upstream = upstream + [settings]
+
+    return keys
+
+
+def cached_cavity_phases(cache, keys):
+    """
+    Returns a dict of cavity index: phase dict if all cavities have a phase in the cache, otherwise None.
+    """
+    if not keys:
+        return None
+    phases = {ix: cache.get(key) for ix, key in keys.items()}
+    if any(p is None for p in phases.values()):
+        return None
+    return phases
+
+
+def store_cavity_phases(cache, keys, phases):
+    """
+    Stores the phases parsed from a log (see: parsers.parse_auto_phase_table) in the cache.
+
+    Cavities that were not phased are not stored.
+    """
+    for ix, key in keys.items():
+        if phases.get(ix) is not None:
+            cache.put(key, phases[ix])
+
+
+def apply_cavity_phases(astra_input, phases):
+    """
+    Writes absolute phases into an Astra input dict: phi(i) = phase of maximum energy gain + phi(i),
+    and turns off auto_phase and phase_scan.
+
+    phases must have every cavity: the phi of a cavity without a phase would be used as an absolute phase.
+
+    The input dict is changed in place. Returns a dict of the original values, for restore_input.
+    """
+    cav = astra_input['cavity']
+    nr = astra_input['newrun']
+
+    missing = [ix for ix, p in phases.items() if p is None]
+    if missing:
+        raise ValueError(f'No phase for cavities {missing}')
+
+    saved = {('newrun', k): nr.get(k) for k in ('auto_phase', 'phase_scan')}
+    for ix, p in phases.items():
+        k = f'phi({ix})'
+        saved[('cavity', k)] = cav.get(k)
+        cav[k] = p['phase'] + cav.get(k, 0)
+
+    nr['auto_phase'] = False
+    nr['phase_scan'] = False
+
+    return saved
+
+
+def restore_input(astra_input, saved):
+    """
+    Restores the values from apply_cavity_phases.
+    """
+    for (section, key), val in saved.items():
+        if val is None:
+            astra_input[section].pop(key, None)
+        else:
+            astra_input[section][key] = val
@@ -0,0 +1,257 @@
+"""
+Parallel execution of many Astra runs.
+
+Each run is sent to a worker process, rebuilt there as a fresh Astra object
+with its own workdir, and run. The parsed output is sent back,
+so the parent never has to re-parse any files.
+
+Workdirs are leased from a WorkdirPool in each worker process, and reused
+between the runs of that worker.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import multiprocessing.util
+import os
+import traceback
+
+from .workdir import WorkdirPool
+
+# Workdir pools of this process, by (root, use_shm)
+_WORKDIR_POOLS = {}
+
+
+def worker_workdir_pool(root=None, use_shm=False):
+    """
+    Returns the WorkdirPool of this process for a root directory, creating it if needed.
+    """
+    key = (root, use_shm)
+    if key not in _WORKDIR_POOLS:
+        pool = WorkdirPool(root=root, use_shm=use_shm)
+        # Worker processes skip normal interpreter cleanup, but run these on exit.
+        multiprocessing.util.Finalize(pool, pool.close, exitpriority=10)
+        _WORKDIR_POOLS[key] = pool
+    return _WORKDIR_POOLS[key]
+
+
+def astra_payload(astra_object, settings=None):
+    """
+    Collects everything needed to rebuild and run an Astra object in another process.
+
+    Parameters
+    ----------
+    astra_object : Astra
+        A configured Astra object. It is not modified.
+    settings : dict, optional
+        Settings to apply in the worker before running. See: astra.astra.set_astra
+
+    Returns
+    -------
+    payload : dict
+
+    """
+    return {
+        'cls': type(astra_object),
+        'input': astra_object.input,
+        'group': astra_object.group,
+        'fieldmap': astra_object.fieldmap,
+        'initial_particles': astra_object.initial_particles,
+        'original_input_file': astra_object.original_input_file,
+        'command': astra_object.command,
+        'workdir': astra_object._workdir,
+        'timeout': astra_object.timeout,
+        'settings': settings,
+    }
+
+
+def run_astra_payload(payload, include_particles=False, use_shm=False):
+    """
+    Rebuilds an Astra object from a payload (see: astra_payload), and runs it.
+
+    This is the function called in each worker process. It never raises:
+    any exception is caught and returned in the result.
+
+    Parameters
+    ----------
+    payload : dict
+    include_particles : bool, optional
+        If True, the parsed particles are included in the returned output.
+        Default: False
+    use_shm : bool, optional
+        Lease the workdir from a pool in /dev/shm. Default: False
+
+    Returns
+    -------
+    result : dict with:
+        output : dict
+            The Astra .output dict, with 'stats', 'run_info', and optionally 'particles'
+        error : bool
+        why_error : str
+        log : str or list
+        fingerprint : str
+
+    """
+    from .astra import set_astra
+
+    result = {'output': {'stats': {}, 'particles': [], 'run_info': {}},
+              'error': True, 'why_error': '', 'log': '', 'fingerprint': None}
+    A = None
+    try:
+        pool = worker_workdir_pool(payload['workdir'], use_shm=use_shm)
+        A = payload['cls'](command=payload['command'], workdir_pool=pool)
+        A.original_input_file = payload['original_input_file']
+        A.input_file = os.path.join(A.path, A.original_input_file)
+        A.input = payload['input']
+        A.fieldmap = payload['fieldmap']
+        A.initial_particles = payload['initial_particles']
+        A.timeout = payload['timeout']
+
+        # Re-link groups to this copy of the input
+        A.group = payload['group']
+        for _, cg in A.group.items():
+            cg.link(A.input)
+
+        if payload['settings']:
+            set_astra(A, {}, payload['settings'])
+
+        result['fingerprint'] = A.fingerprint()
+
+        # Parse here, so that particles are only loaded if they are needed
+        A.run_astra(parse_output=False)
+        if not A.error:
+            A.load_output(include_particles=include_particles)
+
+        result['error'] = bool(A.error)
+        result['why_error'] = A.output['run_info'].get('why_error', '')
+
+    except Exception:
+        result['why_error'] = traceback.format_exc()
+
+    if A is not None:
+        if not include_particles:
+            A.output['particles'] = []
+        elif A.output.get('particles'):
+            # Files are not sent, and the workdir is reused
+            A.output['particles'] = list(A.output['particles'])
+        result['output'] = A.output
+        result['log'] = A.log
+        A.release_workdir()
+
+    return result
+
+
+class AstraBatch:
+    """
+    Runs many Astra objects in parallel using a process pool.
+
+    Each run happens in its own process and its own workdir.
+    A failure in one run is recorded in its result, and does not stop the others.
+
+    Example:
+        B = AstraBatch([A1, A2, A3], max_workers=3)
+        for index, result in B.iter_results():
+            print(index, result['error'])
+
+    or, with a template and a list of settings:
+        B = AstraBatch(template=A, settings=[{'phi(1)': x} for x in [0, 10, 20]])
+        results = B.run()
+
+    Parameters
+    ----------
+    astra_objects : list of Astra, optional
+        Configured Astra objects to run. Their .output, .log, .error, and .finished
+        will be updated when their result arrives.
+    template : Astra, optional
+        Template Astra object, used with settings.
+    settings : list of dict, optional
+        Settings to apply to the template, one run per dict.
+    max_workers : int, optional
+        Number of worker processes. Default: os.cpu_count()
+    include_particles : bool, optional
+        If True, particles will be sent back from the workers. Default: False
+    mp_context : str, optional
+        multiprocessing start method: 'fork', 'spawn', or 'forkserver'. Default: platform default.
+    use_shm : bool, optional
+        Put the workdirs in /dev/shm (tmpfs). Default: False
+
+    """
+
+    def __init__(self,
+                 astra_objects=None,
+                 *,
+                 template=None,
+                 settings=None,
+                 max_workers=None,
+                 include_particles=False,
+                 mp_context=None,
+                 use_shm=False):
+
+        if astra_objects is not None:
+            assert template is None and settings is None, 'Use either astra_objects, or template with settings'
+            self.astra_objects = list(astra_objects)
+            self.payloads = [astra_payload(A) for A in self.astra_objects]
+        else:
+            assert template is not None and settings is not None, 'template and settings must be given together'
+            self.astra_objects = None
+            self.payloads = [astra_payload(template, settings=s) for s in settings]
+
+        self.max_workers = max_workers
+        self.include_particles = include_particles
+        self.mp_context = mp_context
+        self.use_shm = use_shm
+
+        self.results = [None] * len(self.payloads)
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def _executor(self):
+        if self.mp_context:
+            ctx = multiprocessing.get_context(self.mp_context)
+        else:
+            ctx = None
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+
+    def iter_results(self):
+        """
+        Runs all payloads, yielding (index, result) tuples as they finish.
+
+        See: run_astra_payload for the result dict.
+        """
+        with self._executor() as executor:
+            futures = {executor.submit(run_astra_payload, payload, self.include_particles, self.use_shm): i
+                       for i, payload in enumerate(self.payloads)}
+
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except Exception:
+                    # Problems with the process itself, or pickling
+                    result = {'output': {'stats': {}, 'particles': [], 'run_info': {}},
+                              'error': True, 'why_error': traceback.format_exc(),
+                              'log': '', 'fingerprint': None}
+
+                self.results[i] = result
+                if self.astra_objects is not None:
+                    self._update(self.astra_objects[i], result)
+
+                yield i, result
+
+    def run(self):
+        """
+        Runs all payloads, and returns a list of results in the original order.
+        """
+        for _ in self.iter_results():
+            pass
+        return self.results
+
+    @staticmethod
+    def _update(astra_object, result):
+        """
+        Fills an Astra object with a result from a worker.
+        """
+        astra_object.output = result['output']
+        astra_object.log = result['log']
+        astra_object.error = result['error']
+        astra_object.finished = not result['error']
@@ -1,12 +1,15 @@
 from astra.astra import run_astra, run_astra_with_generator, run_astra_with_generator
 from astra.generator import AstraGenerator
 from astra.astra_calc import calc_ho_energy_spread
+from astra.evaluate_cache import evaluate_key, as_evaluate_cache
 from lume.tools import full_path
 from lume import tools as lumetools
 import numpy as np
 import json
 from inspect import getfullargspec
+from concurrent.futures import ProcessPoolExecutor
 import os
+import traceback
 from h5py import File
 
 
@@ -91,7 +94,7 @@ def _get_defaults(run_f, extra=None):
 
 
 
-def evaluate(settings, simulation='astra', archive_path=None, merit_f=None, **params):
+def evaluate(settings, simulation='astra', archive_path=None, merit_f=None, cache=None, **params):
     """
     Evaluate astra using possible simulations:
         'astra'
@@ -103,10 +106,20 @@ def evaluate(settings, simulation='astra', archive_path=None, merit_f=None, **pa
     If merit_f is provided, this function will be used to form the outputs. 
     Otherwise a default funciton will be applied.
     
+    If cache is given (an EvaluateCache or a path), identical evaluations will
+    return the stored outputs without running. See: astra.evaluate_cache
+    
     Will raise an exception if there is an error. 
     
     """
     
+    cache = as_evaluate_cache(cache)
+    if cache:
+        key = evaluate_key(settings, simulation=simulation, merit_f=merit_f, **params)
+        output = cache.get(key, require_archive=bool(archive_path))
+        if output is not None:
+            return output
+    
     # Pick simulation to run
     
     if simulation=='astra':
@@ -143,14 +156,65 @@ def evaluate(settings, simulation='astra', archive_path=None, merit_f=None, **pa
         A.archive(archive_file)
         output['archive'] = archive_file
         
+    if cache:
+        cache.put(key, output)
+        
     return output
 
 
+def _evaluate_or_error(settings, **kwargs):
+    """
+    Calls evaluate, returning {'error': True, 'why_error': ...} instead of raising.
+    """
+    try:
+        return evaluate(settings, **kwargs)
+    except Exception:
+        return {'error': True, 'why_error': traceback.format_exc()}
+
+
+def evaluate_many(settings_list, simulation='astra', archive_path=None, merit_f=None, cache=None,
+                  max_workers=None, **params):
+    """
+    Evaluates a list of settings in parallel with a process pool. See: evaluate
+    
+    Duplicate settings are collapsed to a single evaluation. 
+    
+    Returns a list of outputs in the same order as settings_list.
+    Failed evaluations return {'error': True, 'why_error': ...} instead of raising.
+    
+    With max_workers=1, everything is run in this process. 
+    merit_f must be importable (not a lambda) for parallel evaluation.
+    
+    """
+    kwargs = dict(simulation=simulation, archive_path=archive_path, merit_f=merit_f, cache=cache, **params)
+    
+    # Collapse duplicates
+    keys = [evaluate_key(s, simulation=simulation, merit_f=merit_f, **params) for s in settings_list]
+    unique = {}
+    for key, s in zip(keys, settings_list):
+        if key not in unique:
+            unique[key] = s
+    
+    if max_workers == 1:
+        results = {key: _evaluate_or_error(s, **kwargs) for key, s in unique.items()}
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {key: executor.submit(_evaluate_or_error, s, **kwargs) for key, s in unique.items()}
+            results = {}
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception:
+                    results[key] = {'error': True, 'why_error': traceback.format_exc()}
+    
+    return [dict(results[key]) for key in keys]
+
+
 # Convenience wrappers, and their full options
 
 # Get all kwargs from run_astra routines. Save these as the complete set of options
-EXTRA = {'archive_path':None, 'merit_f':None}
-EXTRA2 = {'archive_path':None, 'merit_f':None, 'distgen_input_file':None}
+EXTRA = {'archive_path':None, 'merit_f':None, 'cache':None}
+EXTRA2 = {'archive_path':None, 'merit_f':None, 'cache':None, 'distgen_input_file':None}
 DEFAULTS = {
     'evaluate_astra':                _get_defaults(run_astra, EXTRA ),
     'evaluate_astra_with_generator': _get_defaults(run_astra_with_generator, EXTRA) ,
@@ -158,12 +222,12 @@ DEFAULTS = {
 }
 
 
-def evaluate_astra(settings, archive_path=None, merit_f=None, **params):
+def evaluate_astra(settings, archive_path=None, merit_f=None, cache=None, **params):
     """
     Convenience wrapper. See evaluate. 
     """
     return evaluate(settings, simulation='astra', 
-                    archive_path=archive_path, merit_f=merit_f, **params)
+                    archive_path=archive_path, merit_f=merit_f, cache=cache, **params)
 
 
 def old_evaluate_astra_with_generator(settings, archive_path=None, merit_f=None, **params):
@@ -184,16 +248,32 @@ def evaluate_astra_with_generator(settings,
                                   verbose=False,
                                   auto_set_spacecharge_mesh=True,
                                   archive_path=None,
-                                  merit_f=None):
+                                  merit_f=None,
+                                  cache=None):
     """
     Similar to run_astra_with_generator, but returns a flat dict of outputs as processed by merit_f. 
     
     If no merit_f is given, a default one will be used. See:
         astra.evaluate.default_astra_merit
     
+    If cache is given (an EvaluateCache or a path), identical evaluations will
+    return the stored outputs without running. See: astra.evaluate_cache
+    
     Will raise an exception if there is an error. 
     """
 
+    cache = as_evaluate_cache(cache)
+    if cache:
+        key = evaluate_key(settings, simulation='astra_with_generator', merit_f=merit_f,
+                           astra_input_file=astra_input_file,
+                           generator_input_file=generator_input_file,
+                           astra_bin=astra_bin,
+                           generator_bin=generator_bin,
+                           auto_set_spacecharge_mesh=auto_set_spacecharge_mesh)
+        output = cache.get(key, require_archive=bool(archive_path))
+        if output is not None:
+            return output
+
     A = run_astra_with_generator(settings=settings,
                                     astra_input_file=astra_input_file,
                                     generator_input_file=generator_input_file,
@@ -229,7 +309,8 @@ def evaluate_astra_with_generator(settings,
         # Call the composite archive method
         archive_astra_with_generator(A, G, archive_file=archive_file)   
         
-        
+    if cache:
+        cache.put(key, output)
         
     return output
 
@@ -0,0 +1,292 @@
+"""
+On-disk cache for evaluate results.
+
+Entries are keyed before running, by:
+    the settings and run parameters, including the defaults of the run function,
+    the identity (path, size, mtime) of the input files and the files they reference,
+    the identity of the binaries, after resolving environmental variables and symlinks,
+    the merit function name and code.
+
+Least recently used entries are evicted when the cache grows beyond max_bytes.
+"""
+
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import types
+
+from lume import tools as lumetools
+
+from . import parsers
+from .tools import mkdir_p
+
+# Run parameters that do not change the result
+IGNORED_PARAMS = ('workdir', 'verbose', 'timeout')
+
+# Run parameters that are input files, or binaries
+FILE_PARAMS = ('astra_input_file', 'generator_input_file', 'distgen_input_file')
+BINARY_PARAMS = ('command', 'command_generator', 'astra_bin', 'generator_bin')
+
+# Simulation: (module, run function), whose defaults are part of the key
+RUN_FUNCTIONS = {
+    'astra': ('astra.astra', 'run_astra'),
+    'astra_with_generator': ('astra.astra', 'run_astra_with_generator'),
+    'astra_with_distgen': ('astra.astra_distgen', 'run_astra_with_distgen'),
+}
+
+
+def file_identity(path):
+    """
+    Identity of a file: (absolute path, size, mtime in ns).
+
+    If the file does not exist, the expanded path is returned alone.
+    """
+    f = lumetools.full_path(path)
+    if not os.path.exists(f):
+        return [f]
+    st = os.stat(f)
+    return [f, st.st_size, st.st_mtime_ns]
+
+
+def binary_identity(command):
+    """
+    Identity of a binary, as file_identity of the file that actually runs:
+    environmental variables and symlinks are resolved.
+    """
+    return file_identity(os.path.realpath(lumetools.full_path(command)))
+
+
+def run_defaults(simulation):
+    """
+    Default parameters of the run function of a simulation.
+    """
+    if simulation not in RUN_FUNCTIONS:
+        return {}
+    module, name = RUN_FUNCTIONS[simulation]
+    # Imported here, because these modules import this one
+    run_f = getattr(__import__(module, fromlist=[name]), name)
+    return {k: p.default for k, p in inspect.signature(run_f).parameters.items()
+            if p.default is not inspect.Parameter.empty and k != 'settings'}
+
+
+def astra_input_file_identities(astra_input_file):
+    """
+    Identities of an Astra input file, and of all existing files referenced inside it.
+    """
+    ids = [file_identity(astra_input_file)]
+
+    f = lumetools.full_path(astra_input_file)
+    if not os.path.exists(f) or f.endswith('.yaml'):
+        return ids
+
+    astra_input = parsers.parse_astra_input_file(f)
+    parsers.fix_input_paths(astra_input, root=os.path.dirname(f))
+    for nl in astra_input.values():
+        for key, val in nl.items():
+            if key.startswith(('file_', 'distribution', 'q_type')) and isinstance(val, str):
+                if os.path.exists(val):
+                    ids.append(file_identity(val))
+    return ids
+
+
+def merit_name(merit_f=None):
+    """
+    Full name of a merit function, with a hash of its code. None is the default merit function.
+
+    The code hash covers the bytecode, constants, names, defaults, and closure values,
+    so lambdas, or a function edited under the same name, have different names.
+    """
+    if merit_f is None:
+        return 'astra.evaluate.default_astra_merit'
+    module = getattr(merit_f, '__module__', None) or type(merit_f).__module__
+    name = getattr(merit_f, '__qualname__', None) or type(merit_f).__qualname__
+    code = getattr(merit_f, '__code__', None)
+    if code is None:
+        return f'{module}.{name}'
+    h = hashlib.blake2b(digest_size=8)
+    _hash_code(h, code)
+    h.update(repr(merit_f.__defaults__).encode())
+    for cell in merit_f.__closure__ or ():
+        h.update(repr(cell.cell_contents).encode())
+    return f'{module}.{name}:{h.hexdigest()}'
+
+
+def _hash_code(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(h, const)
+        else:
+            h.update(repr(const).encode())
+
+
+def evaluate_key(settings, simulation='astra', merit_f=None, **params):
+    """
+    Key for an evaluate call, computed before running.
+
+    Identical settings and parameters, with unchanged input files and binaries,
+    give the same key. Parameters that are not given take the defaults of the run function
+    of the simulation. See: RUN_FUNCTIONS
+    """
+    d = {}
+    d['settings'] = settings
+    d['simulation'] = simulation
+    d['merit_f'] = merit_name(merit_f)
+    params = {**run_defaults(simulation), **params}
+    for k, v in sorted(params.items()):
+        if k in IGNORED_PARAMS:
+            continue
+        if v and k == 'astra_input_file':
+            d[k] = astra_input_file_identities(v)
+        elif v and k in FILE_PARAMS:
+            d[k] = file_identity(v)
+        elif v and k in BINARY_PARAMS:
+            d[k] = binary_identity(v)
+        else:
+            d[k] = v
+
+    return lumetools.fingerprint(d)
+
+
+class EvaluateCache:
+    """
+    On-disk LRU cache of evaluate outputs.
+
+    Each entry is a pickle file named by its key, holding the output dict.
+    Archives written inside the cache path (archive_path=cache.path) count toward max_bytes,
+    and are removed with their entry.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory. Will be created if it does not exist.
+    max_bytes : int, optional
+        Disk size cap. Default: 1 GB
+
+    """
+
+    def __init__(self, path, max_bytes=1_000_000_000):
+        self.path = lumetools.full_path(path)
+        self.max_bytes = max_bytes
+        mkdir_p(self.path)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path!r}, max_bytes={self.max_bytes})'
+
+    def _entry_file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key, require_archive=False):
+        """
+        Returns the cached output dict for a key, or None.
+
+        If require_archive, entries without an existing archive file are a miss.
+        """
+        f = self._entry_file(key)
+        try:
+            with open(f, 'rb') as fh:
+                output = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if require_archive and not os.path.exists(output.get('archive', '')):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(f)
+        except OSError:
+            pass
+
+        return output
+
+    def put(self, key, output):
+        """
+        Stores an output dict for a key, then evicts old entries if needed.
+        """
+        # Write atomically, so that parallel evaluations never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(output, fh)
+        os.replace(tmp, self._entry_file(key))
+
+        # Only archives inside the cache are managed
+        archive = output.get('archive')
+        if archive and os.path.dirname(os.path.abspath(archive)) == self.path:
+            with open(self._archive_record(key), 'w') as fh:
+                fh.write(os.path.abspath(archive))
+
+        self.evict()
+
+    def _archive_record(self, key):
+        return os.path.join(self.path, key + '.archive')
+
+    def _entries(self):
+        """
+        List of (mtime, size, files) for all entries.
+        """
+        entries = []
+        for item in os.scandir(self.path):
+            if not item.name.endswith('.pkl'):
+                continue
+            key = item.name[:-len('.pkl')]
+            files = [item.path]
+            try:
+                st = item.stat()
+                size = st.st_size
+                record = self._archive_record(key)
+                if os.path.exists(record):
+                    files.append(record)
+                    with open(record) as fh:
+                        archive = fh.read()
+                    if os.path.exists(archive):
+                        files.append(archive)
+                        size += os.path.getsize(archive)
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, size, files))
+        return entries
+
+    @property
+    def size(self):
+        """Total size of the cache in bytes"""
+        return sum(e[1] for e in self._entries())
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache size is under max_bytes.
+        """
+        entries = sorted(self._entries())
+        total = sum(e[1] for e in entries)
+        for _, size, files in entries:
+            if total <= self.max_bytes:
+                break
+            _remove_files(files)
+            total -= size
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        for _, _, files in self._entries():
+            _remove_files(files)
+
+
+def _remove_files(files):
+    for f in files:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+
+
+def as_evaluate_cache(cache):
+    """
+    Returns an EvaluateCache from a cache object or path.
+    """
+    if cache is None or isinstance(cache, EvaluateCache):
+        return cache
+    return EvaluateCache(cache)
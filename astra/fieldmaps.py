@@ -2,9 +2,15 @@
 Tools for loading fieldmap data
 """
 import numpy as np
+from collections import OrderedDict
+import hashlib
 import re
 import os
 import glob
+import threading
+import weakref
+
+from .parse_cache import cached_parse
 
 # Prefix helpers
 
@@ -44,9 +50,196 @@ def find_fieldmap_ixlist(astra_input, section='cavity'):
             ixlist.append(ix)
     return ixlist
 
-def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['cavity', 'solenoid'], verbose=False, strip_path=False):
+# Default memory budget of the process-wide fieldmap cache
+DEFAULT_FIELDMAP_CACHE_BYTES = 1_000_000_000
+
+
+class FieldmapCache:
+    """
+    Process-wide LRU cache of parsed fieldmap files, by absolute path, size, and mtime.
+
+    Cached arrays are read-only and shared by everyone who loads the same file.
+    Each get returns a new dict with a copy of the attrs.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget of the cached arrays. The most recently used map is always kept.
+        Default: DEFAULT_FIELDMAP_CACHE_BYTES
+
+    """
+
+    def __init__(self, max_bytes=DEFAULT_FIELDMAP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # (path, size, mtime_ns): fmap
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} with {len(self)} fieldmaps, {self._nbytes} bytes>'
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self):
+        """Memory used by the cached arrays"""
+        return self._nbytes
+
+    def get(self, filePath, parser=None):
+        """
+        Returns the parsed fieldmap dict of a file, parsing it if needed.
+
+        parser defaults to read_fieldmap, which uses the binary parse cache when it is on.
+        """
+        f = os.path.abspath(filePath)
+        st = os.stat(f)
+        key = (f, st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            fmap = self._data.get(key)
+            if fmap is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+
+        if fmap is None:
+            fmap = (parser or read_fieldmap)(f)
+            for k, v in fmap.items():
+                if isinstance(v, np.ndarray):
+                    v.setflags(write=False)
+            with self._lock:
+                self.misses += 1
+                # Older versions of the same file
+                for old in [k for k in self._data if k[0] == f and k != key]:
+                    self._nbytes -= _fieldmap_nbytes(self._data.pop(old))
+                if key not in self._data:
+                    self._data[key] = fmap
+                    self._nbytes += _fieldmap_nbytes(fmap)
+                self._evict()
+
+        fmap = dict(fmap)
+        fmap['attrs'] = dict(fmap['attrs'])
+        return fmap
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and len(self._data) > 1:
+            _, fmap = self._data.popitem(last=False)
+            self._nbytes -= _fieldmap_nbytes(fmap)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._nbytes = 0
+
+    def _after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+
+
+def _fieldmap_nbytes(fmap):
+    return sum(v.nbytes for v in fmap.values() if isinstance(v, np.ndarray))
+
+
+FIELDMAP_CACHE = FieldmapCache()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=FIELDMAP_CACHE._after_fork)
+
+
+def read_fieldmap(filePath):
+    """
+    Parses a fieldmap file, or memory maps its binary copy.
+
+    When the parse cache is on (see: parse_cache.enable_parse_cache), the first parse
+    stores the data as .npy and the attrs as JSON, and later reads of the unchanged
+    file memory map these.
+
+    Returns a dict of:
+        attrs
+        data
+    """
+    return cached_parse(filePath, parse_fieldmap, tag='fieldmap')
+
+
+def load_fieldmap(filePath):
+    """
+    Loads a fieldmap file through the process-wide cache. See: FieldmapCache
+
+    The data array is read-only.
+
+    Returns a dict of:
+        attrs
+        data
+    """
+    return FIELDMAP_CACHE.get(filePath)
+
+
+def read_fieldmap3d(filePath):
+    """
+    Parses one 3D fieldmap component file, or memory maps its binary copy.
+
+    As for read_fieldmap, the binary copy is only made when the parse cache is on.
+    Its root directory (enable_parse_cache(path)) keeps the copies of large maps
+    out of the fieldmap directories. See: astra.parse_cache
+
+    Returns a dict of:
+        attrs
+        data
+        x, y, z
+    See: parse_fieldmap3d
+    """
+    return cached_parse(filePath, parse_fieldmap3d, tag='fieldmap3d')
+
+
+def load_fieldmap3d(base_filename):
+    """
+    Loads the component files of a 3D fieldmap through the process-wide cache.
+
+    Returns a dict of component file: fieldmap dict, with read-only arrays.
+    These are memory mapped when the parse cache is on. See: read_fieldmap3d
+    The component file is base_filename with the extension of the file found, e.g. '3D_map.ez'.
+
+    Each fieldmap dict also has 'source': (path, size, mtime_ns) of its file,
+    so that write_fieldmaps can link to it instead of writing the data. See: fieldmap_source
+    """
+    d = {}
+    for f in sorted(fieldmap3d_filenames(base_filename)):
+        ext = os.path.splitext(f)[1]
+        f = os.path.abspath(f)
+        st = os.stat(f)
+        fmap = FIELDMAP_CACHE.get(f, parser=read_fieldmap3d)
+        fmap['source'] = (f, st.st_size, st.st_mtime_ns)
+        d[base_filename + ext] = fmap
+    return d
+
+
+def fieldmap_source(fmap):
+    """
+    Path of the file a fieldmap dict was loaded from, if the file has not changed since, or None.
+    """
+    if 'source' not in fmap:
+        return None
+    path, size, mtime_ns = fmap['source']
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+        return None
+    return path
+
+
+def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['cavity', 'solenoid'], verbose=False, strip_path=False,
+                   include_3d=False):
     """
     Loads all found fieldmaps into a dict with the filenames as keys
+
+    3D fieldmaps are skipped, and symlinked when writing input, unless include_3d.
+    Then each of their component files is loaded, keyed by the base filename and the
+    extension, e.g. '3D_map.ez', and write_fieldmaps symlinks to the files while they
+    are unchanged. See: load_fieldmap3d
     """
     fmap = {}
     for sec in sections:
@@ -60,7 +253,8 @@ def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['ca
             file = astra_input[sec][k]
 
             # Skip 3D fieldmaps. These are symlinked
-            if os.path.split(file)[1].lower().startswith('3d_'):
+            is_3d = os.path.split(file)[1].lower().startswith('3d_')
+            if is_3d and not include_3d:
                 continue
             
             if file not in fmap:
@@ -75,14 +269,15 @@ def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['ca
                     print(f'Loading fieldmap file {file}')                    
                 
                 # Look in search path
-                if not os.path.exists(file):
+                exists = fieldmap3d_filenames(file) if is_3d else os.path.exists(file)
+                if not exists:
                     if verbose:
                         print(f'{file} not found, searching:')
                     for path in search_paths:
                         _, file = os.path.split(file)
                         tryfile = os.path.join(path, file)
                                          
-                        if os.path.exists(tryfile):
+                        if (fieldmap3d_filenames(tryfile) if is_3d else os.path.exists(tryfile)):
                             if verbose:
                                 print('Found:', tryfile)
                             file = tryfile
@@ -92,7 +287,10 @@ def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['ca
                     # Set input
                     astra_input[sec][k] = file
                     
-                fmap[file] = parse_fieldmap(file)
+                if is_3d:
+                    fmap.update(load_fieldmap3d(file))
+                else:
+                    fmap[file] = load_fieldmap(file)
            
     # Loop again
     if strip_path:
@@ -111,11 +309,17 @@ def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['ca
             fmap2[k2] = fmap[k] 
 
         for sec in sections:
+            if sec not in astra_input:
+                continue
             ixlist = find_fieldmap_ixlist(astra_input, sec) 
             for ix in ixlist:
                 k = file_(section=sec, index=ix)
                 file = astra_input[sec][k]
-                astra_input[sec][k] = translate[file]
+                if file in translate:
+                    astra_input[sec][k] = translate[file]
+                elif include_3d and os.path.split(file)[1].lower().startswith('3d_'):
+                    # Components are keyed by extension
+                    astra_input[sec][k] = os.path.split(file)[1]
 
         return fmap2
                 
@@ -123,21 +327,46 @@ def load_fieldmaps(astra_input, search_paths=[], fieldmap_dict={}, sections=['ca
         return fmap
    
 
+def fieldmap_fingerprint(fmap):
+    """
+    Fingerprint of the attrs and data of a fieldmap dict.
+
+    The fingerprints of read-only arrays, as from FieldmapCache, are remembered,
+    so large maps are only hashed once.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(sorted(fmap['attrs'].items())).encode())
+    for k in sorted(fmap):
+        if k not in ('attrs', 'source'):
+            h.update(k.encode())
+            h.update(_data_fingerprint(np.asanyarray(fmap[k])).encode())
+    return h.hexdigest()
+
+
 def write_fieldmaps(fieldmap_dict, path):
     """
     Writes fieldmap dict to path
-    
+
+    Fieldmaps loaded from files that have not changed (3D maps, see: load_fieldmap3d)
+    are symlinked to these files instead of written.
     """
     assert os.path.exists(path)
     
     for k, fmap in fieldmap_dict.items():
         file = os.path.join(path, k)
-        
-        # Remove any previous symlinks
-        if os.path.islink(file):
+        src = fieldmap_source(fmap)
+
+        if src and os.path.exists(file) and os.path.samefile(src, file):
+            continue
+
+        # Remove any previous symlinks, or files to be replaced by one
+        if os.path.islink(file) or (src and os.path.exists(file)):
             os.unlink(file)        
-        
-        write_fieldmap(file, fmap)
+
+        if src:
+            os.symlink(src, file)
+        else:
+            write_fieldmap(file, fmap)
 
 def write_fieldmap(fname, fmap):
     
@@ -148,6 +377,9 @@ def write_fieldmap(fname, fmap):
         np.savetxt(fname, fmap['data'], header=header, comments='')
     elif ftype == 'astra_1d':
         np.savetxt(fname, fmap['data'])
+    elif ftype == 'astra_3d':
+        header = '\n'.join(f"{len(fmap[k])} " + ' '.join(map(repr, map(float, fmap[k]))) for k in ('x', 'y', 'z'))
+        np.savetxt(fname, fmap['data'].reshape(-1, len(fmap['x'])), header=header, comments='')
     else:
         raise ValueError(f'Unknown fieldmap type: {ftype}')        
         
@@ -166,7 +398,8 @@ def parse_fieldmap(filePath):
     
     """
     
-    header = list(map(float, open(filePath).readline().split()))
+    with open(filePath) as f:
+        header = list(map(float, f.readline().split()))
     
     attrs = {}
     
@@ -186,14 +419,80 @@ def parse_fieldmap(filePath):
 
 
 
+def parse_fieldmap3d(filePath):
+    """
+    Parses one component file of a 3D fieldmap: .ex, .ey, .ez, .bx, .by, or .bz
+
+    The first three lines are the number of grid points and the grid coordinates in x, y, and z.
+    The field values follow, with x running fastest, then y, then z.
+
+    Returns a dict of:
+        attrs
+        data : array indexed as [iz, iy, ix]
+        x, y, z : grid coordinates
+
+    See: write_fieldmap
+    """
+    with open(filePath) as f:
+        grid = {}
+        for k in ('x', 'y', 'z'):
+            line = np.array(f.readline().split(), dtype=float)
+            n = int(line[0])
+            grid[k] = line[1:]
+            if len(grid[k]) != n:
+                raise ValueError(f'Expected {n} {k} coordinates in 3D fieldmap {filePath}, found {len(grid[k])}')
+        values = np.fromstring(f.read(), sep=' ')
+
+    shape = (len(grid['z']), len(grid['y']), len(grid['x']))
+    if values.size != np.prod(shape):
+        raise ValueError(f'Expected {np.prod(shape)} field values in 3D fieldmap {filePath}, found {values.size}')
+
+    attrs = {'type': 'astra_3d', 'component': os.path.splitext(filePath)[1][1:].lower()}
+    return dict(attrs=attrs, data=values.reshape(shape), **grid)
+
+
+# Number of fieldmap_data results kept
+FIELDMAP_DATA_CACHE_SIZE = 256
+_fieldmap_data_cache = OrderedDict()
+_fieldmap_data_lock = threading.Lock()
+
+# id(read-only data array): (weakref to the array, shape, fingerprint)
+_data_fingerprints = {}
+
+
+def _data_fingerprint(data):
+    """
+    Fingerprint of the shape, dtype, and values of an array.
+
+    Remembered for read-only arrays, which cannot change. Fieldmaps are read-only when loaded
+    from files or archives. Writable arrays are hashed on every call.
+    """
+    if not data.flags.writeable:
+        entry = _data_fingerprints.get(id(data))
+        if entry is not None and entry[0]() is data and entry[1] == data.shape:
+            return entry[2]
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((data.shape, data.dtype.str)).encode())
+    h.update(np.ascontiguousarray(data).tobytes())
+    fp = h.hexdigest()
+    if not data.flags.writeable:
+        i = id(data)
+        _data_fingerprints[i] = (weakref.ref(data, lambda _, i=i: _data_fingerprints.pop(i, None)), data.shape, fp)
+    return fp
+
+
 def fieldmap_data(astra_input, section='cavity', index=1, fieldmaps={}, verbose=False):
     """
     Loads the fieldmap in absolute coordinates.
     
     If a fieldmaps dict is given, thes will be used instead of loading the file.
     
-    Returns tuple:
-        attrs, data
+    Results are memoized by the fieldmap contents, c_numb, position, and scaling,
+    so the array returned is read-only, and shared between calls.
+    
+    Returns
+    -------
+    data : array of shape (n, 2) with columns z, field
     
     """
     
@@ -219,37 +518,45 @@ def fieldmap_data(astra_input, section='cavity', index=1, fieldmaps={}, verbose=
     else:
         scale = 1
     
-    
     if file in fieldmaps:
-        fmap = fieldmaps[file].copy()
+        fmap = fieldmaps[file]
     else:
-        print(f'loading from file {file}')
-        fmap = parse_fieldmap(file)
-            
-    dat = fmap['data'].copy()    
+        if verbose:
+            print(f'loading from file {file}')
+        fmap = load_fieldmap(file)
     
     # TWS special case 
     # From the manual: 
     # field map can be n times periodically repeated by specifying C_numb( ) = n.
+    n_cell = 1
     if section == 'cavity':
-        # Look for this key
-        k2 = f'c_numb({index})'
-        if k2 in astra_input[section]:
-            n_cell = astra_input[section][k2]
-            
-            if n_cell > 1:
-                zfull, Ezfull = expand_tws_fmap(fmap, n_cell)
-                dat = np.array([zfull, Ezfull]).T
-
+        n_cell = astra_input[section].get(f'c_numb({index})', 1)
+    
+    key = (_data_fingerprint(fmap['data']), repr(sorted(fmap['attrs'].items())), n_cell, offset, scale)
+    with _fieldmap_data_lock:
+        dat = _fieldmap_data_cache.get(key)
+        if dat is not None:
+            _fieldmap_data_cache.move_to_end(key)
+            return dat
+    
+    if n_cell > 1:
+        zfull, Ezfull = expand_tws_fmap(fmap, n_cell)
+        dat = np.array([zfull, Ezfull]).T
+    else:
+        dat = np.array(fmap['data'], dtype=float)
     
     dat[:,0] += offset
-    dat[:,1] *= scale/max(abs(dat[:,1]))
+    dat[:,1] *= scale/np.abs(dat[:,1]).max()
+    dat.setflags(write=False)
+    
+    with _fieldmap_data_lock:
+        _fieldmap_data_cache[key] = dat
+        while len(_fieldmap_data_cache) > FIELDMAP_DATA_CACHE_SIZE:
+            _fieldmap_data_cache.popitem(last=False)
     
     return dat
 
 
-
-
 def expand_tws_fmap(fmap, n_cell):
     """
     Expands periodic TWS fieldmap data over a number of repeating cells:
@@ -294,13 +601,10 @@ def expand_tws_fmap(fmap, n_cell):
     Ezexit = np.interp(zexit, z0, Ez0)    
     
     # Collect data, not overlapping points
-    ztot =  [zentrance[:-1]]
-    Eztot = [Ezentrance[:-1]]
-    for i in range(n_repeat):
-        ztot.append(zcell[:-1] + i*Lcell)
-        Eztot.append(Ezcell[:-1])
-    ztot.append(zexit + (n_repeat-1)*Lcell)
-    Eztot.append(Ezexit)
+    zcells = (zcell[:-1] + Lcell*np.arange(n_repeat)[:, None]).ravel()
+    Ezcells = np.tile(Ezcell[:-1], n_repeat)
+    ztot = [zentrance[:-1], zcells, zexit + (n_repeat-1)*Lcell]
+    Eztot = [Ezentrance[:-1], Ezcells, Ezexit]
     
     return np.concatenate(ztot), np.concatenate(Eztot)
 
@@ -322,7 +626,7 @@ def fieldmap3d_filenames(base_filename):
     
     files = []
     for file in flist:
-        for ext in ['.ex', '.ey', '.ez', '.bx', '.by', 'bz']:
+        for ext in ['.ex', '.ey', '.ez', '.bx', '.by', '.bz']:
             if file.lower().endswith(ext):
                 files.append(os.path.abspath(file))
     return files
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os
 import traceback
 
@@ -81,17 +82,7 @@ class AstraGenerator(CommandWrapper):
 
         try:
             res = tools.execute2(runscript, timeout=None, cwd=self.path)
-            self.log = res['log']
-
-            self.vprint(self.log)
-
-            # This is the file that should be written
-            if os.path.exists(self.output_file):
-                self.finished = True
-            else:
-                print(f'AstraGenerator.output_file {self.output_file} does not exist.')
-                print(f'Here is what the current working dir looks like: {os.listdir(self.path)}')
-            self.load_output()
+            self._finish_run(res)
 
         except Exception as ex:
             print('AstraGenerator.run exception:', traceback.format_exc())
@@ -99,6 +90,42 @@ class AstraGenerator(CommandWrapper):
         finally:
             pass
 
+    async def run_async(self, executor=None):
+        """
+        Runs Generator as an asyncio coroutine.
+
+        The process is run with tools.execute_async, and the output
+        is parsed in an executor. Cancelling the task kills the process.
+        """
+        self.write_input_file()
+
+        runscript = self.get_run_script()
+
+        try:
+            res = await tools.execute_async(runscript, timeout=None, cwd=self.path)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, self._finish_run, res)
+
+        except Exception as ex:
+            print('AstraGenerator.run_async exception:', traceback.format_exc())
+            self.error = True
+
+    def _finish_run(self, res):
+        """
+        Checks for the output file, and loads it.
+        """
+        self.log = res['log']
+
+        self.vprint(self.log)
+
+        # This is the file that should be written
+        if os.path.exists(self.output_file):
+            self.finished = True
+        else:
+            print(f'AstraGenerator.output_file {self.output_file} does not exist.')
+            print(f'Here is what the current working dir looks like: {os.listdir(self.path)}')
+        self.load_output()
+
     @property
     def output_file(self):
         return os.path.join(self.path, self.input['fname'])
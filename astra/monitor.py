@@ -0,0 +1,387 @@
+"""
+Monitoring of running Astra simulations.
+
+Astra appends a line to its stats files (.Xemit.001, .Zemit.001, ...) at every
+zemit step, so these can be followed while the run is in progress.
+"""
+
+import operator
+import os
+import re
+from time import time
+
+import numpy as np
+from pmd_beamphysics.units import SHORT_PREFIX_FACTOR
+
+from . import parsers
+
+OUTPUT_TYPES = ['Cemit', 'Xemit', 'Yemit', 'Zemit', 'LandF']
+
+# Short names for LandF columns, for abort conditions
+STAT_ALIASES = {
+    'n_particles': 'landf_n_particles',
+    'n_lost': 'landf_n_lost',
+    'total_charge': 'landf_total_charge',
+}
+
+COMPARISONS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+ABORT_CONDITION_RE = re.compile(r'^\s*(\w+)\s*(>=|<=|>|<)\s*([-+0-9.eE]+)\s*(%|[^\s]*)\s*$')
+
+
+class OutputFileTail:
+    """
+    Follows a growing Astra output file, reading only complete new lines.
+
+    Parameters
+    ----------
+    filePath : str
+        Output file, like 'astra.Zemit.001'. It does not need to exist yet.
+
+    """
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.type = parsers.astra_output_type(filePath)
+        self.rows = []
+        self._offset = 0
+        self._partial = b''
+
+    def update(self):
+        """
+        Reads any new complete lines. Returns the number of new rows.
+        """
+        try:
+            with open(self.filePath, 'rb') as f:
+                f.seek(self._offset)
+                new = f.read()
+        except FileNotFoundError:
+            return 0
+
+        self._offset += len(new)
+        buf = self._partial + new
+        lines = buf.split(b'\n')
+        # The last piece is incomplete (or empty)
+        self._partial = lines.pop()
+
+        n = 0
+        for line in lines:
+            try:
+                row = [float(x) for x in line.split()]
+            except ValueError:
+                continue
+            if row:
+                self.rows.append(row)
+                n += 1
+        return n
+
+    def data(self):
+        """
+        2D array of the rows read so far.
+        """
+        ncol = len(parsers.OutputColumnNames[self.type])
+        rows = [r for r in self.rows if len(r) == ncol]
+        return np.array(rows).reshape(-1, ncol)
+
+    def stats(self):
+        """
+        Dict of standard keys and arrays, as from parsers.parse_astra_output_file
+        """
+        return parsers.astra_output_data_dict(self.data(), self.type)
+
+
+def unit_factor(key, unit_string):
+    """
+    Factor to convert a value in unit_string to the standard units of a stat key.
+
+    unit_string can be the standard unit with an SI prefix, like 'mm' for 'm', or 'MeV' for 'eV'.
+    """
+    if not unit_string:
+        return 1
+    key_unit = parsers.OutputUnits[key].unitSymbol
+    if unit_string == key_unit:
+        return 1
+    prefix = unit_string[:-len(key_unit)] if unit_string.endswith(key_unit) else None
+    if prefix == 'u':
+        prefix = 'µ'
+    if prefix not in SHORT_PREFIX_FACTOR:
+        raise ValueError(f'Unit {unit_string} is not compatible with {key} in {key_unit}')
+    return SHORT_PREFIX_FACTOR[prefix]
+
+
+class AbortCondition:
+    """
+    Condition on the stats of a running simulation, like:
+        'norm_emit_x > 5e-6'
+        'sigma_x > 3 mm'
+        'n_lost > 10%'
+
+    The condition is true if it holds for any z written so far.
+
+    Values are in the standard units of the key (see: parsers.OutputUnits), or in the given unit
+    with an SI prefix. A value in % is relative to the initial number of particles, for particle counts.
+
+    Short names for the LandF columns are allowed: n_particles, n_lost, total_charge
+
+    Parameters
+    ----------
+    condition : str or callable
+        If callable, it is called with the dict of stats arrays written so far,
+        and must return True to abort.
+
+    """
+
+    def __init__(self, condition):
+        self.condition = condition
+
+        if callable(condition):
+            self.key = None
+            return
+
+        m = ABORT_CONDITION_RE.match(condition)
+        if not m:
+            raise ValueError(f'Cannot parse abort condition: {condition}')
+        key, op, value, unit_string = m.groups()
+
+        self.key = STAT_ALIASES.get(key, key)
+        if self.key not in parsers.OutputUnits:
+            raise ValueError(f'Unknown stat in abort condition: {key}')
+        self.compare = COMPARISONS[op]
+        self.value = float(value)
+        self.percent = unit_string == '%'
+        if self.percent:
+            if not self.key.startswith('landf_n_'):
+                raise ValueError(f'% is only allowed for particle counts: {condition}')
+            self.value /= 100
+        else:
+            self.value *= unit_factor(self.key, unit_string)
+
+    def __repr__(self):
+        if self.key is None:
+            return getattr(self.condition, '__name__', repr(self.condition))
+        return str(self.condition)
+
+    def __call__(self, stats):
+        if self.key is None:
+            return bool(self.condition(stats))
+
+        if self.key not in stats or len(stats[self.key]) == 0:
+            return False
+
+        value = self.value
+        if self.percent:
+            if len(stats.get('landf_n_particles', [])) == 0:
+                return False
+            value *= stats['landf_n_particles'][0]
+
+        return bool(np.any(self.compare(stats[self.key], value)))
+
+
+def partial_output_stats(tails):
+    """
+    Collects the stats from a list of OutputFileTail, as in Astra.load_output.
+
+    Files are written at slightly different times, so all arrays are cut to the shortest length.
+    Files with no rows are skipped: Astra only writes some of them, like Cemit, for some settings.
+
+    Returns a tuple of dicts: stats, other
+    """
+    stats = {}
+    other = {}
+    for tail in tails:
+        if not tail.rows:
+            continue
+        d = tail.stats()
+        if tail.type == 'LandF':
+            other.update(d)
+        else:
+            stats.update(d)
+    if stats:
+        n = min(len(v) for v in stats.values())
+        for k in stats:
+            stats[k] = stats[k][:n]
+    return stats, other
+
+
+class RunMonitor:
+    """
+    Reports the progress of a running Astra simulation, by following the mean_z
+    written to its Zemit (or Xemit) file.
+
+    Call .poll() periodically. This is done by tools.execute2, see Astra.run_astra.
+
+    Parameters
+    ----------
+    input_file : str
+        Astra input file of the run. Output files are named from this.
+    run_number : int, optional
+        Astra run number. Default: 1
+    zstart : float, optional
+        Starting z in m. Default: 0
+    zstop : float, optional
+        Final z in m. Default: 1
+    stall_timeout : float, optional
+        A run is stalled if no new z position is written within this many seconds. Default: None (never)
+    callback : callable, optional
+        Called with the .status() dict at every poll.
+    kill_on_stall : bool, optional
+        poll() will return 'stalled' to kill the process. Default: True
+    abort : list of str or callable, optional
+        Abort conditions on the stats written so far. See: AbortCondition
+        poll() will return 'abort: <condition>' when one is true.
+
+    """
+
+    def __init__(self, input_file, run_number=1, zstart=0, zstop=1,
+                 stall_timeout=None, callback=None, kill_on_stall=True, abort=None):
+
+        self.zstart = zstart
+        self.zstop = zstop
+        self.stall_timeout = stall_timeout
+        self.callback = callback
+        self.kill_on_stall = kill_on_stall
+        if abort is None:
+            abort = []
+        elif isinstance(abort, str) or callable(abort):
+            abort = [abort]
+        self.abort = [a if isinstance(a, AbortCondition) else AbortCondition(a) for a in abort]
+        self.aborted = None
+
+        path, infile = os.path.split(input_file)
+        prefix = infile.split('.')[0]  # Astra uses inputfile to name output
+        ext = parsers.astra_run_extension(run_number)
+        # Progress only needs Zemit or Xemit. Abort conditions may need any file.
+        types = OUTPUT_TYPES if self.abort else ['Zemit', 'Xemit']
+        self.tails = {t: OutputFileTail(os.path.join(path, f'{prefix}.{t}.{ext}'))
+                      for t in types}
+
+        self.start_time = time()
+        self.last_progress_time = self.start_time
+        self.history = []  # (time, z)
+        self.stalled = False
+
+    @classmethod
+    def from_astra(cls, astra_object, **kwargs):
+        """
+        Creates a monitor for the input of an Astra object.
+        """
+        output = astra_object.input['output']
+        return cls(astra_object.input_file,
+                   run_number=astra_object.input['newrun']['run'],
+                   zstart=output.get('zstart', 0),
+                   zstop=output.get('zstop', 1),
+                   **kwargs)
+
+    @property
+    def mean_z(self):
+        """Last z position written, or None"""
+        if self.history:
+            return self.history[-1][1]
+        return None
+
+    def update(self):
+        """
+        Reads new output, and updates the stall and abort state.
+        """
+        now = time()
+        new = {t: tail.update() for t, tail in self.tails.items()}
+        for t in ['Zemit', 'Xemit']:
+            if new[t]:
+                z = self.tails[t].rows[-1][0]
+                if not self.history or z != self.history[-1][1]:
+                    self.history.append((now, z))
+                    self.last_progress_time = now
+                # Only use the first file that has data
+                break
+
+        if self.stall_timeout is not None:
+            self.stalled = (now - self.last_progress_time) > self.stall_timeout
+
+        if self.abort and any(new.values()) and self.aborted is None:
+            self.check_abort()
+
+    def check_abort(self):
+        """
+        Evaluates the abort conditions on the stats written so far.
+        Sets .aborted to the first condition that is true.
+        """
+        stats, other = partial_output_stats(self.tails.values())
+        if not stats or len(stats['mean_z']) == 0:
+            return
+        stats.update(other)
+        for condition in self.abort:
+            if condition(stats):
+                self.aborted = condition
+                return
+
+    def status(self):
+        """
+        Returns a dict with:
+            mean_z : last z position written (m)
+            zstop : final z position (m)
+            progress : fraction of the beamline tracked
+            rate : tracking rate (m/s)
+            eta : estimated time remaining (s)
+            elapsed : time since start (s)
+            stalled : bool
+            aborted : abort condition that was met, or None
+        """
+        now = time()
+        d = {'mean_z': self.mean_z, 'zstop': self.zstop, 'progress': 0.0, 'rate': None, 'eta': None,
+             'elapsed': now - self.start_time, 'stalled': self.stalled, 'aborted': self.aborted}
+
+        if self.history:
+            z = self.history[-1][1]
+            L = self.zstop - self.zstart
+            if L > 0:
+                d['progress'] = min(max((z - self.zstart) / L, 0), 1)
+
+            # Rate from the first to the last point written
+            t0, z0 = self.history[0]
+            t1, z1 = self.history[-1]
+            if t1 > t0:
+                rate = (z1 - z0) / (t1 - t0)
+                d['rate'] = rate
+                if rate > 0:
+                    d['eta'] = max(self.zstop - z1, 0) / rate
+
+        return d
+
+    def poll(self):
+        """
+        Updates, calls the callback, and returns 'abort: <condition>' or 'stalled'
+        if the run should be killed.
+        """
+        self.update()
+        if self.callback:
+            self.callback(self.status())
+        if self.aborted is not None:
+            return f'abort: {self.aborted}'
+        if self.stalled and self.kill_on_stall:
+            return 'stalled'
+        return ''
+
+
+def print_progress(status):
+    """
+    Simple progress callback for RunMonitor.
+    """
+    z = status['mean_z']
+    if z is None:
+        print(f"{status['elapsed']:8.1f} s: waiting for output")
+        return
+    s = f"{status['elapsed']:8.1f} s: z = {z:.4g} / {status['zstop']:.4g} m ({100 * status['progress']:.1f}%)"
+    if status['rate'] is not None:
+        s += f", {status['rate']:.3g} m/s"
+    if status['eta'] is not None:
+        s += f", ETA {status['eta']:.1f} s"
+    if status['stalled']:
+        s += ' STALLED'
+    if status['aborted'] is not None:
+        s += f" ABORTED ({status['aborted']})"
+    print(s)
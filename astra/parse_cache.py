@@ -0,0 +1,184 @@
+"""
+Binary cache of parsed Astra text files.
+
+After the first parse of a stats, phase space, or fieldmap file, its arrays are stored as .npy files,
+and later parses of the unchanged file are memory maps of these.
+
+Entries are keyed by the absolute path, size, and mtime of the text file, so a file
+that is rewritten by a new run is parsed again.
+
+The cache is off by default. Turn it on with:
+    enable_parse_cache()  # .astra_cache directories next to the parsed files
+    enable_parse_cache('/path/to/cache')  # one cache directory
+
+or with the environmental variable ASTRA_PARSE_CACHE set to 1 (sidecar) or to a cache directory.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+SIDECAR_DIR = '.astra_cache'
+
+# None: off, '': sidecar directories, otherwise the cache root
+_CACHE_ROOT = None
+
+
+def enable_parse_cache(path=''):
+    """
+    Turns the parse cache on.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache directory. Default: '', for .astra_cache directories next to the parsed files.
+
+    """
+    global _CACHE_ROOT
+    if path:
+        path = os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+        os.makedirs(path, exist_ok=True)
+    _CACHE_ROOT = path
+
+
+def disable_parse_cache():
+    """
+    Turns the parse cache off.
+    """
+    global _CACHE_ROOT
+    _CACHE_ROOT = None
+
+
+def parse_cache_enabled():
+    return _CACHE_ROOT is not None
+
+
+def _init_from_env():
+    val = os.environ.get('ASTRA_PARSE_CACHE', '')
+    if val.lower() in ('', '0', 'false', 'no'):
+        return
+    if val.lower() in ('1', 'true', 'yes', 'sidecar'):
+        enable_parse_cache()
+    else:
+        enable_parse_cache(val)
+
+
+_init_from_env()
+
+
+def entry_path(filePath, tag=''):
+    """
+    Directory of the cache entry for the current version of a file.
+    """
+    f = os.path.abspath(filePath)
+    st = os.stat(f)
+    dirname, name = os.path.split(f)
+    entry = f'{name}.{tag}.{st.st_size}.{st.st_mtime_ns}'
+    if _CACHE_ROOT:
+        h = hashlib.blake2b(dirname.encode(), digest_size=8).hexdigest()
+        return os.path.join(_CACHE_ROOT, h, entry)
+    return os.path.join(dirname, SIDECAR_DIR, entry)
+
+
+def read_entry(path):
+    """
+    Reads a cache entry: arrays are memory mapped (copy on write), other values are from JSON.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    d = {}
+    for key in meta['arrays']:
+        d[key] = np.load(os.path.join(path, key + '.npy'), mmap_mode='c')
+    d.update(meta['values'])
+    return d
+
+
+def write_entry(path, d):
+    """
+    Writes a dict of arrays and JSON-able values as a cache entry.
+
+    Older entries of the same file are removed.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+
+    arrays = [k for k, v in d.items() if isinstance(v, np.ndarray)]
+    values = {k: _native(v) for k, v in d.items() if k not in arrays}
+
+    # Write in a temporary directory, then rename, so readers never see partial entries
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp')
+    try:
+        for key in arrays:
+            np.save(os.path.join(tmp, key + '.npy'), d[key])
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'arrays': arrays, 'values': values}, f)
+        os.rename(tmp, path)
+    except OSError:
+        # Another process wrote it first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(path):
+            raise
+
+    # Stale entries have the same name and tag, with a different size or mtime
+    prefix = os.path.basename(path).rsplit('.', 2)[0] + '.'
+    for item in os.scandir(parent):
+        if item.path == path or not item.name.startswith(prefix):
+            continue
+        if re.fullmatch(r'\d+\.\d+', item.name[len(prefix):]):
+            shutil.rmtree(item.path, ignore_errors=True)
+
+
+def _native(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def cached_parse(filePath, parser, tag=''):
+    """
+    Returns parser(filePath), from the cache if it is on and has an entry for the current file.
+
+    When the cache is used, the arrays returned are memory maps of the entry, also on the first parse.
+
+    parser must return a dict of arrays and JSON-able values.
+    tag distinguishes different parsers or options for the same file.
+    """
+    if _CACHE_ROOT is None:
+        return parser(filePath)
+
+    path = entry_path(filePath, tag=tag)
+    if os.path.isdir(path):
+        try:
+            return read_entry(path)
+        except (OSError, ValueError, KeyError):
+            shutil.rmtree(path, ignore_errors=True)
+
+    d = parser(filePath)
+    try:
+        write_entry(path, d)
+    except OSError:
+        # A read-only location is not an error
+        return d
+
+    # Return memory maps, as for later parses, so the parsed arrays can be freed
+    try:
+        return read_entry(path)
+    except (OSError, ValueError, KeyError):
+        return d
+
+
+def clear_parse_cache(path=None):
+    """
+    Removes the cache root, or the sidecar cache directory in path.
+    """
+    if path is None:
+        path = _CACHE_ROOT
+    elif os.path.basename(path) != SIDECAR_DIR:
+        path = os.path.join(path, SIDECAR_DIR)
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
@@ -11,11 +11,17 @@ https://journals.aps.org/prab/pdf/10.1103/PhysRevSTAB.6.034202
 from pmd_beamphysics.units import unit
 
 import os
+import functools
+import threading
+from collections import OrderedDict
+from numbers import Number
 
 from math import isnan
 import numpy as np
 import re
 
+from .parse_cache import cached_parse
+
 # ------------
 
 
@@ -138,24 +144,167 @@ def parse_astra_output_file(filePath, standardize_labels=True,):
     if os.stat(filePath).st_size == 0:
         raise ValueError(f'ERROR: Empty output file: {filePath}')
     
-    data = np.loadtxt(filePath, ndmin=2)
-    if data.shape == ():
-        raise ValueError(f'No data in file: {filePath}')
+    tag = 'std' if standardize_labels else 'raw'
+    return cached_parse(filePath, functools.partial(_parse_astra_output_file, standardize_labels=standardize_labels), 
+                        tag=tag)
+
+
+def _parse_astra_output_file(filePath, standardize_labels=True):
+    type = astra_output_type(filePath) 
+    
+    data = read_table(filePath, len(OutputColumnNames[type]))
     
     if len(data) == 0:
         raise ValueError(f'No data in file (zero length): {filePath}')
     
+    return astra_output_data_dict(data, type, standardize_labels=standardize_labels)
+
+
+# Numbers in Fortran E format, like -0.12345E+01, with a column for the sign before them
+E_FIELD_RE = re.compile(rb'(?<![^ ])[+-]?(\d+)\.(\d+)([EeDd])([+-])(\d+)(?![^ \r])')
+
+# Exact powers of ten, for scaling integer mantissas
+_POW10 = np.array([float(10**k) for k in range(23)])
+
+FIXED_WIDTH_BLOCK_ROWS = 8192
+
+
+def read_table(filePath, ncol):
+    """
+    Reads a whitespace separated numerical table with ncol columns into a 2D array.
+    
+    Astra writes its stats files with Fortran E formats, so all lines have the same length,
+    and each number has its digits, point, and exponent in the same columns.
+    These files are converted directly from the bytes. See: read_fixed_width_table
+    
+    Other files are read with np.loadtxt.
+    """
+    with open(filePath, 'rb') as f:
+        buf = f.read()
+    
+    data = read_fixed_width_table(buf, ncol)
+    if data is None:
+        data = np.loadtxt(filePath, ndmin=2)
+    return data
+
+
+def read_fixed_width_table(buf, ncol):
+    """
+    Converts the bytes of a table of numbers in a fixed E format, like:
+          0.1000E+00  -0.2500E-03   0.1234E+01
+    in which every line has the same length, and every number the same digits.
+    
+    The character columns of all lines are transposed in blocks, and digits are
+    accumulated with integer arithmetic, so the result is the same as np.loadtxt.
+    
+    Returns a 2D array, or None if buf does not have this form.
+    """
+    if buf and not buf.endswith(b'\n'):
+        buf += b'\n'
+    L = buf.find(b'\n') + 1
+    if L < 2 or len(buf) % L:
+        return None
+    
+    fields = list(E_FIELD_RE.finditer(buf, 0, L - 1))
+    if len(fields) != ncol:
+        return None
+    formats = {tuple(len(m.group(i)) for i in (1, 2, 5)) for m in fields}
+    if len(formats) != 1:
+        return None
+    n_int, n_frac, n_exp = formats.pop()
+    if n_int + n_frac > 15:
+        return None
+    
+    # Character columns of each part, as arrays over the fields
+    sign = np.array([m.start(1) - 1 for m in fields])
+    if sign.min() < 0:
+        return None
+    mantissa = [np.array([m.start(1) + i for m in fields]) for i in range(n_int)]
+    mantissa += [np.array([m.start(2) + i for m in fields]) for i in range(n_frac)]
+    exponent = [np.array([m.start(5) + i for m in fields]) for i in range(n_exp)]
+    exp_sign = np.array([m.start(4) for m in fields])
+    
+    # Everything else must be the same in every line: points, exponent markers, spaces, newline
+    variable = np.concatenate([sign, exp_sign] + mantissa + exponent)
+    fixed = np.setdiff1d(np.arange(L), variable)
+    line = np.frombuffer(buf, dtype=np.uint8, count=L)
+    fixed_chars = line[fixed][:, None]
+    
+    # Lookup tables by character: sign factor (0 if invalid), exponent sign offset (-1 if invalid)
+    sign_factor = np.zeros(256)
+    sign_factor[[32, 43]] = 1
+    sign_factor[45] = -1
+    n_e = 10**n_exp
+    exp_offset = np.full(256, -1)
+    exp_offset[[43, 45]] = [0, n_e]
+    
+    # Lookup tables by exponent and its sign: scaling of the integer mantissa.
+    # Up to 10**22, powers of ten are exact, so one multiply or divide is exactly rounded.
+    k = np.concatenate([np.arange(n_e), -np.arange(n_e)]) - n_frac
+    kc = np.clip(k, -22, 22)
+    mul = _POW10[np.maximum(kc, 0)]
+    div = _POW10[np.maximum(-kc, 0)]
+    big = np.abs(k) > 22
+    
+    A = np.frombuffer(buf, dtype=np.uint8).reshape(-1, L)
+    data = np.empty((ncol, len(A)))
+    for i in range(0, len(A), FIXED_WIDTH_BLOCK_ROWS):
+        T = np.ascontiguousarray(A[i:i + FIXED_WIDTH_BLOCK_ROWS].T)
+        if not np.array_equal(T[fixed], np.broadcast_to(fixed_chars, (len(fixed), T.shape[1]))):
+            return None
+        
+        m = _digits(T, mantissa)
+        e = _digits(T, exponent)
+        if m is None or e is None:
+            return None
+        
+        s = sign_factor[T[sign]]
+        offset = exp_offset[T[exp_sign]]
+        if not s.all() or (offset < 0).any():
+            return None
+        
+        e += offset
+        v = m*mul[e]/div[e]
+        # Beyond 10**22 the powers of ten are inexact: convert these few as text
+        b = big[e]
+        if b.any():
+            v[b] = [float(f'{mi}e{ki}') for mi, ki in zip(m[b].tolist(), k[e[b]].tolist())]
+        v *= s
+        data[:, i:i + FIXED_WIDTH_BLOCK_ROWS] = v
+    
+    return data.T
+
+
+def _digits(T, columns):
+    """
+    Integers from columns of digit characters, with the most significant first.
+    """
+    v = np.zeros((len(columns[0]), T.shape[1]), dtype=np.int64)
+    for c in columns:
+        d = T[c] - np.uint8(48)
+        if not np.all(d <= 9):
+            return None
+        v *= 10
+        v += d
+    return v
+
+
+def astra_output_data_dict(data, type, standardize_labels=True):
+    """
+    Forms a dict of standard keys and arrays from the 2D data table of an output file.
+    
+    See: parse_astra_output_file
+    """
     d = {}
-    type = astra_output_type(filePath) 
     
     # Get the appropriate keys and factors 
     keys = OutputColumnNames[type]
-    factors = OutputColumnFactors[type]
+    factors = np.asarray(OutputColumnFactors[type], dtype=float)
      
-    for i in range(len(keys)):
-        #print(filePath, keys[i])
-        
-        d[keys[i]] = data[:,i]*factors[i]
+    # Scale all columns at once. Transpose, so that each column is contiguous.
+    columns = np.ascontiguousarray((data[:, :len(keys)]*factors).T)
+    for i, key in enumerate(keys):
+        d[key] = columns[i]
 
     
     if standardize_labels:
@@ -307,7 +456,7 @@ def parse_simple_namelist(filePath, commentchar='!', condense=False ):
         
         for line in f:
             ulines = unroll_namelist_line(line, commentchar=commentchar, condense=condense)
-            lines = lines + ulines
+            lines.extend(ulines)
 
             
     return lines
@@ -352,14 +501,162 @@ def parse_unrolled_namelist(unrolled_lines):
     return namelists
 
 
+# Tokens of a namelist file, in order of precedence. Separators (spaces, commas, newlines) are skipped.
+NAMELIST_TOKEN_RE = re.compile(r"""
+    [\s,]*(?:
+    (?P<comment>![^\n]*)                             # comment, to the end of the line
+   |(?P<end>/|[&$]end\b)                             # end of a namelist
+   |(?P<group>[&$]\w+)                               # start of a namelist
+   |(?P<key>[A-Za-z_][\w%]*(?:[ \t]*\([^()=\n]*\))?)[ \t]*=  # key =, with an optional index
+   |(?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")       # quoted string
+   |(?P<complex>\([ \t]*[^\s,()]+[ \t]*,[ \t]*[^\s,()]+[ \t]*\))  # complex: (re, im)
+   |(?P<repeat>\d+)\*                                # repeat count: 3*0.0
+   |(?P<value>[^\s,'"()=!/][^\s,'"()=!]*)             # number, logical, or bare word
+   |(?P<other>\S)
+    )""", re.VERBOSE)
+
+
+def _namelist_value(values, raw):
+    """
+    Value of a key from its list of tokens: a scalar, a list, or the raw text if it is not all numbers.
+    """
+    if len(values) == 1:
+        return values[0]
+    if not values:
+        return ''
+    if all(isinstance(v, (Number, list)) for v in values):
+        return values
+    return ' '.join(raw)
+
+
+def parse_namelists(text):
+    """
+    Parses Fortran namelist text into a dict of namelists, each a dict of key: value,
+    in a single pass.
+
+    Keys are lower case, without spaces. Values are converted by number(), with:
+        vectors (separated by spaces or commas) as lists
+        repeat counts: 3*0 -> [0, 0, 0]
+        complex values: (1.0, 2.0) -> [1.0, 2.0]
+        double precision exponents: 1.0D-3 or 1.0d-3
+        quoted strings, which may contain ! , = / and ''
+    Several keys can be on one line, and a vector can continue on the next line.
+    Comments (!) are skipped. A namelist ends with / or $end.
+
+    Quoted strings are returned without their quotes, also if they have several words:
+    head = 'My run' gives 'My run'. The line based parser (parse_unrolled_namelist)
+    kept the quotes of such strings: "'My run'".
+    """
+    namelists = {}
+    nl = None
+    key, values, raw = None, [], []
+    repeat = 1
+
+    for m in NAMELIST_TOKEN_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == 'comment' or kind is None:
+            continue
+        tok = m[kind]
+
+        if kind == 'key' or kind == 'end' or kind == 'group':
+            # Finish the current key
+            if key is not None:
+                nl[key] = _namelist_value(values, raw)
+                key = None
+            if kind == 'key':
+                if nl is None:
+                    raise ValueError(f'Namelist key outside of a namelist, line {_lineno(text, m)}: {tok}')
+                key, values, raw = tok.lower().replace(' ', '').replace('\t', ''), [], []
+            elif kind == 'end':
+                nl = None
+            else:
+                nl = namelists[tok[1:].lower()] = {}
+            continue
+
+        if key is None:
+            raise ValueError(f'Namelist value without a key, line {_lineno(text, m)}: {tok}')
+        if kind == 'value':
+            try:
+                # Fortran double precision: 1.0D-3 or 1.0d-3
+                val = float(tok.replace('D', 'E').replace('d', 'e'))
+                if val.is_integer():
+                    val = int(val)
+            except ValueError:
+                val = number(tok)
+        elif kind == 'string':
+            q = tok[0]
+            val = tok[1:-1].replace(q + q, q)
+        elif kind == 'repeat':
+            repeat = int(tok)
+            continue
+        elif kind == 'complex':
+            val = [number(x.strip()) for x in tok[1:-1].split(',')]
+        else:
+            raise ValueError(f'Cannot parse namelist, line {_lineno(text, m)}: {tok}')
+
+        if repeat == 1:
+            values.append(val)
+        else:
+            values.extend([val]*repeat)
+            repeat = 1
+        raw.append(tok)
+
+    if key is not None:
+        nl[key] = _namelist_value(values, raw)
+    return namelists
+
+
+def _lineno(text, match):
+    return text.count('\n', 0, match.start()) + 1
+
+
+# Parsed namelist files, by (path, mtime, size)
+NAMELIST_CACHE_SIZE = 64
+_namelist_cache = OrderedDict()
+_namelist_cache_lock = threading.Lock()
+
+
+def parse_namelist_file(filePath):
+    """
+    Parses a Fortran namelist file. See: parse_namelists
+
+    Results are cached by path, mtime, and size, and a copy is returned,
+    so repeated parses of the same file are fast.
+    """
+    f = os.path.abspath(filePath)
+    st = os.stat(f)
+    cache_key = (f, st.st_mtime_ns, st.st_size)
+
+    with _namelist_cache_lock:
+        namelists = _namelist_cache.get(cache_key)
+        if namelists is not None:
+            _namelist_cache.move_to_end(cache_key)
+
+    if namelists is None:
+        with open(f, 'r') as fid:
+            namelists = parse_namelists(fid.read())
+        with _namelist_cache_lock:
+            _namelist_cache[cache_key] = namelists
+            while len(_namelist_cache) > NAMELIST_CACHE_SIZE:
+                _namelist_cache.popitem(last=False)
+
+    return {name: {k: _copy_value(v) for k, v in nl.items()} for name, nl in namelists.items()}
+
+
+def _copy_value(v):
+    if isinstance(v, list):
+        return [_copy_value(x) for x in v]
+    return v
+
+
 def parse_astra_input_file(filePath, condense=False):
     """
     Parses an Astra input file into separate dicts for each namelist. 
     Returns a dict of namelists. 
+
+    See: parse_namelist_file. condense is not used.
     """
-    lines = parse_simple_namelist(filePath, condense=condense)
-    namelists = parse_unrolled_namelist(lines)
-    return namelists
+    return parse_namelist_file(filePath)
 
 
 
@@ -410,8 +707,52 @@ def find_max_pos(astra_input):
                     
     return zmax        
 
+def parse_auto_phase_table(log):
+    """
+    Parses the cavity phasing table that Astra writes to its log when auto_phase is on:
+    
+         Cavity phasing completed:
+         Cavity number   Energy gain [MeV]  at  Phase [deg]
+               1             17.34               299.38    
+     ----------------------------------------------------------
+    
+    log can be a str, or a list of lines.
+    
+    Returns a dict of cavity number: dict with
+        energy_gain : in eV
+        phase : phase of maximum energy gain, in deg
+    
+    """
+    if not isinstance(log, str):
+        log = ''.join(log)
+        
+    phases = {}
+    lines = iter(log.splitlines())
+    for line in lines:
+        if 'Cavity phasing completed' not in line:
+            continue
+        next(lines, None) # Header
+        for line in lines:
+            x = line.split()
+            if len(x) != 3:
+                break
+            try:
+                ix, gain, phase = int(x[0]), float(x[1]), float(x[2])
+            except ValueError:
+                break
+            phases[ix] = {'energy_gain': gain*1e6, 'phase': phase}
+    return phases
+
 # ------------------------------------------------------------------ 
 # ------------------------- Astra particles ------------------------ 
+@functools.lru_cache(maxsize=None)
+def phase_file_pattern(prefix, run_extension):
+    """
+    Compiled regex for the phase space files of a run: <prefix>.<4 digits>.<run_extension>
+    """
+    return re.compile(re.escape(prefix) + r'\.(\d{4})\.' + re.escape(run_extension) + '$')
+
+
 def find_phase_files(input_filePath, run_number=1):
     """
     Returns a list of the phase space files, sorted by z position
@@ -419,26 +760,14 @@ def find_phase_files(input_filePath, run_number=1):
     """
     path, infile = os.path.split(input_filePath)
     prefix = infile.split('.')[0] # Astra uses inputfile to name output    
-    phase_import_file = ''
-    phase_files = [];
-    run_extension = astra_run_extension(run_number)
-    for file in os.listdir(path):
-        if re.match(prefix + '.\d\d\d\d.'+run_extension, file):
-            # Get z position
-            z = float(file.replace(prefix+ '.', '').replace('.'+run_extension,''))
-            phase_file=os.path.join(path, file)
-            phase_files.append((phase_file, z))
+    pattern = phase_file_pattern(prefix, astra_run_extension(run_number))
+    phase_files = []
+    with os.scandir(path or '.') as it:
+        for entry in it:
+            m = pattern.match(entry.name)
+            if m:
+                # Get z position
+                z = float(m.group(1))
+                phase_files.append((os.path.join(path, entry.name), z))
     # Sort by z
     return sorted(phase_files, key=lambda x: x[1])
-
-
-
-
-
-    
-    
-    
-    
-    
-    
-
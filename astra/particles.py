@@ -0,0 +1,512 @@
+"""
+Loading of Astra phase space files.
+"""
+
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import hashlib
+import itertools
+import os
+import threading
+
+import numpy as np
+from pmd_beamphysics import ParticleGroup
+from pmd_beamphysics.interfaces.astra import astra_species_name, parse_astra_phase_file
+
+from .parse_cache import cached_parse
+
+# Default memory budget for parsed screens in a PhaseFileSequence
+DEFAULT_MAX_BYTES = 2_000_000_000
+
+# ParticleGroup key: column in an Astra phase space file.
+# t is the time of the reference particle, so it needs no column.
+PHASE_FILE_COLUMNS = {'x': 0, 'y': 1, 'z': 2, 'px': 3, 'py': 4, 'pz': 5, 'weight': 7, 'status': 9}
+PARTICLE_KEYS = ['x', 'y', 'z', 'px', 'py', 'pz', 't', 'status', 'weight']
+COORDINATE_KEYS = ['x', 'y', 'z', 'px', 'py', 'pz', 't']
+
+
+def parse_phase_file(filePath, columns=None, alive_only=False, subsample=None, seed=0):
+    """
+    Parses an Astra phase space file, as pmd_beamphysics.interfaces.astra.parse_astra_phase_file,
+    reading only some of the columns and particles.
+
+    Parameters
+    ----------
+    filePath : str
+    columns : list of str, optional
+        ParticleGroup keys to read, from: x, y, z, px, py, pz, t, status, weight.
+        weight is always read. Default: None (all)
+    alive_only : bool, optional
+        Drop particles that do not have status == 1 (Astra status 5). Default: False
+    subsample : int or float, optional
+        An int k keeps every k-th particle.
+        A float in (0, 1) keeps this fraction of the particles, chosen at random with seed.
+        The weights are scaled by (number of particles)/(number kept), to keep the total charge.
+        Default: None (all)
+    seed : int, optional
+        Seed of the random subsample. Default: 0
+
+    Returns
+    -------
+    dict of the columns that were read, and the scalars: t, species, n_particle
+
+    """
+    if columns is None and not alive_only and subsample is None:
+        return parse_astra_phase_file(filePath)
+
+    keys, usecols = _phase_file_columns(columns, alive_only)
+
+    with open(filePath) as f:
+        ref = np.array(f.readline().split(), dtype=float)
+        if subsample is None:
+            lines, scale = f, 1
+        else:
+            n = _count_lines(filePath) - 1
+            lines, n_kept = _subsample_lines(f, n, subsample, seed)
+            scale = n/n_kept if n_kept else 1
+        data = np.loadtxt(lines, usecols=usecols, ndmin=2)
+
+    return _phase_data(data, keys, ref, alive_only=alive_only, scale=scale)
+
+
+def iter_phase_file_chunks(filePath, chunk_size=1_000_000, columns=None):
+    """
+    Parses an Astra phase space file in chunks of particles.
+
+    Only one chunk is in memory at a time.
+
+    Parameters
+    ----------
+    filePath : str
+    chunk_size : int, optional
+        Particles per chunk. Default: 1_000_000
+    columns : list of str, optional
+        ParticleGroup keys to read. See: parse_phase_file
+
+    Yields
+    ------
+    dict, as parse_phase_file, for each chunk
+
+    """
+    keys, usecols = _phase_file_columns(columns, False)
+    with open(filePath) as f:
+        ref = np.array(f.readline().split(), dtype=float)
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            data = np.loadtxt(lines, usecols=usecols, ndmin=2)
+            del lines
+            yield _phase_data(data, keys, ref)
+
+
+def _phase_file_columns(columns, alive_only):
+    """
+    Keys and file columns to read. weight is always read, and status if it is needed for alive_only.
+    """
+    keys = PARTICLE_KEYS if columns is None else list(columns)
+    unknown = set(keys) - set(PARTICLE_KEYS)
+    if unknown:
+        raise ValueError(f'Unknown particle columns: {sorted(unknown)}. Allowed: {PARTICLE_KEYS}')
+    keys = [k for k in PHASE_FILE_COLUMNS if k in keys or k == 'weight' or (k == 'status' and alive_only)]
+    return keys, [PHASE_FILE_COLUMNS[k] for k in keys]
+
+
+def _phase_data(data, keys, ref, alive_only=False, scale=1):
+    """
+    Data dict from the parsed columns of a phase space file, in the units of parse_astra_phase_file.
+    """
+    d = {}
+    for i, key in enumerate(keys):
+        d[key] = data[:, i]
+    d['weight'] = np.abs(d['weight'])*(1e-9*scale)
+    if 'z' in d:
+        d['z'] = d['z'] + ref[2]
+    if 'pz' in d:
+        d['pz'] = d['pz'] + ref[5]
+    if 'status' in d:
+        # As in parse_astra_phase_file: Astra 1 -> 2, 5 -> 1
+        raw = d['status'].astype(int)
+        status = raw.copy()
+        status[raw == 1] = 2
+        status[raw == 5] = 1
+        d['status'] = status
+        if alive_only:
+            alive = status == 1
+            for key in keys:
+                d[key] = d[key][alive]
+
+    d['t'] = ref[6]*1e-9
+    d['species'] = astra_species_name[int(ref[8])]
+    d['n_particle'] = len(d['weight'])
+    return d
+
+
+def _count_lines(filePath):
+    n = 0
+    with open(filePath, 'rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            n += block.count(b'\n')
+    return n
+
+
+def _subsample_lines(lines, n, subsample, seed):
+    """
+    Returns an iterator over the kept lines, and the number kept.
+    """
+    if isinstance(subsample, (int, np.integer)) and not isinstance(subsample, bool):
+        if subsample < 1:
+            raise ValueError(f'subsample must be an int >= 1 or a float in (0, 1): {subsample}')
+        return itertools.islice(lines, 0, None, subsample), len(range(0, n, subsample))
+
+    if not 0 < subsample < 1:
+        raise ValueError(f'subsample must be an int >= 1 or a float in (0, 1): {subsample}')
+    n_kept = int(round(n*subsample))
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(n, dtype=bool)
+    mask[rng.choice(n, size=n_kept, replace=False)] = True
+    return itertools.compress(lines, mask), n_kept
+
+
+def phase_data_particle_group(data):
+    """
+    Makes a ParticleGroup from parse_phase_file data.
+
+    Columns that were not read are read-only views of a single value:
+    status is 1, the others are nan.
+    """
+    n = data['n_particle']
+    missing = [k for k in PARTICLE_KEYS if k not in data]
+    P = ParticleGroup(data={**{k: 0 for k in missing}, **data})
+    for k in missing:
+        P.data[k] = np.broadcast_to(np.array(1 if k == 'status' else np.nan, dtype=P.data[k].dtype), (n,))
+    return P
+
+
+def compact_particle_group(particle_group, float32=False):
+    """
+    Reduces the memory of a ParticleGroup, in place:
+        status is stored as int8
+        weight and t are stored as a single value, if they are constant
+        coordinates are stored as float32, if asked for
+
+    The arrays stay arrays of the same length, so the ParticleGroup interface is unchanged,
+    but constant arrays are read-only views: set them as a whole (P.weight = ...),
+    not in place (P.weight *= ...).
+
+    float32 has about 7 significant digits. This is enough for most diagnostics of
+    x, y, px, py, but not for absolute z or pz of a bunch with a small spread.
+
+    Parameters
+    ----------
+    particle_group : ParticleGroup
+    float32 : bool or list of str, optional
+        Store these keys (True for all of: x, y, z, px, py, pz, t) as float32. Default: False
+
+    Returns
+    -------
+    ParticleGroup, the same object
+
+    """
+    if float32 is True:
+        float32 = COORDINATE_KEYS
+    float32 = float32 or []
+
+    data = particle_group.data
+    n = len(particle_group)
+    for key in ('weight', 't'):
+        arr = data[key]
+        if n > 0 and arr.strides != (0,) and np.all(arr == arr[0]):
+            data[key] = np.broadcast_to(arr[:1].copy(), (n,))
+
+    status = data['status']
+    if status.dtype != np.int8 and (n == 0 or (status.min() >= -128 and status.max() <= 127)):
+        data['status'] = _astype(status, np.int8)
+
+    for key in float32:
+        data[key] = _astype(data[key], np.float32)
+
+    return particle_group
+
+
+def _astype(arr, dtype):
+    """
+    astype that keeps a broadcast view a view
+    """
+    if arr.strides == (0,) and len(arr) > 0:
+        return np.broadcast_to(arr[:1].astype(dtype), arr.shape)
+    return arr.astype(dtype, copy=False)
+
+
+def load_phase_file(filePath, columns=None, alive_only=False, subsample=None, seed=0,
+                    compact=False, float32=False):
+    """
+    Loads an Astra phase space file as a ParticleGroup.
+
+    The options select columns and particles. See: parse_phase_file
+
+    compact and float32 reduce the memory of the ParticleGroup. See: compact_particle_group
+
+    The parsed data is taken from the parse cache, if it is on. See: astra.parse_cache
+    """
+    options = {'columns': columns, 'alive_only': alive_only, 'subsample': subsample, 'seed': seed}
+    if columns is None and not alive_only and subsample is None:
+        tag = 'phase'
+    else:
+        options['columns'] = None if columns is None else sorted(columns)
+        tag = 'phase-' + hashlib.blake2b(repr(sorted(options.items())).encode(), digest_size=6).hexdigest()
+    data = cached_parse(filePath, functools.partial(parse_phase_file, **options), tag=tag)
+    P = phase_data_particle_group(data)
+    if compact:
+        compact_particle_group(P, float32=float32)
+    return P
+
+
+def load_phase_files(files, max_workers=1, executor='process', **options):
+    """
+    Loads a list of Astra phase space files as ParticleGroups, in the same order.
+
+    Parameters
+    ----------
+    files : list of str
+    max_workers : int, optional
+        Number of files to parse in parallel. None means os.cpu_count(). Default: 1
+    executor : str or concurrent.futures.Executor, optional
+        'process' or 'thread' pool, or an existing executor. Default: 'process'
+
+    Returns
+    -------
+    list of ParticleGroup
+
+    Other options are passed to load_phase_file.
+    """
+    load = functools.partial(load_phase_file, **options)
+    if not isinstance(executor, str):
+        return _compact_list(executor.map(load, files), options)
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    max_workers = min(max_workers, len(files))
+    if max_workers <= 1:
+        return [load(f) for f in files]
+
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        raise ValueError(f"executor must be 'process', 'thread', or an Executor: {executor}")
+
+    with pool:
+        return _compact_list(pool.map(load, files), options)
+
+
+def _compact_list(particle_groups, options):
+    # Pickling expands broadcast views, so compact again after another process
+    if options.get('compact'):
+        return [compact_particle_group(P, float32=options.get('float32', False)) for P in particle_groups]
+    return list(particle_groups)
+
+
+def particle_stats_table(particle_groups, keys, alive_only=True, skip_missing=False):
+    """
+    Computes statistics of a list of ParticleGroups (screens), for many keys in one pass.
+
+    Each screen is visited once: its alive particles (status == 1) are selected once,
+    and all keys are computed from them.
+
+    n_alive and n_dead use the Astra convention of Astra.particle_stat: status > -6 and status < -6,
+    counted over all particles.
+
+    Parameters
+    ----------
+    particle_groups : sequence of ParticleGroup
+    keys : list of str
+    alive_only : bool, optional
+        Compute statistics from the alive particles only. Default: True
+    skip_missing : bool, optional
+        Leave out keys that ParticleGroup cannot compute, instead of raising. Default: False
+
+    Returns
+    -------
+    dict of key: array with one value per screen
+
+    """
+    keys = list(keys)
+    table = {key: [] for key in keys}
+    for P in particle_groups:
+        status = P.status
+        if 'n_alive' in table:
+            table['n_alive'].append(np.count_nonzero(status > -6))
+        if 'n_dead' in table:
+            table['n_dead'].append(np.count_nonzero(status < -6))
+
+        if alive_only:
+            alive = status == 1
+            if not alive.all():
+                P = P.where(alive)
+
+        for key in keys:
+            if key in ('n_alive', 'n_dead') or key not in table:
+                continue
+            try:
+                table[key].append(P[key])
+            except (ValueError, KeyError, AttributeError):
+                if not skip_missing:
+                    raise
+                del table[key]
+
+    return {key: np.array(val) for key, val in table.items()}
+
+
+def particle_group_nbytes(particle_group):
+    """
+    Memory used by the arrays of a ParticleGroup. Broadcast views count as one value.
+    """
+    return sum(v.itemsize if v.strides == (0,) else v.nbytes
+               for v in particle_group.data.values() if isinstance(v, np.ndarray))
+
+
+class PhaseFileSequence(Sequence):
+    """
+    Sequence of ParticleGroups, loaded from Astra phase space files on first access.
+
+    Loaded screens are kept in an LRU cache, up to max_bytes of particle data.
+    The most recently used screen is always kept.
+
+    Files are checked for changes (size, mtime) since the sequence was made,
+    because a new run in the same workdir overwrites them.
+
+    Parameters
+    ----------
+    files : list of str
+        Phase space files, sorted by z. See: parsers.find_phase_files
+    z : list of float, optional
+        Approximate z of the files, from their names.
+    max_bytes : int, optional
+        Memory budget for loaded screens. Default: DEFAULT_MAX_BYTES
+    owner : object, optional
+        Kept alive with the sequence, so that a temporary workdir is not removed.
+    options : dict, optional
+        Column and particle selection for load_phase_file.
+
+    """
+
+    def __init__(self, files, z=None, max_bytes=None, owner=None, options=None):
+        self.files = list(files)
+        self.options = options or {}
+        self.z = list(z) if z is not None else None
+        self.max_bytes = DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+        self._owner = owner
+        self._stats = [_file_stat(f) for f in self.files]
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} with {len(self)} screens, {len(self._cache)} loaded>'
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('PhaseFileSequence index out of range')
+
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+
+        P = self._load(index)
+
+        with self._lock:
+            if index not in self._cache:
+                self._cache[index] = P
+                self._nbytes += particle_group_nbytes(P)
+                self._evict()
+        return P
+
+    def _load(self, index):
+        f = self.files[index]
+        if _file_stat(f) != self._stats[index]:
+            raise ValueError(f'Phase file has changed since it was found: {f}')
+        return load_phase_file(f, **self.options)
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and len(self._cache) > 1:
+            _, P = self._cache.popitem(last=False)
+            self._nbytes -= particle_group_nbytes(P)
+
+    @property
+    def nbytes(self):
+        """Memory used by the loaded screens"""
+        return self._nbytes
+
+    def loaded(self):
+        """Indices of the loaded screens"""
+        return list(self._cache)
+
+    def materialize(self, max_workers=1, executor='process'):
+        """
+        Loads all screens, and returns them as a list.
+
+        This ignores the memory budget.
+        """
+        todo = [i for i in range(len(self)) if i not in self._cache]
+        for i in todo:
+            if _file_stat(self.files[i]) != self._stats[i]:
+                raise ValueError(f'Phase file has changed since it was found: {self.files[i]}')
+        loaded = dict(zip(todo, load_phase_files([self.files[i] for i in todo],
+                                                 max_workers=max_workers, executor=executor, **self.options)))
+        return [self._cache[i] if i in self._cache else loaded[i] for i in range(len(self))]
+
+    def with_options(self, **options):
+        """
+        Returns a new sequence of the same files, with options for load_phase_file updated.
+        """
+        new = self.__class__(self.files, z=self.z, max_bytes=self.max_bytes, owner=self._owner,
+                             options={**self.options, **options})
+        new._stats = self._stats
+        return new
+
+    def clear(self):
+        """Drops all loaded screens"""
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def __getstate__(self):
+        # The lock and owner are not sent to other processes
+        d = self.__dict__.copy()
+        d['_lock'] = None
+        d['_owner'] = None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._lock = threading.Lock()
+
+
+def compact_particles(particles, float32=False):
+    """
+    Compact version of a list of ParticleGroups or a PhaseFileSequence. See: compact_particle_group
+
+    A PhaseFileSequence is replaced by one that compacts screens as they are loaded.
+    """
+    if isinstance(particles, PhaseFileSequence):
+        return particles.with_options(compact=True, float32=float32)
+    return [compact_particle_group(P, float32=float32) for P in particles]
+
+
+def _file_stat(f):
+    st = os.stat(f)
+    return st.st_size, st.st_mtime_ns
@@ -0,0 +1,221 @@
+"""
+Segmented tracking, with caching of the particles at segment boundaries.
+
+The beamline is split at boundary z positions. Each segment is tracked from the
+particles at the previous boundary, and the particles at its end are cached,
+keyed by everything upstream of the boundary that can change them.
+A run whose upstream input is unchanged resumes from the deepest cached boundary.
+
+Example:
+    cache = SegmentCache()
+    for x in values:
+        A['solenoid:maxb(2)'] = x  # Downstream of z=1.5
+        A.run_segmented([0.5, 1.5], cache=cache)
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import re
+
+import numpy as np
+from lume import tools as lumetools
+
+from .evaluate_cache import file_identity
+from .fieldmaps import fieldmap_data, file_, load_fieldmap
+
+# Output control: set for each segment, and not part of any key.
+OUTPUT_CONTROL_KEYS = ('zstop', 'zphase', 'zemit', 'phases', 'distribution')
+
+# Elements with fields. A segment must not start inside these.
+FIELD_SECTIONS = ('cavity', 'solenoid', 'quadrupole')
+
+INDEXED_KEY_RE = re.compile(r'^(\w+)\((\d+)(?:,\s*\d+)?\)$')
+
+
+class SegmentCache:
+    """
+    In-memory LRU cache of segment results, by key.
+
+    For a cache on disk, use astra.evaluate_cache.EvaluateCache, which has the same interface.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of entries. Default: 32
+
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(maxsize={self.maxsize}, n={len(self)})'
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Returns the entry for a key, or None.
+        """
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, entry):
+        """
+        Stores an entry, then evicts the least recently used entries if needed.
+        """
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def element_z_ranges(astra_input, fieldmaps={}):
+    """
+    Finds the z range of each indexed element in an Astra input dict.
+
+    Ranges are known for:
+        cavity, solenoid : from the fieldmap and its position (1D fieldmaps only)
+        quadrupole : from q_pos and q_length
+        aperture : from ap_z1 and ap_z2
+
+    Returns a dict of (section, index): (zmin, zmax), or None if the range is unknown.
+    """
+    # Fieldmaps that are not loaded are parsed once here
+    fieldmaps = dict(fieldmaps)
+    ranges = {}
+    for section, nl in astra_input.items():
+        indices = set()
+        for key in nl:
+            m = INDEXED_KEY_RE.match(key)
+            if m:
+                indices.add(int(m.group(2)))
+
+        for ix in indices:
+            ranges[(section, ix)] = _element_z_range(astra_input, section, ix, fieldmaps)
+
+    return ranges
+
+
+def _element_z_range(astra_input, section, ix, fieldmaps):
+    nl = astra_input[section]
+    try:
+        if section in ('cavity', 'solenoid'):
+            file = nl[file_(section, ix)]
+            if file not in fieldmaps and not os.path.basename(file).lower().startswith('3d_'):
+                fieldmaps[file] = load_fieldmap(file)
+            dat = fieldmap_data(astra_input, section=section, index=ix, fieldmaps=fieldmaps)
+            if dat is None:
+                return None
+            return float(dat[:, 0].min()), float(dat[:, 0].max())
+        elif section == 'quadrupole':
+            z, L = nl[f'q_pos({ix})'], nl[f'q_length({ix})']
+            return z - L / 2, z + L / 2
+        elif section == 'aperture':
+            return nl[f'ap_z1({ix})'], nl[f'ap_z2({ix})']
+    except (KeyError, OSError, ValueError):
+        pass
+    return None
+
+
+def elements_at(ranges, z, sections=FIELD_SECTIONS):
+    """
+    Elements of these sections whose known z range has z inside it (not at its ends).
+
+    Returns a list of (section, index)
+    """
+    return sorted(k for k, r in ranges.items() if k[0] in sections and r is not None and r[0] < z < r[1])
+
+
+def upstream_input(astra_input, z, fieldmaps={}, ranges=None):
+    """
+    Returns the part of an Astra input dict that can change the particles at z.
+
+    This includes all non-indexed settings, except for output control,
+    and all elements that start before z, or whose range is unknown.
+
+    Values that are existing files are replaced by their identity (path, size, mtime).
+    """
+    if ranges is None:
+        ranges = element_z_ranges(astra_input, fieldmaps)
+
+    upstream = {}
+    for section, nl in astra_input.items():
+        d = upstream[section] = {}
+        for key, val in nl.items():
+            if key in OUTPUT_CONTROL_KEYS:
+                continue
+            m = INDEXED_KEY_RE.match(key)
+            if m:
+                if section == 'output' and m.group(1) == 'screen':
+                    continue
+                r = ranges.get((section, int(m.group(2))))
+                if r is not None and r[0] >= z:
+                    continue
+            if isinstance(val, str) and os.path.isfile(val):
+                val = file_identity(val)
+            d[key] = val
+    return upstream
+
+
+def particle_fingerprint(particles):
+    """
+    Fingerprint of the data in a ParticleGroup.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(particles.species.encode())
+    for key in sorted(particles.data):
+        val = particles.data[key]
+        if isinstance(val, np.ndarray):
+            h.update(key.encode())
+            h.update(np.ascontiguousarray(val).tobytes())
+    return h.hexdigest()
+
+
+def segment_key(astra_object, z, ranges=None):
+    """
+    Key for the particles at z, from the upstream input, the initial particles or distribution,
+    and the Astra binary.
+    """
+    d = {}
+    d['z'] = z
+    d['input'] = upstream_input(astra_object.input, z, fieldmaps=astra_object.fieldmap, ranges=ranges)
+    if astra_object.initial_particles:
+        d['initial_particles'] = particle_fingerprint(astra_object.initial_particles)
+    else:
+        dist = astra_object.input['newrun'].get('distribution', '')
+        d['distribution'] = file_identity(dist) if dist else ''
+    d['command'] = file_identity(astra_object.command)
+    return lumetools.fingerprint(d)
+
+
+def concatenate_stats(stats_list, z_key='mean_z'):
+    """
+    Concatenates the stats dicts of consecutive segments.
+
+    Rows of a segment that are not beyond the last z of the previous segments are dropped,
+    so the boundary is not repeated.
+    """
+    stats_list = [s for s in stats_list if s and z_key in s]
+    if not stats_list:
+        return {}
+
+    keys = [k for k in stats_list[0] if all(k in s for s in stats_list)]
+    out = {k: [stats_list[0][k]] for k in keys}
+    zlast = stats_list[0][z_key][-1] if len(stats_list[0][z_key]) else -np.inf
+    for s in stats_list[1:]:
+        keep = s[z_key] > zlast
+        for k in keys:
+            out[k].append(s[k][keep])
+        if keep.any():
+            zlast = s[z_key][keep][-1]
+
+    return {k: np.concatenate(v) for k, v in out.items()}
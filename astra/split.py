@@ -0,0 +1,159 @@
+"""
+Parallel tracking of independent particles.
+
+Without space charge, particles do not interact, so a distribution can be split into
+chunks and tracked in separate Astra processes. All chunks share the reference particle
+of the full distribution, so they see the same phasing and the same output z positions.
+The particles at each output are then merged, and the stats are computed from them.
+
+Each chunk also tracks and counts its copy of the reference particle, so sum_landf removes
+the extra copies from the summed LandF particle count and charge.
+"""
+
+import os
+
+import numpy as np
+
+from . import parsers
+
+# Stats to compute from the merged particles, when ParticleGroup has them. See: particles.particle_stats_table
+# norm_emit_z is not a ParticleGroup key. See: norm_emit_z
+PARTICLE_STAT_KEYS = [
+    'mean_z', 'mean_t',
+    'mean_x', 'sigma_x', 'norm_emit_x',
+    'mean_y', 'sigma_y', 'norm_emit_y',
+    'mean_kinetic_energy', 'sigma_z', 'sigma_energy',
+]
+
+
+def space_charge_off(astra_input):
+    """
+    True if an Astra input dict has both lspch and lspch3d off.
+
+    Astra turns space charge on by default, so a missing lspch means on.
+    """
+    charge = astra_input.get('charge', {})
+    return not charge.get('lspch', True) and not charge.get('lspch3d', False)
+
+
+def split_astra_particle_file(filePath, n_chunks, path=None):
+    """
+    Splits an Astra particle file into n_chunks files that share its reference particle (first line).
+
+    Parameters
+    ----------
+    filePath : str
+        Astra particle file.
+    n_chunks : int
+        Number of files to write. This is reduced if there are fewer particles.
+    path : str, optional
+        Directory to write the files in. Default: the directory of filePath
+
+    Returns
+    -------
+    files : list of str
+
+    """
+    if path is None:
+        path = os.path.dirname(os.path.abspath(filePath))
+
+    with open(filePath) as f:
+        lines = f.readlines()
+    ref, particles = lines[0], lines[1:]
+
+    n_chunks = max(min(n_chunks, len(particles)), 1)
+    bounds = np.linspace(0, len(particles), n_chunks + 1).astype(int)
+
+    name = os.path.basename(filePath)
+    files = []
+    for i in range(n_chunks):
+        fname = os.path.join(path, f'{name}.chunk{i}')
+        with open(fname, 'w') as f:
+            f.write(ref)
+            f.writelines(particles[bounds[i]:bounds[i + 1]])
+        files.append(fname)
+    return files
+
+
+def reference_particle_charge(filePath):
+    """
+    Charge of the reference particle (first line) of an Astra particle file,
+    in the units of landf_total_charge (C).
+    """
+    with open(filePath) as f:
+        ref = f.readline().split()
+    return float(ref[7]) * parsers.LandFColumnFactors[2]
+
+
+def norm_emit_z(particle_group):
+    """
+    Longitudinal emittance of the alive particles, as Astra writes it to Zemit:
+        sqrt(<dz^2><dE^2> - <dz dE>^2)
+    in m*eV, with charge-weighted averages.
+    """
+    P = particle_group
+    alive = P.status == 1
+    if not alive.all():
+        P = P.where(alive)
+    if len(P) == 0:
+        return np.nan
+    w = P.weight
+    dz = P.z - np.average(P.z, weights=w)
+    dE = P.energy - np.average(P.energy, weights=w)
+    det = np.average(dz**2, weights=w) * np.average(dE**2, weights=w) - np.average(dz * dE, weights=w)**2
+    return np.sqrt(max(det, 0))
+
+
+def merge_particle_lists(particle_lists):
+    """
+    Merges lists of ParticleGroups, one list per chunk, output by output.
+
+    Returns a list of ParticleGroup
+    """
+    n = {len(plist) for plist in particle_lists}
+    if len(n) != 1:
+        raise ValueError(f'Chunks have different numbers of particle outputs: {sorted(n)}')
+
+    merged = []
+    for groups in zip(*particle_lists):
+        P = groups[0]
+        for P2 in groups[1:]:
+            P = P + P2
+        merged.append(P)
+    return merged
+
+
+def sum_landf(others, ref_charge=None):
+    """
+    Sums the LandF tables of chunks. Returns {} if their z positions differ.
+
+    Parameters
+    ----------
+    others : list of dict
+        .output['other'] of each chunk.
+    ref_charge : float, optional
+        Charge of the reference particle in C, see: reference_particle_charge.
+        If given, the chunks are taken to share one reference particle, and all but one
+        copy of it are removed from landf_n_particles and landf_total_charge.
+
+    Returns
+    -------
+    dict
+
+    """
+    others = [o for o in others if o]
+    if not others:
+        return {}
+    z = others[0]['landf_z']
+    if any(len(o['landf_z']) != len(z) or not np.allclose(o['landf_z'], z) for o in others):
+        return {}
+
+    total = {'landf_z': z}
+    for key in parsers.LandFColumnNames[1:]:
+        total[key] = np.sum([o[key] for o in others], axis=0)
+
+    if ref_charge is not None:
+        n_extra = len(others) - 1
+        total['landf_n_particles'] = total['landf_n_particles'] - n_extra
+        total['landf_total_charge'] = total['landf_total_charge'] - n_extra * ref_charge
+    return total
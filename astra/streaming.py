@@ -0,0 +1,306 @@
+"""
+Statistics of phase space files, streamed in chunks.
+
+The particles of a file are parsed a chunk at a time, and weighted moments are
+accumulated, so memory is bounded by the chunk size rather than the number of particles.
+The results are the same as the ParticleGroup statistics of the whole file.
+
+Example:
+    stats = stream_phase_file_stats('astra.0100.001', ['sigma_x', 'norm_emit_x', 'higher_order_energy_spread'])
+"""
+
+import re
+
+import numpy as np
+from pmd_beamphysics import ParticleGroup
+from pmd_beamphysics.units import c_light
+
+from .particles import iter_phase_file_chunks
+
+STAT_RE = re.compile(r'^(mean|sigma|min|max|ptp)_(.+)$')
+COV_RE = re.compile(r'^cov_(.+)__(.+)$')
+
+# Emittance key: planes
+NORM_EMIT_PLANES = {'norm_emit_x': ['x'], 'norm_emit_y': ['y'], 'norm_emit_4d': ['x', 'y']}
+
+# Keys that are the same for every particle
+CONSTANT_KEYS = ('mass', 'species', 'species_charge')
+
+
+class StreamingStats:
+    """
+    Accumulates ParticleGroup statistics over chunks of particles.
+
+    Supported keys:
+        mean_<key>, sigma_<key>, min_<key>, max_<key>, ptp_<key>, cov_<key1>__<key2>
+        norm_emit_x, norm_emit_y, norm_emit_4d
+        higher_order_energy_spread
+        charge, n_particle, mass, species, species_charge
+        n_alive, n_dead, with the Astra convention of Astra.particle_stat (status > -6, status < -6)
+    where <key> is any particle array of ParticleGroup: x, px, energy, kinetic_energy, ...
+
+    Parameters
+    ----------
+    keys : list of str
+    alive_only : bool, optional
+        Only use particles with status == 1 (except for n_alive and n_dead). Default: True
+    histograms : dict, optional
+        Weighted histograms to accumulate, as key: bin edges.
+        See: .histogram
+
+    """
+
+    def __init__(self, keys, alive_only=True, histograms=None):
+        self.keys = list(keys)
+        self.alive_only = alive_only
+        self.histogram_edges = {k: np.asarray(v, dtype=float) for k, v in (histograms or {}).items()}
+
+        names = []
+        self._minmax = []
+        for key in self.keys:
+            if key in ('higher_order_energy_spread',):
+                names += ['z', 'energy']
+            elif key in NORM_EMIT_PLANES:
+                for plane in NORM_EMIT_PLANES[key]:
+                    names += [plane, 'p' + plane]
+            elif COV_RE.match(key):
+                names += list(COV_RE.match(key).groups())
+            elif STAT_RE.match(key):
+                op, name = STAT_RE.match(key).groups()
+                if op in ('min', 'max', 'ptp'):
+                    self._minmax.append(name)
+                else:
+                    names.append(name)
+            elif key not in ('charge', 'n_particle', 'n_alive', 'n_dead') + CONSTANT_KEYS:
+                raise ValueError(f'Cannot stream the statistic: {key}')
+        self.names = list(dict.fromkeys(names))
+        self._minmax = list(dict.fromkeys(self._minmax))
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+        k = len(self.names)
+        self.n = 0
+        self.n_alive = 0
+        self.n_dead = 0
+        self.weight = 0.0  # Sum of weights
+        self.weight2 = 0.0  # Sum of squared weights, for the covariance normalization of np.cov
+        self.mean = np.zeros(k)
+        self.comoment = np.zeros((k, k))  # sum w (a - mean_a)(b - mean_b)
+        self.min = {name: np.inf for name in self._minmax}
+        self.max = {name: -np.inf for name in self._minmax}
+        self.histograms = {name: np.zeros(len(edges) - 1) for name, edges in self.histogram_edges.items()}
+        self.constants = {}
+
+        self._energy_fit = None
+        if 'higher_order_energy_spread' in self.keys:
+            self._energy_fit = {'t': _PolyFitSums(), 'z': _PolyFitSums()}
+
+    def update(self, particle_group):
+        """
+        Adds a chunk of particles.
+        """
+        P = particle_group
+        status = P.status
+        self.n_alive += int(np.count_nonzero(status > -6))
+        self.n_dead += int(np.count_nonzero(status < -6))
+
+        if self.alive_only and np.any(status != 1):
+            P = P.where(status == 1)
+
+        n = len(P)
+        if n == 0:
+            return
+        if not self.constants:
+            self.constants = {k: P[k] for k in CONSTANT_KEYS}
+
+        w = P.weight
+        wb = w.sum()
+        self.n += n
+        self.weight2 += np.dot(w, w)
+
+        # Chan et al. pairwise update of the mean and co-moments
+        if self.names:
+            X = np.array([P[name] for name in self.names])
+            mb = X @ w/wb
+            D = X - mb[:, None]
+            Cb = (D*w) @ D.T
+            del X, D
+            wa = self.weight
+            delta = mb - self.mean
+            self.mean = self.mean + delta*wb/(wa + wb)
+            self.comoment = self.comoment + Cb + np.outer(delta, delta)*wa*wb/(wa + wb)
+        self.weight += wb
+
+        for name in self._minmax:
+            dat = P[name]
+            self.min[name] = min(self.min[name], np.min(dat))
+            self.max[name] = max(self.max[name], np.max(dat))
+
+        for name, edges in self.histogram_edges.items():
+            self.histograms[name] += np.histogram(P[name], bins=edges, weights=w)[0]
+
+        if self._energy_fit is not None:
+            energy = P.energy
+            self._energy_fit['t'].update(P.t, energy, w)
+            self._energy_fit['z'].update(P.z/c_light, energy, w)
+
+    def histogram(self, key):
+        """
+        Returns the weighted histogram of a key, and its bin edges.
+        """
+        return self.histograms[key], self.histogram_edges[key]
+
+    def cov(self, *keys):
+        """
+        Covariance matrix of keys, normalized as in ParticleGroup.cov (np.cov with aweights).
+        """
+        ix = [self._index[k] for k in keys]
+        return self.comoment[np.ix_(ix, ix)]/(self.weight - self.weight2/self.weight)
+
+    def stat(self, key):
+        """
+        Returns a statistic from the particles so far.
+        """
+        if key == 'n_alive':
+            return self.n_alive
+        if key == 'n_dead':
+            return self.n_dead
+        if key == 'n_particle':
+            return self.n
+        if key == 'charge':
+            return self.weight
+        if key in CONSTANT_KEYS:
+            return self.constants.get(key)
+
+        if self.n == 0:
+            return np.nan
+
+        if key in NORM_EMIT_PLANES:
+            planes = NORM_EMIT_PLANES[key]
+            names = [name for plane in planes for name in (plane, 'p' + plane)]
+            return np.sqrt(np.linalg.det(self.cov(*names)))/self.constants['mass']**len(planes)
+
+        if key == 'higher_order_energy_spread':
+            # As ParticleGroup.higher_order_energy_calc: fit energy against t at a screen, otherwise z/c
+            sigma_z = np.sqrt(self.comoment[self._index['z'], self._index['z']]/self.weight)
+            return self._energy_fit['t' if sigma_z < 1e-12 else 'z'].residual_std()
+
+        m = COV_RE.match(key)
+        if m:
+            return self.cov(*m.groups())[0, 1]
+
+        op, name = STAT_RE.match(key).groups()
+        if op == 'mean':
+            return self.mean[self._index[name]]
+        if op == 'sigma':
+            i = self._index[name]
+            return np.sqrt(self.comoment[i, i]/self.weight)
+        if op == 'min':
+            return self.min[name]
+        if op == 'max':
+            return self.max[name]
+        return self.max[name] - self.min[name]
+
+    def result(self):
+        """
+        Returns a dict of key: statistic
+        """
+        return {key: self.stat(key) for key in self.keys}
+
+
+class _PolyFitSums:
+    """
+    Sums for a quadratic least squares fit of y(x), as np.polynomial.Polynomial.fit,
+    and the weighted standard deviation of its residual.
+
+    x and y are shifted and scaled by the first chunk, for conditioning.
+    """
+
+    def __init__(self):
+        self.x0 = None
+        self.sx = 1.0
+        self.y0 = 0.0
+        self.xk = np.zeros(5)  # sum x^k
+        self.xky = np.zeros(3)  # sum x^k y
+        self.wxk = np.zeros(5)  # sum w x^k
+        self.wxky = np.zeros(3)  # sum w x^k y
+        self.wy2 = 0.0  # sum w y^2
+
+    def update(self, x, y, w):
+        if self.x0 is None:
+            self.x0 = np.mean(x)
+            self.sx = np.std(x) or 1.0
+            self.y0 = np.mean(y)
+        u = (x - self.x0)/self.sx
+        v = y - self.y0
+        uk = [np.ones_like(u), u, u*u, u*u*u, u*u*u*u]
+        for k in range(5):
+            self.xk[k] += uk[k].sum()
+            self.wxk[k] += np.dot(w, uk[k])
+        for k in range(3):
+            self.xky[k] += np.dot(uk[k], v)
+            self.wxky[k] += np.dot(w*uk[k], v)
+        self.wy2 += np.dot(w*v, v)
+
+    def residual_std(self):
+        A = np.array([[self.xk[i + j] for j in range(3)] for i in range(3)])
+        a = np.linalg.lstsq(A, self.xky, rcond=None)[0]
+        W = self.wxk[0]
+        mean_r = (self.wxky[0] - a @ self.wxk[:3])/W
+        B = np.array([[self.wxk[i + j] for j in range(3)] for i in range(3)])
+        mean_r2 = (self.wy2 - 2*a @ self.wxky + a @ B @ a)/W
+        return np.sqrt(max(mean_r2 - mean_r**2, 0))
+
+
+def stream_phase_file_stats(filePath, keys, chunk_size=1_000_000, alive_only=True, histograms=None):
+    """
+    Computes statistics of an Astra phase space file, parsing chunk_size particles at a time.
+
+    Parameters
+    ----------
+    filePath : str
+    keys : list of str
+        See: StreamingStats
+    chunk_size : int, optional
+        Particles per chunk. Default: 1_000_000
+    alive_only : bool, optional
+        Only use particles with status == 1, as Astra.particle_stat. Default: True
+    histograms : dict, optional
+        key: bin edges, or key: (bins, (min, max)).
+        Given only a number of bins, the range is found with an extra pass over the file.
+
+    Returns
+    -------
+    dict of key: statistic, and histogram_<key>: (histogram, edges) for each histogram
+
+    """
+    edges = {}
+    if histograms:
+        need_range = [k for k, v in histograms.items() if np.isscalar(v)]
+        ranges = {}
+        if need_range:
+            S = stream_stats(filePath, [f'{op}_{k}' for k in need_range for op in ('min', 'max')],
+                             chunk_size=chunk_size, alive_only=alive_only)
+            ranges = {k: (S.stat(f'min_{k}'), S.stat(f'max_{k}')) for k in need_range}
+        for k, v in histograms.items():
+            if np.isscalar(v):
+                edges[k] = np.histogram_bin_edges([], bins=v, range=ranges[k])
+            elif len(v) == 2 and np.isscalar(v[0]):
+                edges[k] = np.histogram_bin_edges([], bins=v[0], range=v[1])
+            else:
+                edges[k] = np.asarray(v, dtype=float)
+
+    S = stream_stats(filePath, keys, chunk_size=chunk_size, alive_only=alive_only, histograms=edges)
+    result = S.result()
+    for k in edges:
+        result[f'histogram_{k}'] = S.histogram(k)
+    return result
+
+
+def stream_stats(filePath, keys, chunk_size=1_000_000, alive_only=True, histograms=None):
+    """
+    Accumulates a StreamingStats over the chunks of an Astra phase space file.
+    """
+    S = StreamingStats(keys, alive_only=alive_only, histograms=histograms)
+    for data in iter_phase_file_chunks(filePath, chunk_size=chunk_size):
+        S.update(ParticleGroup(data=data))
+    return S
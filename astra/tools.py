@@ -1,11 +1,15 @@
+import asyncio
 import datetime
 import errno
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
 import traceback
 
-def execute(cmd, cwd=None):
+def execute(cmd, cwd=None, usage=None):
     """
     
     Constantly print Subprocess output while process is running
@@ -17,6 +21,9 @@ def execute(cmd, cwd=None):
         
     Useful in Jupyter notebook
     
+    If a usage dict is given, it will be filled with the resource usage of the process.
+    See: wait_process
+    
     """
     popen = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, cwd=cwd)
     if os.name == 'nt':
@@ -28,27 +35,42 @@ def execute(cmd, cwd=None):
         yield stdout_line
     popen.stdin.close()
     popen.stdout.close()
-    return_code = popen.wait()
+    return_code = wait_process(popen, usage=usage)
     if return_code:
         raise subprocess.CalledProcessError(return_code, cmd)
 
 
 # Alternative execute
-def execute2(cmd, timeout=None, cwd=None):
+def execute2(cmd, timeout=None, cwd=None, poll=None, poll_interval=1.0):
     """
     Execute with time limit (timeout) in seconds, catching run errors. 
+    
+    If a poll function is given, it is called every poll_interval seconds while the process runs.
+    If it returns a non-empty string, the process is killed, and this string is returned as why_error.
+    
+    The resource usage of the process is returned in output['usage']. See: wait_process
     """
 
-    output = {'error': True, 'log': ''}
+    output = {'error': True, 'log': '', 'usage': {}}
+    lines = []
     try:
-        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
-                           timeout=timeout, cwd=cwd)
-        output['log'] = p.stdout
-        output['error'] = False
-        output['why_error'] = ''
-    except subprocess.TimeoutExpired as ex:
-        output['log'] = ex.stdout + '\n' + str(ex)
-        output['why_error'] = 'timeout'
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                             cwd=cwd)
+        # Read in a thread, so that the pipe never fills up
+        reader = threading.Thread(target=_read_lines, args=(p.stdout, lines), daemon=True)
+        reader.start()
+        
+        why_error = _wait(p, timeout=timeout, poll=poll, poll_interval=poll_interval, usage=output['usage'])
+        
+        reader.join()
+        output['log'] = ''.join(lines)
+        if why_error == 'timeout':
+            output['log'] += '\n' + f"Command '{cmd}' timed out after {timeout} seconds"
+        elif why_error:
+            output['log'] += '\n' + f"Command '{cmd}' killed: {why_error}"
+        else:
+            output['error'] = False
+        output['why_error'] = why_error
     except:
         #exc_tuple = sys.exc_info()
         error_str = traceback.format_exc()         
@@ -57,6 +79,283 @@ def execute2(cmd, timeout=None, cwd=None):
     return output
 
 
+def _read_lines(stream, lines):
+    for line in iter(stream.readline, ""):
+        lines.append(line)
+    stream.close()
+
+
+def _wait(p, timeout=None, poll=None, poll_interval=1.0, usage=None):
+    """
+    Waits for a Popen process to finish, calling poll() every poll_interval seconds.
+    
+    Kills the process on timeout, or when poll() returns a non-empty string. 
+    
+    Returns why_error: '' if the process finished, 'timeout', or the string from poll().
+    """
+    t0 = time.time()
+    while True:
+        step = poll_interval if poll else None
+        if timeout is not None:
+            remaining = max(timeout - (time.time() - t0), 0)
+            step = remaining if step is None else min(step, remaining)
+        try:
+            wait_process(p, timeout=step, usage=usage)
+            return ''
+        except subprocess.TimeoutExpired:
+            pass
+        
+        if timeout is not None and time.time() - t0 >= timeout:
+            why_error = 'timeout'
+        elif poll:
+            why_error = poll()
+        else:
+            why_error = ''
+            
+        if why_error:
+            kill_process(p)
+            wait_process(p, usage=usage)
+            return why_error
+
+
+def kill_process(p):
+    """
+    Kills a Popen or asyncio process.
+
+    Where os.wait4 is available, the signal is sent with os.kill: p.kill() polls, 
+    and could reap the process before wait_process gets its resource usage.
+    Until it is reaped, the pid of the process is not reused.
+    """
+    try:
+        if hasattr(os, 'wait4') and isinstance(p, subprocess.Popen) and p.returncode is None:
+            os.kill(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except ProcessLookupError:
+        pass
+
+
+def wait_process(p, timeout=None, usage=None):
+    """
+    Waits for a Popen process, like p.wait(timeout), and returns its return code.
+    
+    Where available (not Windows), the process is reaped with os.wait4, 
+    and the usage dict is filled with its resource usage:
+        cpu_user_time : user CPU time (s)
+        cpu_system_time : system CPU time (s)
+        max_rss : peak resident set size (bytes)
+    
+    These include any children of the process that it has waited for.
+    """
+    if not hasattr(os, 'wait4') or p.returncode is not None:
+        return p.wait(timeout=timeout)
+    
+    if timeout is None:
+        pid, status, ru = _wait4(p.pid, 0)
+    else:
+        # Same polling as Popen.wait with a timeout
+        endtime = time.monotonic() + timeout
+        delay = 0.0005
+        while True:
+            pid, status, ru = _wait4(p.pid, os.WNOHANG)
+            if pid:
+                break
+            remaining = endtime - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(p.args, timeout)
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+    
+    if pid < 0:
+        # Reaped elsewhere
+        return p.wait()
+    
+    p.returncode = _exit_code(status)
+    if usage is not None:
+        usage.update(rusage_dict(ru))
+    return p.returncode
+
+
+def _wait4(pid, options):
+    while True:
+        try:
+            return os.wait4(pid, options)
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            return -1, 0, None
+    
+
+def _exit_code(status):
+    """Return code from a wait status, as in subprocess"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def rusage_dict(ru):
+    """
+    Dict of CPU times in s, and max_rss in bytes, from a resource.struct_rusage
+    """
+    # ru_maxrss is in kilobytes, except on macOS
+    rss_factor = 1 if sys.platform == 'darwin' else 1024
+    return {'cpu_user_time': ru.ru_utime,
+            'cpu_system_time': ru.ru_stime,
+            'max_rss': ru.ru_maxrss * rss_factor}
+
+
+def file_stat(path):
+    """
+    (size, mtime_ns) of a file, not following symlinks, or None if it does not exist.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def dir_file_stats(path):
+    """
+    Dict of name: (size, mtime_ns) of the regular files in path. Symlinks are skipped.
+    """
+    d = {}
+    for item in os.scandir(path):
+        if item.is_file(follow_symlinks=False):
+            st = item.stat(follow_symlinks=False)
+            d[item.name] = (st.st_size, st.st_mtime_ns)
+    return d
+
+
+def dir_file_changes(before, after):
+    """
+    Compares two dir_file_stats.
+    
+    Returns a dict with:
+        bytes_written : total size of the new and changed files 
+        n_output_files : number of new and changed files
+    """
+    bytes_written = 0
+    n_files = 0
+    for name, stat in after.items():
+        if before.get(name) != stat:
+            n_files += 1
+            bytes_written += stat[0]
+    return {'bytes_written': bytes_written, 'n_output_files': n_files}
+
+
+async def execute_async(cmd, timeout=None, cwd=None):
+    """
+    asyncio version of execute2, using asyncio.create_subprocess_exec.
+
+    Returns the same output dict as execute2.
+
+    Where available (not Windows), the process is started with subprocess.Popen instead,
+    and reaped with os.wait4 once it has exited, so that output['usage'] has its resource usage.
+    No thread is held while the process runs. See: wait_process_async
+
+    The timeout counts from the start of the process.
+
+    If the calling task is cancelled, the process is killed before the
+    cancellation is propagated.
+    """
+    output = {'error': True, 'log': '', 'usage': {}}
+    lines = []
+    loop = asyncio.get_running_loop()
+    transport = None
+
+    if hasattr(os, 'wait4'):
+        # Not an asyncio subprocess: its child watcher would reap the process without usage
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                cwd=cwd)
+        proc.stdin.close()
+        done = asyncio.ensure_future(wait_process_async(proc, usage=output['usage']))
+        stdout = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout), proc.stdout)
+    else:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT,
+                                                    cwd=cwd)
+        if os.name == 'nt':
+            # When running Astra with Windows it requires us to Press return at the end of execution
+            proc.stdin.write(b"\n")
+        proc.stdin.close()
+        stdout = proc.stdout
+        done = asyncio.ensure_future(proc.wait())
+
+    async def read_stdout():
+        async for line in stdout:
+            lines.append(line.decode())
+
+    try:
+        # Shielded, so that the process is always waited for, also after a kill
+        await asyncio.wait_for(asyncio.gather(read_stdout(), asyncio.shield(done)), timeout)
+        output['log'] = ''.join(lines)
+        output['error'] = False
+        output['why_error'] = ''
+    except asyncio.TimeoutError:
+        await _kill_async(proc, done)
+        output['log'] = ''.join(lines) + '\n' + f"Command '{cmd}' timed out after {timeout} seconds"
+        output['why_error'] = 'timeout'
+    except asyncio.CancelledError:
+        await _kill_async(proc, done)
+        raise
+    finally:
+        if transport is not None:
+            transport.close()
+
+    return output
+
+
+async def wait_process_async(p, usage=None):
+    """
+    Waits for a Popen process without blocking the event loop, and returns its return code.
+
+    On Linux, the exit is signalled by a pidfd that the event loop watches. Elsewhere, 
+    the process is polled. It is then reaped with wait_process, which fills the usage dict.
+    """
+    loop = asyncio.get_running_loop()
+    pidfd = None
+    if hasattr(os, 'pidfd_open') and p.returncode is None:
+        try:
+            pidfd = os.pidfd_open(p.pid)
+        except OSError:
+            pass
+    if pidfd is not None:
+        exited = loop.create_future()
+        try:
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        except NotImplementedError:
+            # Event loop without add_reader: poll
+            os.close(pidfd)
+        else:
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+
+    delay = 0.0005
+    while True:
+        try:
+            return wait_process(p, timeout=0, usage=usage)
+        except subprocess.TimeoutExpired:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+async def _kill_async(proc, done):
+    """
+    Kills a process, if it is still running, and waits for it.
+
+    done is the future of its wait.
+    """
+    if not done.done():
+        kill_process(proc)
+    await done
+
+
 def runs_script(runscript=[], dir=None, log_file=None, verbose=True):
     """
     Basic driver for running a script in a directory. Will     
@@ -142,8 +441,10 @@ def make_symlink(src, path):
     
     dest = os.path.join(path, file)
     
-    # Replace old symlinks. 
+    # Replace old symlinks. Keep identical ones.
     if os.path.islink(dest):
+        if os.readlink(dest) == src:
+            return True
         os.unlink(dest)
     elif os.path.exists(dest):
         return False
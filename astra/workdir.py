@@ -0,0 +1,159 @@
+"""
+Reusable work directories for many Astra runs.
+
+Creating and removing a temporary directory, and its symlinks, for every run
+adds up over large scans. A WorkdirPool creates directories once, optionally
+on tmpfs (/dev/shm), and leases them to Astra objects.
+
+Example:
+    pool = WorkdirPool(use_shm=True)
+    pool.stage(A0.input) # Pre-make fieldmap symlinks in every directory
+
+    for x in values:
+        A = Astra(input_file, workdir_pool=pool)
+        ...
+        A.run()
+        A.release_workdir() # Or let A be garbage collected
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+from .fieldmaps import fieldmap3d_filenames
+from .writers import make_namelist_symlinks
+
+SHM_PATH = '/dev/shm'
+
+
+class WorkdirPool:
+    """
+    Pool of reusable work directories.
+
+    Directories are created lazily, on the first lease that finds no free directory.
+    On release, a directory is scrubbed of everything except its staged symlinks.
+
+    Parameters
+    ----------
+    root : str, optional
+        Directory to create the work directories in. Default: the system temp dir,
+        or /dev/shm if use_shm.
+    use_shm : bool, optional
+        Use /dev/shm (tmpfs) as the root, if it exists. Default: False
+    prefix : str, optional
+        Prefix for the directory names. Default: 'astra_'
+
+    """
+
+    def __init__(self, root=None, use_shm=False, prefix='astra_'):
+        if root is None and use_shm and os.path.isdir(SHM_PATH):
+            root = SHM_PATH
+
+        self.root = root
+        self.prefix = prefix
+
+        self._free = []
+        self._leased = set()
+        self._all = []
+        self._staged_input = []
+        self._staged_names = set()
+        self._lock = threading.Lock()
+
+        # Remove all directories when the pool goes away
+        self._finalizer = weakref.finalize(self, _remove_dirs, self._all)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(root={self.root!r}, n_dirs={len(self._all)}, n_leased={len(self._leased)})'
+
+    def __len__(self):
+        return len(self._all)
+
+    def __copy__(self):
+        # Copies of Astra objects share the pool
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def lease(self):
+        """
+        Returns the path of a free work directory, creating one if needed.
+        """
+        with self._lock:
+            if self._free:
+                path = self._free.pop()
+            else:
+                path = tempfile.mkdtemp(prefix=self.prefix, dir=self.root)
+                self._all.append(path)
+                for astra_input in self._staged_input:
+                    self._stage_path(astra_input, path)
+            self._leased.add(path)
+        return path
+
+    def release(self, path):
+        """
+        Scrubs a leased directory and returns it to the pool.
+
+        Paths that are not currently leased are ignored.
+        """
+        with self._lock:
+            if path not in self._leased:
+                return
+            self._leased.remove(path)
+
+        self.scrub(path)
+
+        with self._lock:
+            self._free.append(path)
+
+    def scrub(self, path):
+        """
+        Removes everything in path, except the staged symlinks.
+        """
+        for item in os.scandir(path):
+            if item.is_symlink():
+                if item.name not in self._staged_names:
+                    os.unlink(item.path)
+            elif item.is_dir():
+                shutil.rmtree(item.path)
+            else:
+                os.remove(item.path)
+
+    def stage(self, astra_input):
+        """
+        Makes the symlinks for the files in an Astra input dict (fieldmaps, 3D fieldmaps, etc.)
+        in all current and future directories.
+
+        These symlinks are kept when directories are scrubbed.
+        """
+        # See: writers.write_namelists
+        if os.name == 'nt':
+            return
+
+        astra_input = {name: dict(nl) for name, nl in astra_input.items()}
+        with self._lock:
+            self._staged_input.append(astra_input)
+            for path in self._all:
+                self._stage_path(astra_input, path)
+
+    def _stage_path(self, astra_input, path):
+        for namelist in astra_input.values():
+            replacements = make_namelist_symlinks(namelist, path, prefixes=('file_',))
+            for key, file in replacements.items():
+                if file.lower().startswith('3d_'):
+                    self._staged_names.update(os.path.basename(f) for f in fieldmap3d_filenames(namelist[key]))
+                else:
+                    self._staged_names.add(file)
+
+    def close(self):
+        """
+        Removes all directories.
+        """
+        self._finalizer()
+
+
+def _remove_dirs(paths):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
@@ -21,36 +21,140 @@ def namelist_lines(namelist_dict, name):
     
     
     for key, value in namelist_dict.items():
-        #if type(value) == type(1) or type(value) == type(1.): # numbers
-
-        if isinstance(value, Number): # numbers
-            line= key + ' = ' + str(value) 
-        elif type(value) == type([]) or isinstance(value, np.ndarray): # lists or np arrays
-            liststr = ''
-            # Special case for dipole Double Complex items
-            if key.upper() in ('D1', 'D2', 'D3', 'D4'):
-                for item in value:
-                    liststr = liststr + str(item) + ','
-                line = key + ' = ' + "(" + liststr[:-1] + ")"
-            else:
-                for item in value:
-                    liststr += str(item) + ' '
-                line = key + ' = ' + liststr 
-        elif type(value) == type('a'): # strings
-            line = key + ' = ' + "'" + value.strip("''") + "'"  # input may need apostrophes
-       
-        elif bool(value) == value:
-            line= key + ' = ' + str(value) 
-        else:
-            #print 'skipped: key, value = ', key, value
-            raise ValueError(f'Problem writing input key: {key}, value: {value}, type: {type(value)}')
-           
-        lines.append(line)
+        lines.append(namelist_line(key, value))
     
     lines.append('/')
     return lines
 
 
+def namelist_line(key, value):
+    """
+    Converts a single namelist key and value to an output line.
+    """
+    #if type(value) == type(1) or type(value) == type(1.): # numbers
+
+    if isinstance(value, Number): # numbers
+        line= key + ' = ' + str(value) 
+    elif type(value) == type([]) or isinstance(value, np.ndarray): # lists or np arrays
+        liststr = ''
+        # Special case for dipole Double Complex items
+        if key.split('(')[0].upper() in ('D1', 'D2', 'D3', 'D4'):
+            for item in value:
+                liststr = liststr + str(item) + ','
+            line = key + ' = ' + "(" + liststr[:-1] + ")"
+        else:
+            for item in value:
+                liststr += str(item) + ' '
+            line = key + ' = ' + liststr 
+    elif type(value) == type('a'): # strings
+        line = key + ' = ' + "'" + value.strip("''") + "'"  # input may need apostrophes
+   
+    elif bool(value) == value:
+        line= key + ' = ' + str(value) 
+    else:
+        #print 'skipped: key, value = ', key, value
+        raise ValueError(f'Problem writing input key: {key}, value: {value}, type: {type(value)}')
+
+    return line
+
+
+class NamelistTemplate:
+    """
+    Namelists compiled for writing many times with a few keys changed.
+
+    The lines of all other keys are rendered once. Each render only converts the slot values,
+    and the output is the same as write_namelists (without make_symlinks) of the namelists
+    with those values set.
+
+    Parameters
+    ----------
+    namelists : dict of dict
+        Namelists, as Astra.input
+    slots : list of str or tuple
+        Keys that change, as 'namelist:key' or (namelist, key).
+        A key that is not in the namelists is written at the end of its namelist, if it is given.
+
+    Example:
+        T = NamelistTemplate(A.input, ['cavity:phi(1)', 'newrun:run'])
+        for i, phi in enumerate(phis):
+            T.write(f'run{i}/astra.in', {'cavity:phi(1)': phi, 'newrun:run': i + 1})
+    """
+
+    def __init__(self, namelists, slots):
+        self.slots = list(dict.fromkeys(self._slot(s) for s in slots))
+        for name, key in self.slots:
+            if name not in namelists:
+                raise ValueError(f'Namelist {name} does not exist for slot {name}:{key}')
+
+        # Static text chunks, with a slot (or None) between each
+        self._chunks = []
+        self._defaults = {}  # Slot: compiled value, in order
+        text = []
+        for name, namelist in namelists.items():
+            text.append('&' + name + '\n')
+            slot_keys = [key for nl, key in self.slots if nl == name]
+            for key, value in namelist.items():
+                if key in slot_keys:
+                    self._add_slot((name, key), ''.join(text), value)
+                    text = []
+                else:
+                    text.append(namelist_line(key, value) + '\n')
+            for key in slot_keys:
+                if key not in namelist:
+                    self._add_slot((name, key), ''.join(text), None)
+                    text = []
+            text.append('/\n')
+        self._chunks.append(''.join(text))
+
+    @staticmethod
+    def _slot(slot):
+        if isinstance(slot, str):
+            name, key = slot.split(':', 1)
+        else:
+            name, key = slot
+        return name, key
+
+    def _add_slot(self, slot, text, default):
+        self._chunks.append(text)
+        self._defaults[slot] = default
+
+    def render(self, values=None):
+        """
+        Returns the namelist text with slot values.
+
+        Parameters
+        ----------
+        values : dict, optional
+            Slot: value. Slots that are not given keep the value they were compiled with.
+            A value of None leaves the key out.
+
+        Returns
+        -------
+        str
+
+        """
+        vals = dict(self._defaults)
+        for slot, value in (values or {}).items():
+            slot = self._slot(slot)
+            if slot not in vals:
+                raise KeyError(f'Not a slot of this template: {slot[0]}:{slot[1]}')
+            vals[slot] = value
+
+        parts = []
+        for chunk, (slot, value) in zip(self._chunks, vals.items()):
+            parts.append(chunk)
+            if value is not None:
+                parts.append(namelist_line(slot[1], value) + '\n')
+        parts.append(self._chunks[-1])
+        return ''.join(parts)
+
+    def write(self, filePath, values=None):
+        """
+        Writes the namelist text with slot values to a file. See: .render
+        """
+        with open(filePath, 'w') as f:
+            f.write(self.render(values))
+
 
 def make_namelist_symlinks(namelist, path, prefixes=('file_', 'distribution', 'q_type'), verbose=False):
     """
@@ -93,27 +197,39 @@ def write_namelists(namelists, filePath, make_symlinks=False, prefixes=['file_',
     If make_symlinks, prefixes will be searched for paths and the appropriate links will be made.
     For Windows, make_symlinks is ignored and it is always False.See note at https://docs.python.org/3/library/os.html#os.symlink .
     """
+    text = render_namelists(namelists, filePath, make_symlinks=make_symlinks, prefixes=prefixes, verbose=verbose)
+    with open(filePath, 'w') as f:
+        f.write(text)
+
+
+def render_namelists(namelists, filePath, make_symlinks=False, prefixes=['file_', 'distribution'], verbose=False):
+    """
+    Returns the text that write_namelists writes to filePath.
+
+    Symlinks are made as in write_namelists.
+    """
     # With Windows 10, users need Administator Privileges or run on Developer mode
     # in order to be able to create symlinks.
     # More info: https://docs.python.org/3/library/os.html#os.symlink
     if os.name == 'nt':
         make_symlinks = False
 
-    with open(filePath, 'w') as f:
-        for key in namelists:
-            namelist = namelists[key]
+    lines = []
+    for key in namelists:
+        namelist = namelists[key]
+        
+        if make_symlinks:
+            # Work on a copy
+            namelist = namelist.copy()
+            path, _ = os.path.split(filePath)
+            replacements = make_namelist_symlinks(namelist, path, prefixes=prefixes, verbose=verbose)
+            namelist.update(replacements)
             
-            if make_symlinks:
-                # Work on a copy
-                namelist = namelist.copy()
-                path, _ = os.path.split(filePath)
-                replacements = make_namelist_symlinks(namelist, path, prefixes=prefixes, verbose=verbose)
-                namelist.update(replacements)
-                
-                
-            lines = namelist_lines(namelist, key)
-            for l in lines:
-                f.write(l+'\n')
+            
+        lines += namelist_lines(namelist, key)
+
+    return ''.join(l+'\n' for l in lines)
+
 
 
 
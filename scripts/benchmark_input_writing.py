@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark of writing many Astra input files with a few changed keys:
+writers.NamelistTemplate against writers.write_namelists.
+
+Parses an input file (default: a generated deck with many elements), then writes
+--decks files into a temporary directory with cavity:phi(1) and newrun:run changed, with:
+    write_namelists : set the values, then write_namelists
+    template : NamelistTemplate.write
+
+and checks that the files are byte-identical.
+
+Usage:
+    python scripts/benchmark_input_writing.py --decks 2000
+    python scripts/benchmark_input_writing.py --input docs/examples/templates/sc_inj/astra.in
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from astra import parsers, writers
+
+SLOTS = ['cavity:phi(1)', 'newrun:run']
+
+
+def generated_input(n_elements):
+    nl = {
+        'newrun': {'head': 'benchmark deck', 'run': 1, 'distribution': 'astra.particles', 'auto_phase': True},
+        'output': {'zstart': 0, 'zstop': 100, 'zemit': 1000, 'zphase': 1},
+        'cavity': {'lefield': True},
+        'solenoid': {'lbfield': True},
+    }
+    for i in range(1, n_elements + 1):
+        nl['output'][f'screen({i})'] = 0.01*i
+        nl['cavity'].update({f'file_efield({i})': 'fieldmaps/cavity.dat', f'nue({i})': 1.3,
+                             f'maxe({i})': 32.0, f'phi({i})': i % 360, f'c_pos({i})': 0.02*i})
+        nl['solenoid'].update({f'file_bfield({i})': 'fieldmaps/sol.dat', f'maxb({i})': 0.1,
+                               f's_pos({i})': 0.02*i + 0.01})
+    return nl
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--decks', type=int, default=2000, help='Number of files to write')
+    parser.add_argument('--elements', type=int, default=20, help='Elements in the generated deck')
+    parser.add_argument('--input', default=None, help='Astra input file to use instead of a generated deck')
+    args = parser.parse_args()
+
+    if args.input:
+        namelists = parsers.parse_astra_input_file(args.input)
+    else:
+        namelists = generated_input(args.elements)
+    namelists.setdefault('cavity', {}).setdefault('phi(1)', 0)
+
+    values = [{'cavity:phi(1)': 0.1*i, 'newrun:run': i + 1} for i in range(args.decks)]
+
+    with tempfile.TemporaryDirectory() as path:
+        t0 = time.perf_counter()
+        for i, v in enumerate(values):
+            for slot, val in v.items():
+                name, key = slot.split(':')
+                namelists[name][key] = val
+            writers.write_namelists(namelists, os.path.join(path, f'a{i}.in'))
+        t_write = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        T = writers.NamelistTemplate(namelists, SLOTS)
+        for i, v in enumerate(values):
+            T.write(os.path.join(path, f'b{i}.in'), v)
+        t_template = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for v in values:
+            T.render(v)
+        t_render = time.perf_counter() - t0
+
+        for i in range(args.decks):
+            with open(os.path.join(path, f'a{i}.in'), 'rb') as a, open(os.path.join(path, f'b{i}.in'), 'rb') as b:
+                assert a.read() == b.read(), f'Deck {i} differs'
+        size = os.path.getsize(os.path.join(path, 'a0.in'))
+
+    print(f'{args.decks} decks of {size/1e3:.1f} kB, byte-identical')
+    print(f'write_namelists: {t_write:8.3f} s  ({1:6.1f}x)')
+    print(f'       template: {t_template:8.3f} s  ({t_write/t_template:6.1f}x)  (including compile)')
+    print(f' render (no IO): {t_render:8.3f} s  ({t_write/t_render:6.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
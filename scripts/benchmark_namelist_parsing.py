@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark of Astra input file parsing: parsers.parse_astra_input_file
+against the previous line unrolling parser (parse_simple_namelist + parse_unrolled_namelist).
+
+Writes a large generated deck with many cavities and solenoids to a temporary directory, then times:
+    quadratic : the previous parse_simple_namelist, which built its list with lines = lines + ulines
+    unrolled : parse_unrolled_namelist(parse_simple_namelist(f)), with the list built in place
+    tokenizer : parse_namelists on the file text (no cache)
+    cached : parse_astra_input_file, after the first parse (returns a copy)
+
+Usage:
+    python scripts/benchmark_namelist_parsing.py --elements 2000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from astra import parsers
+
+
+def write_deck(path, n_elements):
+    lines = ['&newrun', "  head = 'benchmark deck'", '  run = 1', "  distribution = 'astra.particles'",
+             '  auto_phase = T', '/', '&output', '  zstart = 0, zstop = 100, zemit = 1000, zphase = 1']
+    for i in range(1, n_elements + 1):
+        lines.append(f'  screen({i}) = {0.01*i:.4f}')
+    lines += ['/', '&cavity', '  lefield = T']
+    for i in range(1, n_elements + 1):
+        lines += [f'! cavity {i}',
+                  f"  file_efield({i}) = 'fieldmaps/cavity.dat'",
+                  f'  nue({i}) = 1.3, maxe({i}) = 32.0, phi({i}) = {i % 360}, c_pos({i}) = {0.02*i:.4f}',
+                  f'  c_smooth({i}) = 10',
+                  f'  c_higher_order({i}) = T']
+    lines += ['/', '&solenoid', '  lbfield = T']
+    for i in range(1, n_elements + 1):
+        lines += [f"  file_bfield({i}) = 'fieldmaps/sol.dat'",
+                  f'  maxb({i}) = 0.1D0, s_pos({i}) = {0.02*i + 0.01:.4f}, s_xoff({i}) = 0']
+    lines.append('/')
+
+    f = os.path.join(path, 'astra.in')
+    with open(f, 'w') as fid:
+        fid.write('\n'.join(lines) + '\n')
+    return f
+
+
+def parse_quadratic(filePath):
+    lines = []
+    with open(filePath) as f:
+        for line in f:
+            lines = lines + parsers.unroll_namelist_line(line)
+    return parsers.parse_unrolled_namelist(lines)
+
+
+def timeit(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', type=int, default=2000, help='Number of cavities, solenoids, and screens')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        f = write_deck(path, args.elements)
+        with open(f) as fid:
+            text = fid.read()
+        print(f'{args.elements} elements, {len(text.splitlines())} lines, {len(text)/1e6:.2f} MB')
+
+        # Check that the results agree
+        d0 = parsers.parse_unrolled_namelist(parsers.parse_simple_namelist(f))
+        d1 = parsers.parse_astra_input_file(f)
+        d0['newrun']['head'] = d0['newrun']['head'].strip("'")  # The old parser kept quotes around strings with spaces
+        assert d0 == d1
+
+        results = {
+            'quadratic': timeit(lambda: parse_quadratic(f), args.repeat),
+            'unrolled': timeit(lambda: parsers.parse_unrolled_namelist(parsers.parse_simple_namelist(f)), args.repeat),
+            'tokenizer': timeit(lambda: parsers.parse_namelists(text), args.repeat),
+            'cached': timeit(lambda: parsers.parse_astra_input_file(f), args.repeat),
+        }
+
+    t0 = results['quadratic']
+    for name, t in results.items():
+        print(f'{name:>10}: {t:8.4f} s  ({t0/t:7.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
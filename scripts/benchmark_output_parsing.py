@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark of Astra stats file parsing: parsers.parse_astra_output_file
+against the previous np.loadtxt path.
+
+Writes synthetic Cemit, Xemit, Yemit, Zemit, and LandF files in Astra's fixed E format
+to a temporary directory, then times:
+    loadtxt : np.loadtxt per file, one multiply per column
+    fast : parse_astra_output_file per file, with the fixed width reader
+
+Usage:
+    python scripts/benchmark_output_parsing.py --rows 2000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from astra import parsers
+
+TYPES = ['Cemit', 'Xemit', 'Yemit', 'Zemit', 'LandF']
+
+
+def write_files(path, n_rows):
+    files = []
+    rng = np.random.default_rng(0)
+    for type in TYPES:
+        ncol = len(parsers.OutputColumnNames[type])
+        data = rng.normal(size=(n_rows, ncol))
+        data[:, 0] = np.linspace(0, 10, n_rows)
+        f = os.path.join(path, f'bench.{type}.001')
+        # As Astra: a leading space and sign column, 0.dddddE+dd
+        np.savetxt(f, data, fmt='%13.4E')
+        files.append(f)
+    return files
+
+
+def parse_loadtxt(filePath):
+    data = np.loadtxt(filePath, ndmin=2)
+    type = parsers.astra_output_type(filePath)
+    keys = parsers.OutputColumnNames[type]
+    factors = parsers.OutputColumnFactors[type]
+    d = {}
+    for i in range(len(keys)):
+        d[keys[i]] = data[:, i]*factors[i]
+    return d
+
+
+def timeit(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Rows per file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        files = write_files(path, args.rows)
+        size = sum(os.path.getsize(f) for f in files)
+        print(f'{len(files)} files, {args.rows} rows each, {size/1e6:.1f} MB total')
+
+        # Check that the results agree
+        for f in files:
+            d0 = parse_loadtxt(f)
+            d1 = parsers.parse_astra_output_file(f, standardize_labels=False)
+            assert all(np.array_equal(d0[k], d1[k]) for k in d0), f
+
+        results = {
+            'loadtxt': timeit(lambda: [parse_loadtxt(f) for f in files], args.repeat),
+            'fast': timeit(lambda: [parsers.parse_astra_output_file(f) for f in files], args.repeat),
+        }
+
+    t0 = results['loadtxt']
+    for name, t in results.items():
+        print(f'{name:>14}: {t:8.3f} s  ({t0/t:5.1f}x)  {size/1e6/t:8.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
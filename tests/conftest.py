@@ -0,0 +1,150 @@
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+# A stand-in for the Astra executable: tracks the particles of the distribution through a drift,
+# and writes the stats, LandF, and phase space files that Astra writes, in the same formats.
+FAKE_ASTRA = r'''
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+infile = sys.argv[1]
+text = open(infile).read()
+
+
+def get(key, default):
+    m = re.search(r'^\s*' + key + r'\s*=\s*([^\s,]+)', text, re.M | re.I)
+    if not m:
+        return default
+    value = m.group(1).strip("'\"")
+    if value.upper() in ('T', 'TRUE', '.T.'):
+        return True
+    if value.upper() in ('F', 'FALSE', '.F.'):
+        return False
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+zstart, zstop = get('zstart', 0.0), get('zstop', 1.0)
+zemit, zphase = int(get('zemit', 10)), int(get('zphase', 1))
+run = int(get('run', 1))
+prefix = os.path.basename(infile).split('.')[0]
+ext = f'{run:03d}'
+
+print(' Fake Astra')
+data = np.loadtxt(get('distribution', ''), ndmin=2)
+ref, beam = data[0], data[1:]
+
+
+def drift(z):
+    """Reference particle, and particles relative to it, at z"""
+    L = z - ref[2]
+    pz = ref[5] + beam[:, 5]
+    b = beam.copy()
+    b[:, 0] += b[:, 3] / pz * L
+    b[:, 1] += b[:, 4] / pz * L
+    r = ref.copy()
+    r[2] = z
+    return r, b
+
+
+def emit(u, p):
+    return np.sqrt(max(np.var(u) * np.var(p) - np.cov(u, p, ddof=0)[0, 1]**2, 0))
+
+
+# For monitor tests: seconds between output steps, and a step to hang at
+step_delay = float(os.environ.get('FAKE_ASTRA_STEP_DELAY', 0))
+stall_at = int(os.environ.get('FAKE_ASTRA_STALL_AT', -1))
+
+files = {t: open(f'{prefix}.{t}.{ext}', 'w') for t in ('Xemit', 'Yemit', 'Zemit', 'LandF')}
+mc2 = 0.51099895e6
+for step, z in enumerate(np.linspace(max(zstart, ref[2]), zstop, zemit + 1)):
+    if step == stall_at:
+        time.sleep(3600)
+    if step and step_delay:
+        time.sleep(step_delay)
+    r, b = drift(z)
+    alive = b[b[:, 9] > 0]
+    pz = r[5] + alive[:, 5]
+    energy = np.sqrt(pz**2 + alive[:, 3]**2 + alive[:, 4]**2 + mc2**2)
+    t = r[6]
+    for t_, col in (('Xemit', 0), ('Yemit', 1)):
+        u, up = alive[:, col], alive[:, col + 3] / pz
+        row = [z, t, 1e3 * u.mean(), 1e3 * u.std(), 1e3 * up.std(),
+               1e6 * emit(u, alive[:, col + 3] / mc2), 1e3 * np.cov(u, up, ddof=0)[0, 1] / max(u.std(), 1e-30)]
+        files[t_].write(' '.join(f'{v:12.4E}' for v in row) + '\n')
+    dz = alive[:, 2]
+    row = [z, t, 1e-6 * (energy.mean() - mc2), 1e3 * dz.std(), 1e-3 * energy.std(),
+           emit(dz, energy), 1e-3 * np.cov(dz, energy, ddof=0)[0, 1] / max(dz.std(), 1e-30)]
+    files['Zemit'].write(' '.join(f'{v:12.4E}' for v in row) + '\n')
+    n = 1 + len(b)
+    row = [z, n, r[7] + b[:, 7].sum(), np.count_nonzero(b[:, 9] < -6), 0, 0]
+    files['LandF'].write(' '.join(f'{v:12.4E}' for v in row) + '\n')
+    for f in files.values():
+        f.flush()
+for f in files.values():
+    f.close()
+
+if get('phases', True):
+    for k in range(1, zphase + 1):
+        z = zstart + (zstop - zstart) * k / zphase
+        r, b = drift(z)
+        np.savetxt(f'{prefix}.{int(round(100 * z)):04d}.{ext}', np.vstack([r, b]), fmt='%.12e')
+
+print(' finished simulation')
+print(' Goodbye.')
+'''
+
+
+@pytest.fixture
+def fake_astra(tmp_path_factory, monkeypatch):
+    """Path of an executable that stands in for Astra, also set as ASTRA_BIN"""
+    path = tmp_path_factory.mktemp('bin') / 'astra'
+    path.write_text(f'#!{sys.executable}\n' + FAKE_ASTRA)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('ASTRA_BIN', str(path))
+    return str(path)
+
+
+def write_distribution(filePath, n_particles=1000, seed=0, charge=-1e-4):
+    """Astra particle file with a reference particle at z = 0, with 5 MeV/c, and n_particles around it"""
+    rng = np.random.default_rng(seed)
+    data = np.zeros((n_particles + 1, 10))
+    data[1:, :6] = rng.normal(0, [1e-3, 1e-3, 1e-4, 1e3, 1e3, 1e4], (n_particles, 6))
+    data[0, 5] = 5e6
+    data[:, 7] = charge
+    data[:, 8] = 1
+    data[:, 9] = 5
+    np.savetxt(filePath, data, fmt='%.12e')
+    return str(filePath)
+
+
+@pytest.fixture
+def astra_input(tmp_path, fake_astra):
+    """Astra input file in tmp_path, for a drift to z = 1 m without space charge"""
+    dist = write_distribution(tmp_path / 'beam.ini')
+    filePath = tmp_path / 'astra.in'
+    filePath.write_text(f"""&newrun
+  run = 1
+  distribution = '{dist}'
+  zphase = 2
+/
+&output
+  zstart = 0
+  zstop = 1
+  zemit = 10
+/
+&charge
+  lspch = F
+  lspch3d = F
+/
+""")
+    return str(filePath)
@@ -0,0 +1,85 @@
+import h5py
+import numpy as np
+
+from astra import Astra
+from astra.archive import FIELDMAP_STORE, read_fieldmap_h5, write_fieldmap_h5
+
+
+def fieldmap3d(scale=1.0):
+    return dict(attrs={'type': 'astra_3d', 'component': 'ez'},
+                x=np.linspace(-1e-3, 1e-3, 3), y=np.linspace(-2e-3, 2e-3, 4), z=np.linspace(0, 0.1, 5),
+                data=scale * np.arange(60.).reshape(5, 4, 3))
+
+
+def fieldmap1d():
+    z = np.linspace(0, 0.2, 11)
+    return dict(attrs={'type': 'astra_1d'}, data=np.array([z, np.sin(10 * z)]).T)
+
+
+def assert_fieldmaps_equal(a, b):
+    assert set(a) == set(b)
+    for k in a:
+        assert a[k]['attrs'] == b[k]['attrs']
+        for key in a[k]:
+            if key != 'attrs':
+                np.testing.assert_array_equal(a[k][key], b[k][key])
+
+
+def test_archive_round_trip(astra_input, tmp_path):
+    A = Astra(astra_input)
+    A.run()
+    A.fieldmap = {'cav.dat': fieldmap1d(), '3D_map.ez': fieldmap3d()}
+    h5 = str(tmp_path / 'archive.h5')
+    A.archive(h5)
+
+    B = Astra()
+    B.load_archive(h5)
+    assert B.input == A.input
+    for k, v in A.output['stats'].items():
+        np.testing.assert_allclose(B.output['stats'][k], v)
+    assert len(B.particles) == len(A.particles)
+    assert B.particles[-1] == A.particles[-1]
+    assert_fieldmaps_equal(B.fieldmap, A.fieldmap)
+
+
+def test_fieldmap3d_stored_once(tmp_path):
+    fmaps = {'3D_map.ez': fieldmap3d(), 'cav.dat': fieldmap1d()}
+    with h5py.File(tmp_path / 'runs.h5', 'w') as h5:
+        for i in range(3):
+            write_fieldmap_h5(h5.create_group(f'run{i}'), fmaps)
+        write_fieldmap_h5(h5.create_group('other'), {'3D_map.ez': fieldmap3d(scale=2)})
+
+        assert len(h5[FIELDMAP_STORE]) == 2
+        # Hard links to the same dataset
+        assert h5['run0/fieldmap/3D_map.ez'] == h5['run2/fieldmap/3D_map.ez']
+        assert h5['run0/fieldmap/3D_map.ez'] != h5['other/fieldmap/3D_map.ez']
+        for i in range(3):
+            assert_fieldmaps_equal(read_fieldmap_h5(h5[f'run{i}/fieldmap']), fmaps)
+        assert_fieldmaps_equal(read_fieldmap_h5(h5['other/fieldmap']), {'3D_map.ez': fieldmap3d(scale=2)})
+
+
+def test_fieldmap3d_external_store(tmp_path):
+    fmaps = {'3D_map.ez': fieldmap3d()}
+    with h5py.File(tmp_path / 'store.h5', 'w') as store_file:
+        store = store_file.create_group('maps')
+        for i in range(2):
+            with h5py.File(tmp_path / f'run{i}.h5', 'w') as h5:
+                write_fieldmap_h5(h5, fmaps, store=store)
+                link = h5.get('fieldmap/3D_map.ez', getlink=True)
+                assert isinstance(link, h5py.ExternalLink)
+                assert FIELDMAP_STORE not in h5
+        assert len(store) == 1
+
+    with h5py.File(tmp_path / 'run1.h5', 'r') as h5:
+        assert_fieldmaps_equal(read_fieldmap_h5(h5['fieldmap']), fmaps)
+
+
+def test_fieldmap3d_archive_is_compressed(tmp_path):
+    fmap = fieldmap3d()
+    fmap['data'] = np.zeros((50, 40, 30))
+    with h5py.File(tmp_path / 'run.h5', 'w') as h5:
+        write_fieldmap_h5(h5, {'3D_map.ez': fmap})
+        dset = h5['fieldmap/3D_map.ez']
+        assert dset.compression == 'gzip'
+        assert dset.chunks == (1, 40, 30)
+        assert dset.id.get_storage_size() < fmap['data'].nbytes / 10
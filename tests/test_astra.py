@@ -0,0 +1,126 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+
+from astra import Astra
+from astra.particles import load_phase_file
+
+USAGE_KEYS = {'cpu_user_time', 'cpu_system_time', 'max_rss', 'bytes_written', 'n_output_files'}
+
+
+def test_run(astra_input):
+    A = Astra(astra_input)
+    A.run()
+    assert not A.error
+    assert USAGE_KEYS <= set(A.output['run_info'])
+    assert len(A.particles) == 2
+    assert A.output['stats']['mean_z'][-1] == pytest.approx(1)
+    assert A.output['stats']['sigma_x'][-1] == pytest.approx(A.particles[-1]['sigma_x'], rel=1e-3)
+
+
+def test_run_async_records_usage(astra_input):
+    A = Astra(astra_input)
+    A.run()
+    B = Astra(astra_input)
+    asyncio.run(B.run_async())
+    assert not B.error
+    assert USAGE_KEYS <= set(B.output['run_info'])
+    assert B.output['run_info']['cpu_user_time'] > 0
+    assert B.output['run_info']['max_rss'] > 0
+    assert B.output['run_info']['n_output_files'] == A.output['run_info']['n_output_files']
+    assert B.output['stats']['sigma_x'] == pytest.approx(A.output['stats']['sigma_x'])
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Names of the files written by Astra._write_if_changed"""
+    names = []
+    original = Astra._write_if_changed
+
+    def spy(self, filePath, *args, **kwargs):
+        wrote = original(self, filePath, *args, **kwargs)
+        if wrote:
+            names.append(os.path.basename(filePath))
+        return wrote
+
+    monkeypatch.setattr(Astra, '_write_if_changed', spy)
+    return names
+
+
+@pytest.fixture
+def astra_object(astra_input):
+    A = Astra(astra_input)
+    A.initial_particles = load_phase_file(A.input['newrun']['distribution'])
+    A.fieldmap = {'cav.dat': {'attrs': {'type': 'astra_1d'},
+                              'data': np.array([[0, 0], [0.05, 1], [0.1, 0]])}}
+    return A
+
+
+def test_write_input_skips_unchanged(astra_object, written):
+    A = astra_object
+    A.write_input()
+    assert sorted(written) == ['astra.in', 'astra.particles', 'cav.dat']
+    written.clear()
+
+    A.write_input()
+    assert written == []
+
+    A.input['output']['zstop'] = 2
+    A.write_input()
+    assert written == ['astra.in']
+    written.clear()
+
+    A.initial_particles.x[0] += 1e-3
+    A.write_input()
+    assert written == ['astra.particles']
+    written.clear()
+
+    A.fieldmap['cav.dat']['data'] = A.fieldmap['cav.dat']['data'] * 2
+    A.write_input()
+    assert written == ['cav.dat']
+    written.clear()
+
+    A.write_input(force=True)
+    assert sorted(written) == ['astra.in', 'astra.particles', 'cav.dat']
+
+
+def test_write_input_rewrites_modified_files(astra_object, written):
+    A = astra_object
+    A.write_input()
+    written.clear()
+
+    for name in ('astra.in', 'astra.particles', 'cav.dat'):
+        with open(os.path.join(A.path, name), 'a') as f:
+            f.write('\n')
+        A.write_input()
+        assert written == [name]
+        written.clear()
+
+    os.remove(os.path.join(A.path, 'astra.in'))
+    A.write_input()
+    assert written == ['astra.in']
+
+
+def test_run_split_records_written_distribution(astra_object, written):
+    A = astra_object
+    A.fieldmap = {}
+    A.run_split(n_chunks=2, max_workers=1)
+    assert not A.error
+    assert 'astra.particles' in written
+    written.clear()
+
+    # The distribution written by run_split is known
+    A.write_input()
+    assert 'astra.particles' not in written
+
+    # New particles are written by run_split and by write_input
+    A.initial_particles.x[0] += 1e-3
+    A.run_split(n_chunks=2, max_workers=1)
+    assert 'astra.particles' in written
+    written.clear()
+    A.write_input()
+    assert 'astra.particles' not in written
+    P = load_phase_file(os.path.join(A.path, 'astra.particles'))
+    assert P.x[0] == pytest.approx(A.initial_particles.x[0])
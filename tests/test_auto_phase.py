@@ -0,0 +1,146 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from astra import Astra, parsers
+from astra.auto_phase import (AutoPhaseCache, apply_cavity_phases, cached_cavity_phases, cavity_phase_keys,
+                              restore_input, store_cavity_phases)
+
+# From the log of docs/examples/elements/tws.ipynb
+LOG = """
+ --------------------------------------------------------------------------
+     Start auto phasing: 
+     Scan cavity number  :   1
+        6 unstable trajectories out of   50
+     Scan cavity number  :   2
+        0 unstable trajectories out of   50
+
+     Cavity phasing completed:
+     Cavity number   Energy gain [MeV]  at  Phase [deg]
+           1             5.380               46.221    
+           2             46.34               306.08    
+ --------------------------------------------------------------------------
+ on axis tracking of the reference particle:
+     initial position                  z =    0.000     m
+"""
+
+
+def test_parse_auto_phase_table():
+    phases = parsers.parse_auto_phase_table(LOG)
+    assert list(phases) == [1, 2]
+    assert phases[1]['energy_gain'] == pytest.approx(5.380e6)
+    assert phases[1]['phase'] == pytest.approx(46.221)
+    assert phases[2] == pytest.approx({'energy_gain': 46.34e6, 'phase': 306.08})
+    assert parsers.parse_auto_phase_table(LOG.splitlines(keepends=True)) == phases
+    assert parsers.parse_auto_phase_table('finished simulation\n') == {}
+
+
+@pytest.fixture
+def astra_object(astra_input, tmp_path):
+    for i in (1, 2):
+        np.savetxt(tmp_path / f'cav{i}.dat', np.array([[0, 0], [0.05, 1], [0.1, 0]]))
+    A = Astra(astra_input)
+    A.input['newrun']['auto_phase'] = True
+    A.input['cavity'] = {'lefield': True,
+                         'file_efield(1)': str(tmp_path / 'cav1.dat'), 'c_pos(1)': 0.1, 'maxe(1)': 10,
+                         'nue(1)': 1.3, 'phi(1)': 0,
+                         'file_efield(2)': str(tmp_path / 'cav2.dat'), 'c_pos(2)': 0.5, 'maxe(2)': 20,
+                         'nue(2)': 1.3, 'phi(2)': 0}
+    return A
+
+
+def changed_keys(A, change):
+    before = cavity_phase_keys(A)
+    change(A)
+    after = cavity_phase_keys(A)
+    return {ix for ix in before if before[ix] != after[ix]}
+
+
+def test_cavity_phase_keys_upstream_phi(astra_object):
+    def change(A):
+        A.input['cavity']['phi(1)'] = 10
+    assert changed_keys(astra_object, change) == {2}
+
+
+@pytest.mark.parametrize('key', ['maxe', 'nue'])
+def test_cavity_phase_keys_own_field(astra_object, key):
+    def change(A):
+        A.input['cavity'][f'{key}(2)'] *= 2
+    assert changed_keys(astra_object, change) == {2}
+
+    def change(A):
+        A.input['cavity'][f'{key}(1)'] *= 2
+    assert changed_keys(astra_object, change) == {1, 2}
+
+
+def test_cavity_phase_keys_ignore_own_phi(astra_object):
+    def change(A):
+        A.input['cavity']['phi(2)'] = 10
+        A.input['newrun']['auto_phase'] = False
+        A.input['newrun']['run'] = 2
+    assert changed_keys(astra_object, change) == set()
+
+
+def test_cavity_phase_keys_binary(astra_object, tmp_path):
+    other = tmp_path / 'astra2'
+    shutil.copy(astra_object.command, other)
+    with open(other, 'a') as f:
+        f.write('\n# Another version\n')
+
+    def change(A):
+        A.command = str(other)
+    assert changed_keys(astra_object, change) == {1, 2}
+
+
+def test_cavity_phase_keys_distribution(astra_object):
+    def change(A):
+        dist = A.input['newrun']['distribution']
+        with open(dist, 'a') as f:
+            f.write('0 0 0 0 0 0 0 -1e-4 1 5\n')
+    assert changed_keys(astra_object, change) == {1, 2}
+
+
+def test_apply_and_restore(astra_object):
+    astra_input = astra_object.input
+    astra_input['cavity']['phi(2)'] = -5
+    del astra_input['cavity']['phi(1)']
+    original = {k: dict(v) for k, v in astra_input.items()}
+
+    phases = parsers.parse_auto_phase_table(LOG)
+    saved = apply_cavity_phases(astra_input, phases)
+    assert astra_input['cavity']['phi(1)'] == pytest.approx(46.221)
+    assert astra_input['cavity']['phi(2)'] == pytest.approx(306.08 - 5)
+    assert astra_input['newrun']['auto_phase'] is False
+    assert astra_input['newrun']['phase_scan'] is False
+
+    restore_input(astra_input, saved)
+    assert astra_input == original
+
+
+def test_unphased_cavity_is_a_miss(astra_object):
+    cache = AutoPhaseCache()
+    keys = cavity_phase_keys(astra_object)
+    phases = parsers.parse_auto_phase_table(LOG)
+    del phases[2]
+    store_cavity_phases(cache, keys, phases)
+    assert keys[1] in cache
+    assert keys[2] not in cache
+    assert cached_cavity_phases(cache, keys) is None
+
+    # A cache written with None entries
+    cache.put(keys[2], None)
+    assert cached_cavity_phases(cache, keys) is None
+
+    with pytest.raises(ValueError):
+        apply_cavity_phases(astra_object.input, {1: phases[1], 2: None})
+
+
+def test_cache_file(astra_object, tmp_path):
+    path = str(tmp_path / 'phases.json')
+    keys = cavity_phase_keys(astra_object)
+    store_cavity_phases(AutoPhaseCache(path), keys, parsers.parse_auto_phase_table(LOG))
+    cached = cached_cavity_phases(AutoPhaseCache(path), keys)
+    assert cached == parsers.parse_auto_phase_table(LOG)
+    assert os.listdir(tmp_path).count('phases.json') == 1
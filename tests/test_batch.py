@@ -0,0 +1,59 @@
+import pytest
+
+from astra import Astra
+from astra.batch import AstraBatch
+
+
+@pytest.fixture
+def template(astra_input):
+    return Astra(astra_input)
+
+
+@pytest.mark.parametrize('mp_context', ['fork', 'spawn'])
+def test_template_settings(template, mp_context):
+    zstops = [0.5, 1.0, 1.5]
+    B = AstraBatch(template=template, settings=[{'zstop': z} for z in zstops], max_workers=2,
+                   mp_context=mp_context)
+    results = B.run()
+    assert len(results) == 3
+    for z, result in zip(zstops, results):
+        assert not result['error'], result['why_error']
+        assert result['output']['stats']['mean_z'][-1] == pytest.approx(z)
+        assert result['output']['particles'] == []
+        assert 'cpu_user_time' in result['output']['run_info']
+    # The template is not changed
+    assert template.input['output']['zstop'] == 1
+
+
+def test_include_particles(template):
+    B = AstraBatch(template=template, settings=[{}], max_workers=1, include_particles=True)
+    result, = B.run()
+    particles = result['output']['particles']
+    assert isinstance(particles, list)
+    assert len(particles) == 2
+    assert particles[-1]['mean_z'] == pytest.approx(1, abs=1e-4)
+
+
+def test_failure_is_isolated(template):
+    B = AstraBatch(template=template, settings=[{'zstop': 0.5}, {'not_a_key': 1}], max_workers=2)
+    ok, bad = B.run()
+    assert not ok['error']
+    assert bad['error']
+    assert 'set_astra' in bad['why_error']
+
+
+def test_run_many_updates_objects(astra_input):
+    objects = [Astra(astra_input) for _ in range(2)]
+    objects[1].input['output']['zstop'] = 0.5
+    results = Astra.run_many(objects, max_workers=2)
+    assert [r['error'] for r in results] == [False, False]
+    for A, z in zip(objects, [1.0, 0.5]):
+        assert A.finished and not A.error
+        assert A.output['stats']['mean_z'][-1] == pytest.approx(z)
+
+
+def test_iter_results_indices(template):
+    B = AstraBatch(template=template, settings=[{'zstop': z} for z in (0.25, 0.75)], max_workers=2)
+    indices = sorted(i for i, _ in B.iter_results())
+    assert indices == [0, 1]
+    assert all(r is not None for r in B.results)
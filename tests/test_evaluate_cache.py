@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from astra.evaluate_cache import EvaluateCache, evaluate_key, merit_name
+
+
+@pytest.fixture
+def binaries(tmp_path, monkeypatch):
+    files = []
+    for name in ['astra_a', 'astra_b']:
+        f = tmp_path / name
+        f.write_text('#!/bin/sh\n')
+        files.append(str(f))
+    monkeypatch.setenv('ASTRA_BIN', files[0])
+    return files
+
+
+def test_key_uses_default_binary(binaries, monkeypatch):
+    key = evaluate_key({'zstop': 1})
+    assert evaluate_key({'zstop': 1}) == key
+    assert evaluate_key({'zstop': 1}, command=binaries[0]) == key
+
+    monkeypatch.setenv('ASTRA_BIN', binaries[1])
+    assert evaluate_key({'zstop': 1}) != key
+
+
+def test_key_changes_with_binary_mtime(binaries):
+    key = evaluate_key({'zstop': 1})
+    st = os.stat(binaries[0])
+    os.utime(binaries[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert evaluate_key({'zstop': 1}) != key
+
+
+def test_key_follows_symlinks(binaries, tmp_path, monkeypatch):
+    link = tmp_path / 'astra'
+    os.symlink(binaries[0], link)
+    monkeypatch.setenv('ASTRA_BIN', str(link))
+    key = evaluate_key({'zstop': 1})
+    os.remove(link)
+    os.symlink(binaries[1], link)
+    assert evaluate_key({'zstop': 1}) != key
+
+
+def test_key_ignores_run_location(binaries):
+    assert evaluate_key({'zstop': 1}, workdir='/a', verbose=True) == evaluate_key({'zstop': 1})
+
+
+def test_merit_name():
+    def f(n):
+        return lambda A: n
+
+    assert merit_name(None) == 'astra.evaluate.default_astra_merit'
+    assert merit_name(lambda A: 1) != merit_name(lambda A: 2)
+    assert merit_name(lambda A: {'a': A}) != merit_name(lambda A: {'b': A})
+    assert merit_name(f(1)) == merit_name(f(1))
+    assert merit_name(f(1)) != merit_name(f(2))
+
+
+def test_cache_lru(tmp_path):
+    cache = EvaluateCache(tmp_path / 'cache', max_bytes=13_000)
+    for i in range(3):
+        cache.put(f'key{i}', {'x': i, 'data': bytes(4000)})
+        os.utime(cache._entry_file(f'key{i}'), ns=(i, i))
+    cache.get('key0')  # Now the most recent
+    cache.put('key3', {'x': 3, 'data': bytes(4000)})
+
+    assert cache.get('key1') is None
+    assert cache.get('key0')['x'] == 0
+    assert cache.get('key3')['x'] == 3
+    assert cache.size <= 13_000
@@ -0,0 +1,284 @@
+import hashlib
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from astra import parse_cache, parsers
+from astra.archive import read_fieldmap_h5, write_fieldmap_h5
+from astra.fieldmaps import (FIELDMAP_CACHE, FieldmapCache, expand_tws_fmap, fieldmap_data, fieldmap_fingerprint,
+                             load_fieldmap, load_fieldmap3d, parse_fieldmap, parse_fieldmap3d, read_fieldmap,
+                             write_fieldmap, write_fieldmaps)
+
+
+def fieldmap3d(scale=1.0):
+    return dict(attrs={'type': 'astra_3d', 'component': 'ez'},
+                x=np.linspace(-1e-3, 1e-3, 3), y=np.linspace(-2e-3, 2e-3, 4), z=np.linspace(0, 0.1, 5),
+                data=scale * np.arange(60.).reshape(5, 4, 3))
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    FIELDMAP_CACHE.clear()
+    yield
+    FIELDMAP_CACHE.clear()
+
+
+@pytest.fixture
+def map3d(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_fieldmap(str(src / '3D_map.ez'), fieldmap3d())
+    return str(src / '3D_map')
+
+
+def test_write_parse_3d(map3d):
+    fmap = parse_fieldmap3d(map3d + '.ez')
+    expected = fieldmap3d()
+    assert fmap['attrs'] == expected['attrs']
+    for k in ('x', 'y', 'z', 'data'):
+        np.testing.assert_array_equal(fmap[k], expected[k])
+
+
+def test_load_fieldmap3d_without_parse_cache(map3d, monkeypatch):
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', None)
+    fmaps = load_fieldmap3d(map3d)
+    assert list(fmaps) == [map3d + '.ez']
+    fmap = fmaps[map3d + '.ez']
+    assert not isinstance(fmap['data'], np.memmap)
+    assert not fmap['data'].flags.writeable
+    assert fieldmap_fingerprint(fmap) == fieldmap_fingerprint(fieldmap3d())
+    # Nothing is written next to the fieldmaps
+    assert os.listdir(os.path.dirname(map3d)) == ['3D_map.ez']
+
+
+def test_load_fieldmap3d_is_memory_mapped(map3d, tmp_path, monkeypatch):
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', str(tmp_path / 'cache'))
+    fmap = load_fieldmap3d(map3d)[map3d + '.ez']
+    assert isinstance(fmap['data'], np.memmap)
+    assert not fmap['data'].flags.writeable
+    assert fieldmap_fingerprint(fmap) == fieldmap_fingerprint(fieldmap3d())
+    assert os.listdir(os.path.dirname(map3d)) == ['3D_map.ez']
+    assert os.listdir(tmp_path / 'cache')
+
+
+def test_write_fieldmaps_links_3d(map3d, tmp_path):
+    fmaps = {os.path.basename(k): v for k, v in load_fieldmap3d(map3d).items()}
+    workdir = tmp_path / 'run'
+    workdir.mkdir()
+
+    write_fieldmaps(fmaps, str(workdir))
+    link = workdir / '3D_map.ez'
+    assert os.readlink(link) == map3d + '.ez'
+
+    # Again, in place
+    write_fieldmaps(fmaps, str(workdir))
+    assert os.readlink(link) == map3d + '.ez'
+
+    # Not in place of the source itself
+    write_fieldmaps(fmaps, os.path.dirname(map3d))
+    assert not os.path.islink(map3d + '.ez')
+
+
+def test_write_fieldmaps_changed_source(map3d, tmp_path):
+    fmaps = {os.path.basename(k): v for k, v in load_fieldmap3d(map3d).items()}
+    write_fieldmap(map3d + '.ez', fieldmap3d(scale=2))
+    st = os.stat(map3d + '.ez')
+    os.utime(map3d + '.ez', ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    write_fieldmaps(fmaps, str(tmp_path))
+    written = tmp_path / '3D_map.ez'
+    assert not os.path.islink(written)
+    np.testing.assert_array_equal(parse_fieldmap3d(str(written))['data'], fieldmap3d()['data'])
+
+
+def test_fingerprint_remembered_for_cached_maps(map3d, monkeypatch):
+    fmap = load_fieldmap3d(map3d)[map3d + '.ez']
+    fp = fieldmap_fingerprint(fmap)
+
+    def no_hash(*args, **kwargs):
+        raise AssertionError('hashed again')
+
+    monkeypatch.setattr(np, 'ascontiguousarray', no_hash)
+    assert fieldmap_fingerprint(fmap) == fp
+    assert fieldmap_fingerprint(load_fieldmap3d(map3d)[map3d + '.ez']) == fp
+
+
+def test_fingerprint_of_writeable_arrays():
+    fmap = fieldmap3d()
+    fp = fieldmap_fingerprint(fmap)
+    fmap['data'][0, 0, 0] = -1
+    assert fieldmap_fingerprint(fmap) != fp
+    # Same values, another shape
+    fmap = fieldmap3d()
+    fmap['data'] = fmap['data'].reshape(5, 3, 4)
+    assert fieldmap_fingerprint(fmap) != fp
+
+
+TWS = os.path.join(os.path.dirname(__file__), '..', 'docs', 'examples', 'templates', 'tws')
+
+
+def expand_tws_reference(fmap, n_cell):
+    """The cell by cell expansion that expand_tws_fmap replaces"""
+    z0, Ez0 = fmap['data'].T
+    z1, z2 = fmap['attrs']['z1'], fmap['attrs']['z2']
+    dz = np.mean(np.diff(z0))
+    Lcell = z2 - z1
+    n_repeat = int(n_cell / fmap['attrs']['m'])
+    zentrance = np.linspace(z0.min(), z1, int(round((z1 - z0.min())/dz + 1)))
+    zcell = np.linspace(z1, z2, int(round(Lcell/dz + 1)))
+    zexit = np.linspace(z2, z0.max(), int(round((z0.max() - z2)/dz + 1)))
+    ztot = [zentrance[:-1]]
+    Eztot = [np.interp(zentrance, z0, Ez0)[:-1]]
+    for i in range(n_repeat):
+        ztot.append(zcell[:-1] + i*Lcell)
+        Eztot.append(np.interp(zcell, z0, Ez0)[:-1])
+    ztot.append(zexit + (n_repeat - 1)*Lcell)
+    Eztot.append(np.interp(zexit, z0, Ez0))
+    return np.concatenate(ztot), np.concatenate(Eztot)
+
+
+@pytest.fixture
+def tws_input():
+    astra_input = parsers.parse_astra_input_file(os.path.join(TWS, 'astra.in'))
+    parsers.fix_input_paths(astra_input, root=TWS)
+    return astra_input
+
+
+def test_fieldmap_cache_shares_arrays(tmp_path):
+    f = str(tmp_path / 'cav.dat')
+    np.savetxt(f, np.array([np.linspace(0, 1, 11), np.linspace(0, 1, 11)**2]).T)
+    hits, misses = FIELDMAP_CACHE.hits, FIELDMAP_CACHE.misses
+    a = load_fieldmap(f)
+    b = load_fieldmap(f)
+    assert a is not b
+    assert a['data'] is b['data']
+    assert not a['data'].flags.writeable
+    a['attrs']['type'] = 'changed'
+    assert b['attrs']['type'] == 'astra_1d'
+    assert (FIELDMAP_CACHE.hits - hits, FIELDMAP_CACHE.misses - misses) == (1, 1)
+
+    # A rewritten file is parsed again, and replaces the old version
+    np.savetxt(f, np.zeros((3, 2)))
+    st = os.stat(f)
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert load_fieldmap(f)['data'].shape == (3, 2)
+    assert len(FIELDMAP_CACHE) == 1
+
+
+@pytest.mark.parametrize('which', ['1d', 'tws'])
+def test_read_fieldmap_binary_copy(which, tws_input, tmp_path, monkeypatch):
+    if which == '1d':
+        f = str(tmp_path / 'cav.dat')
+        np.savetxt(f, np.array([np.linspace(0, 1, 11), np.linspace(0, 1, 11)**2]).T)
+    else:
+        f = tws_input['cavity']['file_efield(2)']
+    expected = parse_fieldmap(f)
+
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', str(tmp_path / 'cache'))
+    for _ in range(2):
+        fmap = read_fieldmap(f)
+        assert fmap['attrs'] == expected['attrs']
+        np.testing.assert_array_equal(fmap['data'], expected['data'])
+    assert isinstance(fmap['data'], np.memmap)
+
+    # The process-wide cache reads the copy too
+    assert isinstance(load_fieldmap(f)['data'], np.memmap)
+
+
+def test_read_fieldmap_changed_file(tmp_path, monkeypatch):
+    f = str(tmp_path / 'cav.dat')
+    np.savetxt(f, np.ones((11, 2)))
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', str(tmp_path / 'cache'))
+    read_fieldmap(f)
+
+    np.savetxt(f, np.zeros((3, 2)))
+    st = os.stat(f)
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    np.testing.assert_array_equal(read_fieldmap(f)['data'], np.zeros((3, 2)))
+
+
+def test_read_fieldmap_without_parse_cache(tmp_path, monkeypatch):
+    f = str(tmp_path / 'cav.dat')
+    np.savetxt(f, np.ones((11, 2)))
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', None)
+    for _ in range(2):
+        assert not isinstance(read_fieldmap(f)['data'], np.memmap)
+    assert os.listdir(tmp_path) == ['cav.dat']
+
+
+def test_fieldmap_cache_budget(tmp_path):
+    cache = FieldmapCache(max_bytes=300)
+    files = []
+    for i in range(3):
+        f = str(tmp_path / f'cav{i}.dat')
+        np.savetxt(f, np.full((10, 2), float(i)))
+        files.append(f)
+        cache.get(f)
+    # 160 bytes each
+    assert len(cache) == 1
+    assert cache.nbytes == 160
+    cache.get(files[-1])
+    assert cache.hits == 1
+
+
+def test_expand_tws_fmap(tws_input):
+    fmap = load_fieldmap(tws_input['cavity']['file_efield(2)'])
+    for n_cell in (3, 135):
+        z, Ez = expand_tws_fmap(fmap, n_cell)
+        z_ref, Ez_ref = expand_tws_reference(fmap, n_cell)
+        np.testing.assert_array_equal(z, z_ref)
+        np.testing.assert_array_equal(Ez, Ez_ref)
+
+
+def test_fieldmap_data_memoized(tws_input):
+    dat = fieldmap_data(tws_input, section='cavity', index=2)
+    assert not dat.flags.writeable
+    assert fieldmap_data(tws_input, section='cavity', index=2) is dat
+    assert dat[:, 0].min() == pytest.approx(tws_input['cavity']['c_pos(2)'])
+    assert np.abs(dat[:, 1]).max() == pytest.approx(tws_input['cavity']['maxe(2)'])
+
+    # Settings are part of the key
+    tws_input['cavity']['c_pos(2)'] += 1
+    moved = fieldmap_data(tws_input, section='cavity', index=2)
+    np.testing.assert_allclose(moved[:, 0], dat[:, 0] + 1)
+    tws_input['cavity']['maxe(2)'] *= 2
+    np.testing.assert_allclose(fieldmap_data(tws_input, section='cavity', index=2)[:, 1], 2*dat[:, 1])
+
+
+def test_fieldmap_data_from_archive_is_remembered(tws_input, tmp_path, monkeypatch):
+    file = tws_input['cavity']['file_efield(2)']
+    fmap = load_fieldmap(file)
+    name = os.path.basename(file)
+    writable = {name: {'attrs': dict(fmap['attrs']), 'data': np.array(fmap['data'])}}
+    assert writable[name]['data'].flags.writeable
+
+    with h5py.File(tmp_path / 'archive.h5', 'w') as h5:
+        write_fieldmap_h5(h5, writable)
+        fieldmaps = read_fieldmap_h5(h5['fieldmap'])
+    assert not fieldmaps[name]['data'].flags.writeable
+    tws_input['cavity']['file_efield(2)'] = name
+
+    n_hashes = []
+    blake2b = hashlib.blake2b
+
+    def counting_blake2b(*args, **kwargs):
+        n_hashes.append(1)
+        return blake2b(*args, **kwargs)
+
+    monkeypatch.setattr(hashlib, 'blake2b', counting_blake2b)
+    dat = fieldmap_data(tws_input, section='cavity', index=2, fieldmaps=fieldmaps)
+    assert len(n_hashes) == 1
+    tws_input['cavity']['maxe(2)'] *= 2
+    np.testing.assert_allclose(fieldmap_data(tws_input, section='cavity', index=2, fieldmaps=fieldmaps)[:, 1],
+                               2*dat[:, 1])
+    assert len(n_hashes) == 1
+
+    # Writable arrays are hashed every time, so changes are seen
+    fieldmaps = writable
+    dat = fieldmap_data(tws_input, section='cavity', index=2, fieldmaps=fieldmaps)
+    fieldmaps[name]['data'][:, 1] *= -1
+    np.testing.assert_allclose(fieldmap_data(tws_input, section='cavity', index=2, fieldmaps=fieldmaps)[:, 1],
+                               -dat[:, 1])
+    assert len(n_hashes) == 3
@@ -0,0 +1,144 @@
+import time
+
+import numpy as np
+import pytest
+
+from astra import Astra, monitor, parsers
+from astra.monitor import AbortCondition, OutputFileTail, RunMonitor, partial_output_stats
+
+
+def write_output(path, type, rows):
+    ncol = len(parsers.OutputColumnNames[type])
+    data = np.zeros((len(rows), ncol))
+    for i, row in enumerate(rows):
+        data[i, :len(row)] = row
+    np.savetxt(path / f'astra.{type}.001', data)
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    """Output of a run without C_EmitS, so there is no Cemit file"""
+    z = [0.0, 0.5, 1.0]
+    # mean_z, mean_t, mean_x, sigma_x (mm)
+    write_output(tmp_path, 'Xemit', [[zi, 0, 0, s] for zi, s in zip(z, [1.0, 1.02, 1.1])])
+    write_output(tmp_path, 'Yemit', [[zi, 0, 0, 1.0] for zi in z])
+    write_output(tmp_path, 'Zemit', [[zi, 0, 1.0] for zi in z])
+    # landf_z, landf_n_particles, landf_total_charge, landf_n_lost
+    write_output(tmp_path, 'LandF', [[zi, 100, 1, n] for zi, n in zip(z, [0, 10, 30])])
+    return tmp_path
+
+
+@pytest.mark.parametrize('condition', ['sigma_x > 1.05 mm', 'n_lost > 20%'])
+def test_abort_without_cemit(run_dir, condition):
+    monitor = RunMonitor(str(run_dir / 'astra.in'), abort=condition)
+    assert monitor.poll() == f'abort: {condition}'
+
+
+@pytest.mark.parametrize('condition', ['sigma_x > 2 mm', 'n_lost > 50%'])
+def test_no_abort(run_dir, condition):
+    monitor = RunMonitor(str(run_dir / 'astra.in'), abort=condition)
+    assert monitor.poll() == ''
+    assert monitor.status()['progress'] == 1
+
+
+def test_partial_output_stats_truncates(run_dir):
+    tails = [OutputFileTail(str(run_dir / f'astra.{t}.001')) for t in ['Cemit', 'Xemit', 'Zemit']]
+    for tail in tails:
+        tail.update()
+    # A line written to only one file
+    with open(run_dir / 'astra.Xemit.001', 'a') as f:
+        f.write(' '.join(['1.5'] * 7) + '\n')
+    tails[1].update()
+
+    stats, _ = partial_output_stats(tails)
+    assert {len(v) for v in stats.values()} == {3}
+
+
+def test_tail_reads_complete_lines(tmp_path):
+    f = tmp_path / 'astra.Zemit.001'
+    tail = OutputFileTail(str(f))
+    assert tail.update() == 0
+    f.write_text('0 0 1 0 0 0 0\n0.1 0 1')
+    assert tail.update() == 1
+    with open(f, 'a') as fh:
+        fh.write(' 0 0 0 0\n')
+    assert tail.update() == 1
+    assert tail.data().shape == (2, 7)
+
+
+def test_abort_condition_parsing():
+    assert AbortCondition('sigma_x > 3 mm').value == pytest.approx(3e-3)
+    assert AbortCondition('mean_kinetic_energy < 2 MeV').value == pytest.approx(2e6)
+    with pytest.raises(ValueError):
+        AbortCondition('sigma_x > 10%')
+    with pytest.raises(ValueError):
+        AbortCondition('not_a_stat > 1')
+
+
+def test_status_progress_and_eta(tmp_path, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(monitor, 'time', lambda: clock[0])
+    f = tmp_path / 'astra.Zemit.001'
+    monitor_ = RunMonitor(str(tmp_path / 'astra.in'), zstart=0, zstop=2)
+    assert monitor_.status()['progress'] == 0
+    assert monitor_.status()['eta'] is None
+
+    with open(f, 'w') as fid:
+        fid.write(' 0.0 0 1 0 0 0 0\n')
+        fid.flush()
+        clock[0] += 1
+        monitor_.update()
+        fid.write(' 0.5 0 1 0 0 0 0\n')
+        fid.flush()
+        clock[0] += 10
+        monitor_.update()
+
+    status = monitor_.status()
+    assert status['mean_z'] == 0.5
+    assert status['progress'] == pytest.approx(0.25)
+    assert status['rate'] == pytest.approx(0.05)
+    assert status['eta'] == pytest.approx(30)
+    assert status['elapsed'] == pytest.approx(11)
+    assert not status['stalled']
+
+
+def test_stall_detection(tmp_path, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(monitor, 'time', lambda: clock[0])
+    write_output(tmp_path, 'Zemit', [[0.0, 0, 1.0]])
+    monitor_ = RunMonitor(str(tmp_path / 'astra.in'), stall_timeout=5)
+    assert monitor_.poll() == ''
+    clock[0] += 4
+    assert monitor_.poll() == ''
+    clock[0] += 2
+    assert monitor_.poll() == 'stalled'
+    assert monitor_.status()['stalled']
+
+
+def test_run_stalled(astra_input, monkeypatch):
+    monkeypatch.setenv('FAKE_ASTRA_STALL_AT', '3')
+    A = Astra(astra_input)
+    t0 = time.time()
+    A.run(stall_timeout=1, poll_interval=0.1)
+    assert time.time() - t0 < 10
+    assert A.error
+    assert A.output['run_info']['why_error'] == 'stalled'
+    assert A.monitor.stalled
+    # The stats written before the stall
+    np.testing.assert_allclose(A.output['stats']['mean_z'], [0, 0.1, 0.2])
+
+
+def test_run_progress(astra_input, monkeypatch):
+    monkeypatch.setenv('FAKE_ASTRA_STEP_DELAY', '0.1')
+    statuses = []
+    A = Astra(astra_input)
+    A.run(progress_callback=statuses.append, poll_interval=0.05)
+    assert not A.error
+    progress = [s['progress'] for s in statuses]
+    assert progress == sorted(progress)
+    assert 0 < progress[len(progress) // 2] < 1
+    # Steady tracking: the ETA is the time to track the rest
+    s = next(s for s in statuses if s['eta'] is not None and 0.3 < s['progress'] < 0.7)
+    assert s['rate'] == pytest.approx(1.0, rel=0.5)
+    assert s['eta'] == pytest.approx((1 - s['progress']) / s['rate'])
+    assert A.monitor.status()['progress'] == 1
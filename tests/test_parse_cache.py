@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pytest
+
+from astra import parse_cache
+from astra.parse_cache import cached_parse, entry_path
+
+
+def parse(filePath):
+    return {'data': np.loadtxt(filePath), 'n': 3}
+
+
+@pytest.fixture
+def text_file(tmp_path):
+    filePath = tmp_path / 'table.txt'
+    np.savetxt(filePath, np.arange(12.).reshape(4, 3))
+    return str(filePath)
+
+
+@pytest.fixture
+def cache_on(monkeypatch):
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', '')
+
+
+def test_off_by_default(text_file, monkeypatch):
+    monkeypatch.setattr(parse_cache, '_CACHE_ROOT', None)
+    d = cached_parse(text_file, parse)
+    assert not isinstance(d['data'], np.memmap)
+    assert not os.path.exists(entry_path(text_file))
+
+
+def test_miss_returns_memory_map(text_file, cache_on):
+    d = cached_parse(text_file, parse)
+    assert isinstance(d['data'], np.memmap)
+    assert d['n'] == 3
+    np.testing.assert_array_equal(d['data'], np.arange(12.).reshape(4, 3))
+
+
+def test_hit_does_not_parse(text_file, cache_on):
+    cached_parse(text_file, parse)
+    d = cached_parse(text_file, lambda f: pytest.fail('parsed again'))
+    np.testing.assert_array_equal(d['data'], np.arange(12.).reshape(4, 3))
+
+
+def test_rewritten_file_is_parsed_again(text_file, cache_on):
+    old = entry_path(text_file)
+    cached_parse(text_file, parse)
+    np.savetxt(text_file, np.zeros((2, 3)))
+    st = os.stat(text_file)
+    os.utime(text_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    d = cached_parse(text_file, parse)
+    np.testing.assert_array_equal(d['data'], np.zeros((2, 3)))
+    # The stale entry is removed
+    assert not os.path.exists(old)
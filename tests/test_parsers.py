@@ -0,0 +1,137 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from astra import parsers
+
+
+def loadtxt(buf):
+    return np.loadtxt(io.BytesIO(buf.replace(b'D', b'E')), ndmin=2)
+
+
+@pytest.mark.parametrize('buf', [
+    b'  0.1000E+00 -0.2500E-03\n -0.1234E+01  0.0000E+00\n',
+    b'  0.1000E+00 -0.2500E-03\n -0.1234E+01 +0.0000E+00',  # No final newline
+    b'  0.1000D+00 -0.2500D-03\n',
+    b' 1.0000E+000 -2.5000E-300\r\n-1.2340E+001  0.0000E+000\r\n',
+])
+def test_fixed_width_table(buf):
+    data = parsers.read_fixed_width_table(buf, 2)
+    assert np.array_equal(data, loadtxt(buf))
+
+
+@pytest.mark.parametrize('buf', [
+    b' 0.1000E+00        2000\n',  # Integer column
+    b'  0.1000E+00 -0.2500E-03\n\n',  # Blank line
+    b'  0.1000E+00 -0.2500E-03\n  0.1000E+00 x0.2500E-03\n',
+    b'  0.1000E+00  0.2500E-03\n  0.1000E+00 -0.25001E-3\n',
+    b'1.0E+00 2.0E+00\n',  # No sign column
+])
+def test_fixed_width_table_other_forms(buf):
+    assert parsers.read_fixed_width_table(buf, 2) is None
+
+
+def test_fixed_width_table_random():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(20_000, 4))*10.0**rng.integers(-30, 30, size=(20_000, 4))
+    f = io.BytesIO()
+    np.savetxt(f, x, fmt='%17.8E')
+    buf = f.getvalue()
+    assert np.array_equal(parsers.read_fixed_width_table(buf, 4), loadtxt(buf))
+
+
+@pytest.mark.parametrize('fmt', ['%13.4E', '%.6g'])
+def test_parse_astra_output_file(tmp_path, fmt):
+    keys = parsers.OutputColumnNames['Xemit']
+    data = np.random.default_rng(1).normal(size=(100, len(keys)))
+    f = tmp_path / 'astra.Xemit.001'
+    np.savetxt(f, data, fmt=fmt)
+    ref = np.loadtxt(f)
+
+    d = parsers.parse_astra_output_file(str(f), standardize_labels=False)
+    for i, key in enumerate(keys):
+        assert np.array_equal(d[key], ref[:, i]*parsers.OutputColumnFactors['Xemit'][i])
+        assert d[key].flags.c_contiguous
+
+
+NAMELIST = """! Header comment
+&newrun
+  Head = 'Multi word head', fom(1)='x / y ! not a comment', q = 'it''s'
+  a = 3*0.0, b=1 2
+     3 4
+  c(1) = 1.5D-3, c(2) = 2d4   ! comment, d = 5
+  lflag = T, lf2 = .false.
+  name(2) = "dq""x"
+$end
+&dipole
+  D1(1) = (0.1, -0.2), D2(1)=(1D-2,3)
+  LDipole = T
+/
+&output zstop=1 /
+"""
+
+
+def test_parse_namelists():
+    d = parsers.parse_namelists(NAMELIST)
+    assert list(d) == ['newrun', 'dipole', 'output']
+    nr = d['newrun']
+    assert nr == {'head': 'Multi word head',
+                  'fom(1)': 'x / y ! not a comment',
+                  'q': "it's",
+                  'a': [0, 0, 0],
+                  'b': [1, 2, 3, 4],
+                  'c(1)': 1.5e-3,
+                  'c(2)': 20000,
+                  'lflag': True,
+                  'lf2': False,
+                  'name(2)': 'dq"x'}
+    assert d['dipole'] == {'d1(1)': [0.1, -0.2], 'd2(1)': [0.01, 3], 'ldipole': True}
+    assert d['output'] == {'zstop': 1}
+
+
+def test_parse_namelists_strings_unquoted():
+    """Multi-word strings lose their quotes, unlike with the line based parser"""
+    text = "&newrun\n  head = 'My run'\n  name = 'single'\n/\n"
+    assert parsers.parse_namelists(text)['newrun'] == {'head': 'My run', 'name': 'single'}
+    unrolled = [l for line in text.splitlines(keepends=True) for l in parsers.unroll_namelist_line(line)]
+    assert parsers.parse_unrolled_namelist(unrolled)['newrun']['head'] == "'My run'"
+
+
+def test_parse_namelists_errors():
+    with pytest.raises(ValueError, match='outside'):
+        parsers.parse_namelists('x = 1\n')
+    with pytest.raises(ValueError, match='without a key'):
+        parsers.parse_namelists('&newrun\n 1 2\n/\n')
+
+
+def test_parse_namelists_round_trip():
+    from astra.writers import namelist_lines
+    d = parsers.parse_namelists(NAMELIST)
+    del d['newrun']['q'], d['newrun']['name(2)']
+    text = '\n'.join(line for name, nl in d.items() for line in namelist_lines(nl, name)) + '\n'
+    assert parsers.parse_namelists(text) == d
+
+
+def test_parse_namelist_file_cache(tmp_path):
+    f = tmp_path / 'astra.in'
+    f.write_text('&newrun\n  run = 1\n/\n')
+    d = parsers.parse_namelist_file(str(f))
+    assert d == {'newrun': {'run': 1}}
+
+    # Copies are returned
+    d['newrun']['run'] = 5
+    assert parsers.parse_namelist_file(str(f)) == {'newrun': {'run': 1}}
+
+    # Same size, new mtime
+    st = f.stat()
+    f.write_text('&newrun\n  run = 2\n/\n')
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert parsers.parse_namelist_file(str(f)) == {'newrun': {'run': 2}}
+
+    # New size, same mtime
+    st = f.stat()
+    f.write_text('&newrun\n  run = 10\n/\n')
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert parsers.parse_namelist_file(str(f)) == {'newrun': {'run': 10}}
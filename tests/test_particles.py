@@ -0,0 +1,230 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from pmd_beamphysics.interfaces.astra import parse_astra_phase_file
+
+from astra import Astra
+from astra.particles import (PhaseFileSequence, compact_particle_group, compact_particles, load_phase_file,
+                             parse_phase_file, particle_group_nbytes, particle_stats_table)
+
+N_PARTICLES = 500
+
+
+def write_phase_file(filePath, seed=0, z=1.0):
+    rng = np.random.default_rng(seed)
+    data = np.zeros((N_PARTICLES + 1, 10))
+    data[:, :6] = rng.normal(0, [1e-3, 1e-3, 1e-4, 1e2, 1e2, 1e3], (N_PARTICLES + 1, 6))
+    data[0, :6] = [0, 0, z, 0, 0, 5e6]
+    data[:, 6] = 1e-3
+    data[:, 7] = -1e-4
+    data[:, 8] = 1
+    data[:, 9] = 5
+    # Some lost and some not yet emitted
+    data[1:21, 9] = -15
+    data[21:31, 9] = -1
+    np.savetxt(filePath, data)
+
+
+@pytest.fixture
+def astra_dir(tmp_path):
+    (tmp_path / 'astra.in').write_text("&newrun\n  run = 1\n/\n&output\n  zstop = 2\n/\n")
+    write_phase_file(tmp_path / 'astra.0100.001', seed=0, z=1.0)
+    write_phase_file(tmp_path / 'astra.0200.001', seed=1, z=2.0)
+    return tmp_path
+
+
+def rerun(astra_dir):
+    """A new run in the same workdir overwrites the phase files"""
+    for f in ('astra.0100.001', 'astra.0200.001'):
+        path = astra_dir / f
+        write_phase_file(path, seed=2)
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_load_particles_default_survives_rerun(astra_dir, fake_astra):
+    A = Astra(str(astra_dir / 'astra.in'), use_temp_dir=False)
+    A.load_particles()
+    particles = A.output['particles']
+    assert isinstance(particles, list)
+    assert len(particles) == 2
+    expected = particles[-1]['sigma_x']
+
+    rerun(astra_dir)
+    assert particles[-1]['sigma_x'] == expected
+    for f in A._phase_files():
+        os.remove(f)
+    assert particles[0]['sigma_x'] > 0
+
+
+def test_lazy_sequence_detects_rerun(astra_dir, fake_astra):
+    A = Astra(str(astra_dir / 'astra.in'), use_temp_dir=False)
+    A.load_particles(lazy=True)
+    particles = A.output['particles']
+    assert isinstance(particles, PhaseFileSequence)
+    assert particles.loaded() == []
+    P = particles[1]
+    assert particles.loaded() == [1]
+    assert particles[1] is P
+
+    rerun(astra_dir)
+    with pytest.raises(ValueError, match='changed'):
+        particles[0]
+
+
+def test_lazy_sequence_budget(astra_dir):
+    files = sorted(str(f) for f in astra_dir.glob('astra.0*.001'))
+    seq = PhaseFileSequence(files, max_bytes=1)
+    seq[0], seq[1]
+    assert seq.loaded() == [1]
+    assert [len(P) for P in seq.materialize()] == [N_PARTICLES, N_PARTICLES]
+
+
+def test_parse_phase_file_matches_pmd(astra_dir):
+    f = str(astra_dir / 'astra.0100.001')
+    expected = parse_astra_phase_file(f)
+    d = parse_phase_file(f, columns=['x', 'pz', 't'])
+    for k in ('x', 'pz', 'weight', 't'):
+        np.testing.assert_allclose(d[k], expected[k])
+
+
+def test_parse_phase_file_alive_only(astra_dir):
+    f = str(astra_dir / 'astra.0100.001')
+    P = load_phase_file(f, alive_only=True)
+    assert len(P) == N_PARTICLES - 30
+    assert np.all(P.status == 1)
+
+
+@pytest.mark.parametrize('subsample', [4, 0.25])
+def test_parse_phase_file_subsample_keeps_charge(astra_dir, subsample):
+    f = str(astra_dir / 'astra.0100.001')
+    full = load_phase_file(f)
+    P = load_phase_file(f, subsample=subsample)
+    assert len(P) == pytest.approx(N_PARTICLES / 4, abs=1 if isinstance(subsample, int) else 30)
+    assert P['charge'] == pytest.approx(full['charge'])
+
+
+def test_particle_stats_table(astra_dir):
+    files = sorted(str(f) for f in astra_dir.glob('astra.0*.001'))
+    particles = [load_phase_file(f) for f in files]
+    keys = ['mean_z', 'sigma_x', 'norm_emit_x', 'n_alive', 'n_dead']
+    table = particle_stats_table(particles, keys)
+    for i, P in enumerate(particles):
+        alive = P.where(P.status == 1)
+        for k in ('mean_z', 'sigma_x', 'norm_emit_x'):
+            assert table[k][i] == pytest.approx(alive[k])
+    # Astra convention: not yet emitted particles count as alive
+    np.testing.assert_array_equal(table['n_alive'], [N_PARTICLES - 20] * 2)
+    np.testing.assert_array_equal(table['n_dead'], [20] * 2)
+
+    with pytest.raises((ValueError, KeyError, AttributeError)):
+        particle_stats_table(particles, ['not_a_key'])
+    assert 'not_a_key' not in particle_stats_table(particles, ['not_a_key', 'mean_z'], skip_missing=True)
+
+
+def test_run_loads_particles_lazily(astra_input):
+    A = Astra(astra_input)
+    A.run()
+    particles = A.output['particles']
+    assert isinstance(particles, PhaseFileSequence)
+    assert particles.loaded() == []
+    assert particles[-1]['mean_z'] == pytest.approx(1, abs=1e-4)
+    assert particles.loaded() == [1]
+
+    A.load_output(max_bytes=1)
+    assert A.particles.max_bytes == 1
+    A.load_output(lazy=False)
+    assert isinstance(A.particles, list)
+    assert len(A.particles) == 2
+
+
+COMPACT_KEYS = ['mean_z', 'sigma_x', 'sigma_pz', 'norm_emit_x', 'norm_emit_y', 'charge', 'mean_t']
+
+
+def assert_compact(P, float32):
+    assert P.data['status'].dtype == np.int8
+    for key in ('weight', 't'):
+        assert P.data[key].strides == (0,)
+    for key in ('x', 'y', 'z', 'px', 'py', 'pz'):
+        assert P.data[key].dtype == (np.float32 if float32 else np.float64)
+
+
+@pytest.mark.parametrize('float32', [False, True])
+def test_compact_particle_group(astra_dir, float32):
+    f = str(astra_dir / 'astra.0100.001')
+    full = load_phase_file(f)
+    P = compact_particle_group(load_phase_file(f), float32=float32)
+    assert_compact(P, float32)
+    assert len(P) == len(full)
+    rel = 1e-5 if float32 else 1e-12
+    for key in COMPACT_KEYS:
+        assert P[key] == pytest.approx(full[key], rel=rel)
+    np.testing.assert_array_equal(P.status, full.status)
+    assert particle_group_nbytes(P) < particle_group_nbytes(full)
+
+    # Whole arrays can still be set
+    P.weight = P.weight * 2
+    assert P['charge'] == pytest.approx(2 * full['charge'])
+
+
+def test_compact_float32_keys(astra_dir):
+    P = load_phase_file(str(astra_dir / 'astra.0100.001'), compact=True, float32=['x', 'px'])
+    assert P.data['x'].dtype == np.float32
+    assert P.data['px'].dtype == np.float32
+    assert P.data['z'].dtype == np.float64
+
+
+def test_compact_particles(astra_dir):
+    files = sorted(str(f) for f in astra_dir.glob('astra.0*.001'))
+    particles = compact_particles([load_phase_file(f) for f in files], float32=True)
+    for P in particles:
+        assert_compact(P, True)
+
+    seq = compact_particles(PhaseFileSequence(files), float32=True)
+    assert isinstance(seq, PhaseFileSequence)
+    assert_compact(seq[-1], True)
+    assert seq[-1]['sigma_x'] == pytest.approx(particles[-1]['sigma_x'])
+
+
+def test_archive_compact(astra_input, tmp_path):
+    A = Astra(astra_input)
+    A.run()
+    h5 = str(tmp_path / 'run.h5')
+    A.archive(h5)
+
+    B = Astra()
+    B.load_archive(h5, compact=True, float32=True)
+    assert len(B.particles) == len(A.particles)
+    for P, P0 in zip(B.particles, A.particles):
+        assert_compact(P, True)
+        for key in COMPACT_KEYS:
+            assert P[key] == pytest.approx(P0[key], rel=1e-5)
+
+    B.load_archive(h5)
+    assert B.particles[-1].data['x'].dtype == np.float64
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process', 'existing'])
+@pytest.mark.parametrize('compact', [False, True])
+def test_load_particles_parallel(astra_dir, fake_astra, executor, compact):
+    for i in range(3, 7):
+        write_phase_file(astra_dir / f'astra.0{i}00.001', seed=i, z=i)
+    A = Astra(str(astra_dir / 'astra.in'), use_temp_dir=False)
+    A.load_particles(compact=compact)
+    serial = A.particles
+    assert [P['mean_z'] for P in serial] == pytest.approx([1, 2, 3, 4, 5, 6], abs=1e-3)
+
+    if executor == 'existing':
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            A.load_particles(executor=pool, compact=compact)
+    else:
+        A.load_particles(max_workers=3, executor=executor, compact=compact)
+    assert isinstance(A.particles, list)
+    assert len(A.particles) == len(serial)
+    for P, P0 in zip(A.particles, serial):
+        for key in P0.data:
+            np.testing.assert_array_equal(P.data[key], P0.data[key])
+            assert P.data[key].dtype == P0.data[key].dtype
+        assert P.species == P0.species
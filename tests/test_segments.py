@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from astra import Astra
+from astra.segments import SegmentCache, concatenate_stats, element_z_ranges, elements_at, upstream_input
+
+QUADRUPOLES = {'lquad': True,
+               'q_pos(1)': 0.2, 'q_length(1)': 0.1, 'q_k(1)': 1.0,
+               'q_pos(2)': 0.8, 'q_length(2)': 0.1, 'q_k(2)': 1.0}
+
+
+@pytest.fixture
+def astra_object(astra_input):
+    A = Astra(astra_input)
+    A.input['quadrupole'] = dict(QUADRUPOLES)
+    return A
+
+
+def test_element_z_ranges():
+    astra_input = {'quadrupole': dict(QUADRUPOLES),
+                   'aperture': {'lapert': True, 'ap_z1(1)': 0.3, 'ap_z2(1)': 0.4},
+                   'cavity': {'lefield': True, 'file_efield(1)': '/not/a/file', 'c_pos(1)': 0.1}}
+    ranges = element_z_ranges(astra_input)
+    assert ranges[('quadrupole', 1)] == pytest.approx((0.15, 0.25))
+    assert ranges[('quadrupole', 2)] == pytest.approx((0.75, 0.85))
+    assert ranges[('aperture', 1)] == (0.3, 0.4)
+    # Unknown
+    assert ranges[('cavity', 1)] is None
+
+
+def test_elements_at():
+    ranges = {('quadrupole', 1): (0.15, 0.25), ('aperture', 1): (0.3, 0.4), ('cavity', 1): None}
+    assert elements_at(ranges, 0.2) == [('quadrupole', 1)]
+    assert elements_at(ranges, 0.25) == []
+    assert elements_at(ranges, 0.35) == []
+    assert elements_at(ranges, 0.35, sections=('aperture',)) == [('aperture', 1)]
+
+
+def test_boundary_inside_element(astra_object):
+    with pytest.raises(ValueError, match='quadrupole'):
+        astra_object.run_segmented([0.5, 0.8])
+    assert astra_object.input['output']['zstop'] == 1
+
+
+def test_upstream_input():
+    astra_input = {'output': {'zstop': 1, 'zemit': 100, 'screen(1)': 0.5},
+                   'quadrupole': dict(QUADRUPOLES),
+                   'cavity': {'lefield': True, 'file_efield(1)': '/not/a/file', 'c_pos(1)': 2.0}}
+    up = upstream_input(astra_input, 0.5)
+    assert up['output'] == {}
+    assert 'q_k(1)' in up['quadrupole']
+    assert 'q_k(2)' not in up['quadrupole']
+    assert up['quadrupole']['lquad'] is True
+    # Elements with an unknown range are always upstream
+    assert up['cavity']['c_pos(1)'] == 2.0
+
+
+def test_concatenate_stats():
+    a = {'mean_z': np.array([0, 0.25, 0.5]), 'sigma_x': np.array([1, 2, 3])}
+    b = {'mean_z': np.array([0.5, 0.75, 1.0]), 'sigma_x': np.array([3, 4, 5]), 'only_b': np.zeros(3)}
+    out = concatenate_stats([a, {}, b])
+    assert set(out) == {'mean_z', 'sigma_x'}
+    np.testing.assert_array_equal(out['mean_z'], [0, 0.25, 0.5, 0.75, 1.0])
+    np.testing.assert_array_equal(out['sigma_x'], [1, 2, 3, 4, 5])
+
+
+def test_segment_cache_lru():
+    cache = SegmentCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert len(cache) == 2
+
+
+def test_run_segmented_resumes(astra_object, astra_input):
+    full = Astra(astra_input)
+    full.run()
+
+    cache = SegmentCache()
+    A = astra_object
+    A.run_segmented([0.5], cache=cache)
+    assert not A.error
+    assert A.output['run_info']['n_segments'] == 2
+    assert A.output['run_info']['n_cached_segments'] == 0
+    z = A.output['stats']['mean_z']
+    assert np.all(np.diff(z) > 0)
+    assert z[0] == pytest.approx(0) and z[-1] == pytest.approx(1)
+    assert A.particles[-1]['sigma_x'] == pytest.approx(full.particles[-1]['sigma_x'], rel=1e-6)
+    # The input is restored
+    assert A.input['output']['zstop'] == 1
+
+    # Downstream change
+    A.input['quadrupole']['q_k(2)'] = 2.0
+    A.run_segmented([0.5], cache=cache)
+    assert A.output['run_info']['n_cached_segments'] == 1
+    np.testing.assert_allclose(A.output['stats']['mean_z'], z)
+
+    # Upstream change
+    A.input['quadrupole']['q_k(1)'] = 2.0
+    A.run_segmented([0.5], cache=cache)
+    assert A.output['run_info']['n_cached_segments'] == 0
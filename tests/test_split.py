@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from astra import parsers
+from astra.particles import load_phase_file
+from astra.split import (merge_particle_lists, norm_emit_z, reference_particle_charge,
+                         split_astra_particle_file, sum_landf)
+
+N_PARTICLES = 2000
+Q_NC = -1e-3  # Charge of each macro particle, as Astra writes it
+
+
+@pytest.fixture
+def particle_file(tmp_path):
+    """Astra particle file: reference particle, then N_PARTICLES relative to it"""
+    rng = np.random.default_rng(0)
+    data = np.zeros((N_PARTICLES + 1, 10))
+    data[:, 0:2] = rng.normal(0, 1e-3, (N_PARTICLES + 1, 2))
+    data[:, 2] = rng.normal(0, 1e-3, N_PARTICLES + 1)
+    data[:, 5] = rng.normal(0, 1e3, N_PARTICLES + 1)
+    data[0, 2] = 0.5
+    data[0, 5] = 5e6
+    data[:, 7] = Q_NC
+    data[:, 8] = 1
+    data[:, 9] = 5
+    filePath = tmp_path / 'beam.ini'
+    np.savetxt(filePath, data, fmt='%.12e')
+    return str(filePath)
+
+
+def landf(n_particles, n_lost, charge):
+    z = np.array([0.0, 1.0])
+    return {'landf_z': z,
+            'landf_n_particles': np.full(2, n_particles),
+            'landf_total_charge': np.full(2, charge),
+            'landf_n_lost': np.full(2, n_lost),
+            'landf_energy_deposited': np.zeros(2),
+            'landf_energy_exchange': np.zeros(2)}
+
+
+def test_split_shares_reference(particle_file):
+    files = split_astra_particle_file(particle_file, 4)
+    lines = open(particle_file).readlines()
+    chunks = [open(f).readlines() for f in files]
+    assert all(c[0] == lines[0] for c in chunks)
+    assert sum(len(c) - 1 for c in chunks) == N_PARTICLES
+    assert [l for c in chunks for l in c[1:]] == lines[1:]
+
+
+def test_split_fewer_particles_than_chunks(particle_file, tmp_path):
+    with open(particle_file) as f:
+        lines = f.readlines()[:3]
+    small = tmp_path / 'small.ini'
+    small.write_text(''.join(lines))
+    assert len(split_astra_particle_file(str(small), 8)) == 2
+
+
+def test_reference_particle_charge(particle_file):
+    assert reference_particle_charge(particle_file) == pytest.approx(-Q_NC * 1e-9)
+
+
+@pytest.mark.parametrize('n_chunks', [1, 4])
+def test_sum_landf_counts_reference_once(particle_file, n_chunks):
+    """Each chunk counts its own copy of the reference particle"""
+    q = -Q_NC * 1e-9
+    bounds = np.linspace(0, N_PARTICLES, n_chunks + 1).astype(int)
+    others = [landf(n + 1, 0, (n + 1) * q) for n in np.diff(bounds)]
+    total = sum_landf(others, ref_charge=reference_particle_charge(particle_file))
+    full = landf(N_PARTICLES + 1, 0, (N_PARTICLES + 1) * q)
+    for key in parsers.LandFColumnNames:
+        assert total[key] == pytest.approx(full[key])
+
+
+def test_sum_landf_different_z():
+    other = landf(10, 0, 1e-12)
+    other['landf_z'] = other['landf_z'] + 0.1
+    assert sum_landf([landf(10, 0, 1e-12), other]) == {}
+    assert sum_landf([None, {}]) == {}
+
+
+def test_merge_particle_lists(particle_file):
+    files = split_astra_particle_file(particle_file, 3)
+    chunks = [[load_phase_file(f)] * 2 for f in files]
+    merged = merge_particle_lists(chunks)
+    full = load_phase_file(particle_file)
+    assert len(merged) == 2
+    assert len(merged[0]) == len(full)
+    assert merged[0]['sigma_x'] == pytest.approx(full['sigma_x'])
+
+    with pytest.raises(ValueError):
+        merge_particle_lists([chunks[0], chunks[1][:1]])
+
+
+def test_norm_emit_z(particle_file):
+    P = load_phase_file(particle_file)
+    c = np.cov(P.z, P.energy, aweights=P.weight, ddof=0)
+    expected = np.sqrt(np.linalg.det(c))
+    assert norm_emit_z(P) == pytest.approx(expected)
+
+    # Uncorrelated
+    assert norm_emit_z(P) == pytest.approx(P['sigma_z'] * P['sigma_energy'], rel=0.05)
+
+
+def test_run_split_matches_full_run(astra_input):
+    from astra import Astra
+
+    A = Astra(astra_input)
+    A.run()
+    S = Astra(astra_input)
+    S.run_split(n_chunks=4, max_workers=2)
+    assert not S.error
+    assert S.output['run_info']['n_chunks'] == 4
+
+    for key in parsers.LandFColumnNames:
+        np.testing.assert_allclose(S.output['other'][key], A.output['other'][key], rtol=1e-3)
+
+    # One stats point per particle output
+    assert len(S.output['stats']['mean_z']) == len(A.particles)
+    for key in ('sigma_x', 'norm_emit_x', 'norm_emit_z'):
+        expected = [P[key] if key != 'norm_emit_z' else norm_emit_z(P) for P in A.particles]
+        np.testing.assert_allclose(S.output['stats'][key], expected, rtol=1e-9)
+    assert S.output['stats']['norm_emit_z'][-1] == pytest.approx(A.output['stats']['norm_emit_z'][-1], rel=1e-3)
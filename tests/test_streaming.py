@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from astra.particles import load_phase_file
+from astra.streaming import StreamingStats, stream_phase_file_stats
+
+N_PARTICLES = 2000
+
+KEYS = ['mean_x', 'sigma_x', 'mean_pz', 'sigma_pz', 'mean_energy', 'sigma_energy', 'mean_kinetic_energy',
+        'min_x', 'max_x', 'ptp_z', 'cov_x__px', 'cov_z__energy', 'norm_emit_x', 'norm_emit_y', 'norm_emit_4d',
+        'higher_order_energy_spread', 'charge', 'n_particle', 'mass', 'species']
+
+
+@pytest.fixture
+def phase_file(tmp_path):
+    """Astra phase space file with correlations, charge weights that vary, and some lost particles"""
+    rng = np.random.default_rng(1)
+    data = np.zeros((N_PARTICLES + 1, 10))
+    data[1:, :6] = rng.normal(0, [1e-3, 2e-3, 1e-4, 1e3, 2e3, 1e4], (N_PARTICLES, 6))
+    data[1:, 3] += 3e5 * data[1:, 0]
+    data[1:, 5] += 1e8 * data[1:, 2] + 1e12 * data[1:, 2]**2
+    data[0, 2] = 1.0
+    data[0, 5] = 5e6
+    data[0, 6] = 3.0
+    data[:, 7] = -1e-4 * rng.uniform(0.5, 1.5, N_PARTICLES + 1)
+    data[:, 8] = 1
+    data[:, 9] = 5
+    data[1:51, 9] = -15
+    filePath = tmp_path / 'astra.0100.001'
+    np.savetxt(filePath, data, fmt='%.15e')
+    return str(filePath)
+
+
+@pytest.mark.parametrize('chunk_size', [N_PARTICLES + 1, 333])
+def test_stream_matches_particle_group(phase_file, chunk_size):
+    P = load_phase_file(phase_file)
+    alive = P.where(P.status == 1)
+    stats = stream_phase_file_stats(phase_file, KEYS, chunk_size=chunk_size)
+    for key in KEYS:
+        if key == 'species':
+            assert stats[key] == alive[key]
+        else:
+            assert stats[key] == pytest.approx(alive[key], rel=1e-9), key
+
+
+def test_stream_all_particles(phase_file):
+    P = load_phase_file(phase_file)
+    stats = stream_phase_file_stats(phase_file, ['sigma_x', 'charge', 'n_alive', 'n_dead'],
+                                    chunk_size=500, alive_only=False)
+    assert stats['sigma_x'] == pytest.approx(P['sigma_x'], rel=1e-9)
+    assert stats['charge'] == pytest.approx(P['charge'], rel=1e-12)
+    assert stats['n_alive'] == N_PARTICLES - 50
+    assert stats['n_dead'] == 50
+
+
+def test_stream_histogram(phase_file):
+    P = load_phase_file(phase_file)
+    alive = P.where(P.status == 1)
+    stats = stream_phase_file_stats(phase_file, ['mean_x'], chunk_size=300, histograms={'x': 20})
+    hist, edges = stats['histogram_x']
+    expected, expected_edges = np.histogram(alive.x, bins=20, range=(alive.x.min(), alive.x.max()),
+                                            weights=alive.weight)
+    np.testing.assert_allclose(edges, expected_edges)
+    np.testing.assert_allclose(hist, expected)
+
+
+def test_unknown_key():
+    with pytest.raises(ValueError):
+        StreamingStats(['norm_emit_q'])
@@ -0,0 +1,101 @@
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from astra import tools
+
+BUSY = [sys.executable, '-c', 'import time\nt = time.process_time()\nwhile time.process_time() - t < 0.2: pass\nprint("done")']
+BUSY_LONG = [sys.executable, '-c', 'while True: pass']
+SLEEP_2 = [sys.executable, '-c', 'import time\ntime.sleep(2)']
+SLEEP = [sys.executable, '-c', 'import time\nprint("start", flush=True)\ntime.sleep(30)']
+
+
+def test_execute_async_usage():
+    res = asyncio.run(tools.execute_async(BUSY))
+    assert not res['error']
+    assert res['log'] == 'done\n'
+    assert set(res['usage']) == {'cpu_user_time', 'cpu_system_time', 'max_rss'}
+    assert res['usage']['cpu_user_time'] + res['usage']['cpu_system_time'] >= 0.15
+    assert res['usage']['max_rss'] > 0
+
+
+def test_execute_async_same_usage_keys_as_execute2():
+    sync = tools.execute2(BUSY)
+    res = asyncio.run(tools.execute_async(BUSY))
+    assert set(res) == set(sync)
+    assert set(res['usage']) == set(sync['usage'])
+
+
+def test_execute_async_timeout():
+    t0 = time.time()
+    res = asyncio.run(tools.execute_async(SLEEP, timeout=1))
+    assert time.time() - t0 < 10
+    assert res['error']
+    assert res['why_error'] == 'timeout'
+    assert res['log'].startswith('start\n')
+
+
+def test_execute_async_cancel_kills():
+    async def main():
+        task = asyncio.create_task(tools.execute_async(SLEEP))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    t0 = time.time()
+    asyncio.run(main())
+    assert time.time() - t0 < 10
+
+
+def test_execute2_poll_kills():
+    res = tools.execute2(SLEEP, poll=lambda: 'stop', poll_interval=0.1)
+    assert res['error']
+    assert res['why_error'] == 'stop'
+
+
+def test_execute_async_holds_no_threads():
+    """More processes than executor threads, and the timeout only counts the own process"""
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+        slow = [asyncio.create_task(tools.execute_async(SLEEP_2)) for _ in range(4)]
+        await asyncio.sleep(0.2)
+        t0 = time.time()
+        quick = await tools.execute_async(BUSY, timeout=1)
+        dt = time.time() - t0
+        return await asyncio.gather(*slow), quick, dt
+
+    t0 = time.time()
+    slow, quick, dt = asyncio.run(main())
+    assert time.time() - t0 < 4
+    assert dt < 1
+    assert not quick['error']
+    assert quick['usage']['cpu_user_time'] > 0
+    for res in slow:
+        assert not res['error']
+        assert res['usage']['max_rss'] > 0
+
+
+def test_killed_process_usage():
+    res = tools.execute2(BUSY_LONG, timeout=0.5)
+    assert res['why_error'] == 'timeout'
+    assert res['usage']['cpu_user_time'] > 0.2
+
+    res = tools.execute2(BUSY_LONG, poll=lambda: 'stop', poll_interval=0.5)
+    assert res['why_error'] == 'stop'
+    assert res['usage']['cpu_user_time'] > 0.2
+
+    res = asyncio.run(tools.execute_async(BUSY_LONG, timeout=0.5))
+    assert res['why_error'] == 'timeout'
+    assert res['usage']['cpu_user_time'] > 0.2
+
+
+def test_wait_process_async_polls_without_pidfd(monkeypatch):
+    monkeypatch.delattr(tools.os, 'pidfd_open', raising=False)
+    res = asyncio.run(tools.execute_async(BUSY))
+    assert not res['error']
+    assert res['usage']['cpu_user_time'] > 0
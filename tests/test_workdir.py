@@ -0,0 +1,115 @@
+import copy
+import gc
+import os
+
+import pytest
+
+from astra import Astra
+from astra.workdir import WorkdirPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    root = tmp_path / 'pool'
+    root.mkdir()
+    pool = WorkdirPool(root=str(root))
+    yield pool
+    pool.close()
+
+
+def test_lease_and_release(pool):
+    a = pool.lease()
+    b = pool.lease()
+    assert a != b
+    assert len(pool) == 2
+
+    with open(os.path.join(a, 'output.txt'), 'w') as f:
+        f.write('x')
+    os.mkdir(os.path.join(a, 'sub'))
+    pool.release(a)
+    assert os.listdir(a) == []
+    assert pool.lease() == a
+    assert len(pool) == 2
+
+    # Not leased
+    pool.release('/not/leased')
+
+
+def test_staged_symlinks_are_kept(pool, tmp_path):
+    fmap = tmp_path / 'cav.dat'
+    fmap.write_text('0 0\n1 1\n')
+    a = pool.lease()
+    pool.stage({'cavity': {'file_efield(1)': str(fmap)}})
+    b = pool.lease()
+    for path in (a, b):
+        assert os.readlink(os.path.join(path, 'cav.dat')) == str(fmap)
+
+    os.symlink(str(fmap), os.path.join(a, 'other.dat'))
+    pool.release(a)
+    assert os.listdir(a) == ['cav.dat']
+
+
+def test_close_removes_dirs(tmp_path):
+    pool = WorkdirPool(root=str(tmp_path))
+    paths = [pool.lease() for _ in range(2)]
+    pool.close()
+    assert not any(os.path.exists(p) for p in paths)
+
+
+def test_astra_leases_lazily(pool, astra_input):
+    A = Astra(astra_input, workdir_pool=pool)
+    assert len(pool) == 0
+    A.run()
+    assert not A.error
+    assert len(pool) == 1
+    path = A.path
+    assert os.path.dirname(path) == pool.root
+
+    # Particles stay available after the workdir is released and reused
+    sigma_x = A.particles[-1]['sigma_x']
+    A.release_workdir()
+    assert os.listdir(path) == []
+    B = Astra(astra_input, workdir_pool=pool)
+    B.run()
+    assert B.path == path
+    assert A.particles[-1]['sigma_x'] == sigma_x
+
+
+def test_garbage_collected_astra_releases(pool, astra_input):
+    A = Astra(astra_input, workdir_pool=pool)
+    A.run()
+    path = A.path
+    del A
+    gc.collect()
+    assert pool.lease() == path
+
+
+def test_deepcopy_shares_pool(pool, astra_input):
+    A = Astra(astra_input, workdir_pool=pool)
+    A.run()
+    path = A.path
+    B = copy.deepcopy(A)
+    assert B.workdir_pool is pool
+    assert B._workdir_lease is None
+    assert isinstance(B.particles, list)
+    assert B.particles[-1]['sigma_x'] == A.particles[-1]['sigma_x']
+
+    # The copy runs in its own workdir
+    B.run()
+    assert not B.error
+    path_b = B.path
+    assert path_b != path
+    assert len(pool) == 2
+
+    # Releasing the copy does not release the original
+    B.release_workdir()
+    assert os.listdir(path)
+    assert pool.lease() == path_b
+
+
+def test_deepcopy_without_pool(astra_input):
+    A = Astra(astra_input)
+    A.run()
+    B = copy.deepcopy(A)
+    assert B.particles[-1]['sigma_x'] == A.particles[-1]['sigma_x']
+    assert B.input == A.input and B.input is not A.input
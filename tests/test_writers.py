@@ -0,0 +1,75 @@
+import copy
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from astra import parsers
+from astra.writers import NamelistTemplate, write_namelists
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'docs', 'examples', 'templates')
+INPUT_FILES = sorted(glob.glob(os.path.join(TEMPLATES, '*', 'astra.in')))
+
+
+def written(namelists, path):
+    f = os.path.join(path, 'astra.in')
+    write_namelists(namelists, f)
+    with open(f, 'rb') as fid:
+        return fid.read()
+
+
+@pytest.fixture(params=INPUT_FILES, ids=lambda f: os.path.basename(os.path.dirname(f)))
+def namelists(request):
+    return parsers.parse_astra_input_file(request.param)
+
+
+def test_templates_found():
+    assert INPUT_FILES
+
+
+def test_compiled_values_identical(namelists, tmp_path):
+    slots = ['newrun:run', 'output:zstop']
+    T = NamelistTemplate(namelists, slots)
+    assert T.render().encode() == written(namelists, tmp_path)
+
+
+@pytest.mark.parametrize('values', [
+    {'newrun:run': 7, 'output:zstop': 1.25},
+    {'newrun:run': 2, 'output:zstop': None, 'newrun:xlow': [1, 2.5, 3]},
+    {'newrun:xlow': True},
+])
+def test_render_identical_to_write_namelists(namelists, tmp_path, values):
+    T = NamelistTemplate(namelists, ['newrun:run', 'output:zstop', 'newrun:xlow'])
+    expected = copy.deepcopy(namelists)
+    for slot, value in values.items():
+        name, key = slot.split(':')
+        if value is None:
+            expected[name].pop(key, None)
+        else:
+            expected[name][key] = value
+
+    T.write(tmp_path / 'template.in', values)
+    with open(tmp_path / 'template.in', 'rb') as f:
+        assert f.read() == written(expected, tmp_path)
+
+
+def test_numpy_values(namelists, tmp_path):
+    T = NamelistTemplate(namelists, [('output', 'zstop')])
+    expected = copy.deepcopy(namelists)
+    expected['output']['zstop'] = np.float64(0.5)
+    assert T.render({('output', 'zstop'): np.float64(0.5)}).encode() == written(expected, tmp_path)
+
+
+def test_bad_slots(namelists):
+    with pytest.raises(ValueError):
+        NamelistTemplate(namelists, ['nonexistent:key'])
+    T = NamelistTemplate(namelists, ['newrun:run'])
+    with pytest.raises(KeyError):
+        T.render({'output:zstop': 1})
+
+
+def test_round_trip(namelists, tmp_path):
+    f = tmp_path / 'astra.in'
+    write_namelists(namelists, str(f))
+    assert parsers.parse_astra_input_file(str(f)) == namelists